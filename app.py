@@ -2,17 +2,62 @@ from datetime import datetime as dt
 from logging import exception
 
 from sqlalchemy import func
-from models import Rider, Station, Bike, Trip, setup_db
+from models import Rider, Station, Bike, Trip, batch_transaction, commit, db, setup_db
 from flask_moment import Moment
 from flask_cors import CORS
 from flask import Flask, Response, request, abort, jsonify
+import auth
 from auth import AuthError, requires_auth
+from idempotency import idempotent
+from cache import cached, response_cache
+from changes import (
+    CHANGES_LIMIT,
+    MAX_CHANGES_LIMIT,
+    assign_sequence,
+    delta_sync,
+    read_changes,
+)
+from stream import broker, event_stream, stations_changed
+from fleet import fleet
+from stats import TRIP_STATS_SOURCES, get_trip_stats
+from filters import (
+    parse_datetime_arg,
+    parse_fields,
+    project_query,
+    search_query,
+    select_query,
+)
+from rebalance import TARGET_FILL_RATIO, build_plan
+from bulk import bulk_criteria, bulk_update, bulk_values
+from decommission import assign_targets, decommission, load_decommission_state
+from forecast import FORECAST_HOURS, MAX_FORECAST_HOURS, get_profiles, observe_trip
+from profiling import setup_profiling
+from querylog import SLOW_QUERIES_LIMIT, slow_queries
+import tracing
+from tracing import setup_tracing
+from schemas import (
+    BikeBulkUpdate,
+    BikeCreate,
+    BikeUpdate,
+    RiderCreate,
+    RiderUpdate,
+    StationBulkUpdate,
+    StationCreate,
+    StationUpdate,
+    TripEnd,
+    TripStart,
+    decode_body,
+)
 
 # from .auth.auth import AuthError, requires_auth
 
 ####### Settings ########
 
 ITEMS_PER_PAGE = 10
+RIDER_TRIPS_LIMIT = 25
+MAX_RIDER_TRIPS_LIMIT = 100
+MAX_BATCH_OPERATIONS = 50
+BATCH_METHODS = ("GET", "POST", "PATCH", "DELETE")
 
 
 def create_app():
@@ -20,13 +65,16 @@ def create_app():
 
     app = Flask(__name__)
     setup_db(app)
+    setup_profiling(app)
+    setup_tracing(app, tracing.exporter)
 
     CORS(app)
 
     @app.after_request
     def after_request(response):
         response.headers.add(
-            "Access-Control-Allow-Headers", "Content-Type, Authorization, true"
+            "Access-Control-Allow-Headers",
+            "Content-Type, Authorization, Idempotency-Key, X-Profile, traceparent, true",
         )
         response.headers.add(
             "Access-Control-Allow-Methods", "GET, POST, PATCH, DELETE, OPTIONS"
@@ -34,14 +82,36 @@ def create_app():
         return response
 
     ####### PAGINATION METHOD ########
-    def paginate(request, selection):
+    def paginate(request, query, fields=None):
         page = request.args.get("page", 1, type=int)
         start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
 
-        items = [item.format() for item in selection]
+        # count and slice in the database instead of loading every row
+        total = query.order_by(None).count()
 
-        return items[start:end]
+        if page < 1:
+            return [], total
+
+        selection = query.limit(ITEMS_PER_PAGE).offset(start).all()
+        items = [item.format(fields) for item in selection]
+
+        return items, total
+
+    # optional comma separated station_id argument, 400 if not integers
+    def parse_station_ids(request):
+        station_ids = request.args.get("station_id", None)
+
+        if station_ids is None:
+            return None
+
+        try:
+            return {int(value) for value in station_ids.split(",")}
+        except ValueError:
+            abort(400)
+
+    # bikes docked at a station, counted by the indexed station id
+    def docked_bikes(station_id):
+        return Bike.query.filter(Bike.current_station_id == station_id).count()
 
     ####### ROUTES #######
 
@@ -50,63 +120,64 @@ def create_app():
     # GET List of Bikes paginated
     @app.route("/bikes")
     @requires_auth(permission="get:bikes")
+    @cached("bikes", "trips")
     def get_bikes(payload):
 
+        fields = parse_fields(request, Bike)
+        query = select_query(request, Bike, fields)
+        sync = delta_sync(request, Bike)
+
         try:
-            bikes = Bike.query.order_by(Bike.id).all()
-            current_page = paginate(request, bikes)
+            current_page, total = paginate(request, query, fields)
         except:
             abort(422)
 
-        # If no bikes return 404
-        if len(current_page) == 0:
+        # If no bikes return 404, unless delta syncing
+        if len(current_page) == 0 and sync is None:
             abort(404)
 
         return jsonify(
             {
                 "success": True,
                 "bikes": current_page,
-                "total_num_bikes": len(bikes),
+                "total_num_bikes": total,
                 "page": request.args.get("page", 1, type=int),
+                **(sync or {}),
             }
         )
 
     # create bike
     @app.route("/bikes", methods=["POST"])
     @requires_auth(permission="edit:bikes")
+    @idempotent
     def create_bike(payload):
 
-        # get data from json
-        body = request.get_json()
+        # get data from json, return 422 if invalid
+        body = decode_body(BikeCreate)
 
-        model = body.get("model", None)
-        manufactured_at = body.get("manufactured_at", None)
-        electric = body.get("electric", None)
-        current_station_id = body.get("current_station_id", None)
+        station = Station.query.get(body.current_station_id)
 
         # if station does not exist return 404
-        if current_station_id not in [station.id for station in Station.query.all()]:
+        if station is None:
             abort(404)
 
-        station = Station.query.get(current_station_id)
-
         # if station capcity is exceeded by adding a bike return 400
-        if station.capacity <= len(station.bikes):
+        if station.capacity <= docked_bikes(station.id):
             abort(400)
 
         try:
 
             bike = Bike(
-                model=model,
-                manufactured_at=manufactured_at,
-                electric=electric,
-                current_station_id=current_station_id,
+                model=body.model,
+                manufactured_at=body.manufactured_at,
+                electric=body.electric,
+                current_station_id=body.current_station_id,
             )
 
+            stations_changed(body.current_station_id)
             bike.insert()
 
-            bikes = Bike.query.order_by(Bike.id).all()
-            current_page = paginate(request, bikes)
+            current_page, total = paginate(request, Bike.query.order_by(Bike.id))
 
             # if no bikes on page return 404
             if len(current_page) == 0:
@@ -117,7 +188,7 @@ def create_app():
                     "success": True,
                     "created_bike_id": bike.id,
                     "bikes": current_page,
-                    "total_num_bikes": len(bikes),
+                    "total_num_bikes": total,
                     "page": request.args.get("page", 1, type=int),
                 }
             )
@@ -135,16 +206,16 @@ def create_app():
             abort(404)
 
         try:
+            stations_changed(bike.current_station_id)
             bike.delete()
-            remaining_bikes = Bike.query.all()
-            current_page = paginate(request, remaining_bikes)
+            current_page, total = paginate(request, Bike.query.order_by(Bike.id))
 
             return jsonify(
                 {
                     "success": True,
                     "deleted_bike_id": int(bike_id),
                     "bikes": current_page,
-                    "total_num_bikes": len(remaining_bikes),
+                    "total_num_bikes": total,
                     "page": request.args.get("page", 1, type=int),
                 }
             )
@@ -156,15 +227,6 @@ def create_app():
     @requires_auth(permission="edit:bikes")
     def update_bike(payload, bike_id):
 
-        # get info from request
-        body = request.get_json()
-
-        model = body.get("model", None)
-        manufactured_at = body.get("manufactured_at", None)
-        electric = body.get("electric", None)
-        current_station_id = body.get("current_station_id", None)
-        needs_maintenance = body.get("needs_maintenance", None)
-
         # get bike object
         bike = Bike.query.get(bike_id)
 
@@ -172,34 +234,35 @@ def create_app():
         if bike is None:
             abort(404)
 
+        # get info from request, return 422 if invalid
+        body = decode_body(BikeUpdate)
+
         # update info only when present request
-        if model is not None:
-            bike.model = model
+        if body.model is not None:
+            bike.model = body.model
 
-        if manufactured_at is not None:
-            bike.manufactured_at = manufactured_at
+        if body.manufactured_at is not None:
+            bike.manufactured_at = body.manufactured_at
 
-        if electric is not None:
-            bike.electric = electric
+        if body.electric is not None:
+            bike.electric = body.electric
 
-        if current_station_id is not None:
+        if body.current_station_id is not None:
+            station = Station.query.get(body.current_station_id)
 
             # if station does not exist return 404
-            if current_station_id not in [
-                station.id for station in Station.query.all()
-            ]:
+            if station is None:
                 abort(404)
 
-            station = Station.query.get(current_station_id)
-
             # If there is too many bikes at station return 400
-            if station.capacity <= len(station.bikes):
+            if station.capacity <= docked_bikes(station.id):
                 abort(400)
 
-            bike.current_station_id = current_station_id
+            stations_changed(bike.current_station_id, body.current_station_id)
+            bike.current_station_id = body.current_station_id
 
-        if needs_maintenance is not None:
-            bike.needs_maintenance = needs_maintenance
+        if body.needs_maintenance is not None:
+            bike.needs_maintenance = body.needs_maintenance
 
         try:
             bike.update()
@@ -209,20 +272,141 @@ def create_app():
         except Exception as error:
             abort(422)
 
+    # update every bike matching a filter in one statement
+    @app.route("/bikes", methods=["PATCH"])
+    @requires_auth(permission="edit:bikes")
+    def update_bikes(payload):
+
+        # get filter and changes from request, return 422 if invalid
+        body = decode_body(BikeBulkUpdate)
+        criteria = bulk_criteria(Bike, body.filter)
+        values = bulk_values(body.changes)
+        station_id = values.get("current_station_id", None)
+
+        if station_id is not None:
+            # locked so concurrent moves into the station cannot overfill it
+            station = (
+                db.session.query(Station.id, Station.capacity)
+                .filter(Station.id == station_id)
+                .with_for_update()
+                .first()
+            )
+
+            # if station does not exist return 404
+            if station is None:
+                abort(404)
+
+            # return 400 if the bikes moving in do not fit at the station
+            moving = Bike.query.filter(
+                *criteria, Bike.current_station_id.is_distinct_from(station_id)
+            ).count()
+            if station.capacity < docked_bikes(station_id) + moving:
+                abort(400)
+
+        try:
+            rows = bulk_update(Bike, criteria, values, previous=("current_station_id",))
+
+            if station_id is not None:
+                stations_changed(
+                    station_id, *(row.previous_current_station_id for row in rows)
+                )
+
+            commit(Bike)
+
+            return jsonify(
+                {
+                    "success": True,
+                    "updated_bike_ids": [row.id for row in rows],
+                    "num_bikes_updated": len(rows),
+                }
+            )
+        except Exception as error:
+            abort(422)
+
     ### Stations ###
 
     # get all stations
     @app.route("/stations")
     @requires_auth(permission="get:stations")
+    @cached("stations", "bikes")
     def get_stations(payload):
 
+        fields = parse_fields(request, Station)
+        query = select_query(request, Station, fields)
+        sync = delta_sync(request, Station)
+
+        try:
+            current_page, total = paginate(request, query, fields)
+        except Exception as e:
+            abort(422)
+
+        # return 404 if none found on page, unless delta syncing
+        if len(current_page) == 0 and sync is None:
+            abort(404)
+
+        return jsonify(
+            {
+                "success": True,
+                "stations": current_page,
+                "total_num_stations": total,
+                "page": request.args.get("page", 1, type=int),
+                **(sync or {}),
+            }
+        )
+
+    # bike and dock availability at stations, served from the fleet state
+    @app.route("/stations/availability")
+    @requires_auth(permission="get:stations")
+    def get_station_availability(payload):
+
+        station_ids = parse_station_ids(request)
+
+        try:
+            fleet.refresh()
+            stations = list(fleet.availability(station_ids).values())
+        except Exception as e:
+            abort(422)
+
+        return jsonify({"success": True, "stations": stations})
+
+    # stream bike and dock availability as it changes at stations
+    @app.route("/stations/stream")
+    @requires_auth(permission="get:stations")
+    def stream_stations(payload):
+
+        station_ids = parse_station_ids(request)
+
+        # subscribe before the snapshot so no change falls in between
+        subscriber = broker.subscribe()
+
         try:
-            stations = Station.query.order_by(Station.id).all()
-            current_page = paginate(request, stations)
+            fleet.refresh()
+            snapshot = list(fleet.availability(station_ids).values())
         except Exception as e:
+            broker.unsubscribe(subscriber)
             abort(422)
 
-        # return 404 if none found on page
+        return Response(
+            event_stream(subscriber, snapshot, station_ids),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    # search stations by name, best matches first
+    @app.route("/stations/search")
+    @requires_auth(permission="get:stations")
+    @cached("stations", "bikes")
+    def search_stations(payload):
+
+        fields = parse_fields(request, Station)
+        query = project_query(search_query(request, Station), Station, fields)
+
+        try:
+            current_page, total = paginate(request, query, fields)
+        except Exception as e:
+            abort(422)
+
+        # return 404 if no matches on page
         if len(current_page) == 0:
             abort(404)
 
@@ -230,7 +414,7 @@ def create_app():
             {
                 "success": True,
                 "stations": current_page,
-                "total_num_stations": len(stations),
+                "total_num_results": total,
                 "page": request.args.get("page", 1, type=int),
             }
         )
@@ -238,6 +422,7 @@ def create_app():
     # get a specific station and bikes at that station
     @app.route("/stations/<station_id>/bikes")
     @requires_auth(permission="get:stations")
+    @cached("stations", "bikes", "trips")
     def get_bikes_at_station(payload, station_id):
 
         station = Station.query.get(station_id)
@@ -246,8 +431,12 @@ def create_app():
         if station is None:
             abort(404)
 
+        fields = parse_fields(request, Bike)
+
         # gets bikes at station
-        bikes = [bike.format() for bike in station.bikes]
+        query = Bike.query.filter(Bike.current_station_id == station.id)
+        selection = project_query(query.order_by(Bike.id), Bike, fields).all()
+        bikes = [bike.format(fields) for bike in selection]
 
         return jsonify(
             {
@@ -258,32 +447,61 @@ def create_app():
             }
         )
 
+    # get expected departures and arrivals at a station for the coming hours
+    @app.route("/stations/<station_id>/forecast")
+    @requires_auth(permission="get:stations")
+    def get_station_forecast(payload, station_id):
+
+        station = Station.query.get(station_id)
+
+        # return 404 if station not found
+        if station is None:
+            abort(404)
+
+        hours = request.args.get("hours", FORECAST_HOURS, type=int)
+
+        # return 400 if forecast horizon is out of range
+        if not 1 <= hours <= MAX_FORECAST_HOURS:
+            abort(400)
+
+        try:
+            forecast = get_profiles().forecast(station.id, dt.now(), hours)
+        except Exception as e:
+            abort(422)
+
+        return jsonify(
+            {
+                "success": True,
+                "station_id": station.id,
+                "forecast": forecast,
+            }
+        )
+
     # create new station
     @app.route("/stations", methods=["POST"])
     @requires_auth(permission="edit:stations")
+    @idempotent
     def create_station(payload):
 
-        # retreive request and data
-        body = request.get_json()
-
-        name = body.get("name", None)
-        capacity = body.get("capacity", None)
-        latitude = body.get("latitude", None)
-        longitude = body.get("longitude", None)
+        # retreive request and data, return 422 if invalid
+        body = decode_body(StationCreate)
 
         try:
             # create new station
             station = Station(
-                name=name,
-                capacity=capacity,
-                latitude=latitude,
-                longitude=longitude,
+                name=body.name,
+                capacity=body.capacity,
+                latitude=body.latitude,
+                longitude=body.longitude,
             )
 
+            # flushed for its id, the stream announces the new station
+            db.session.add(station)
+            db.session.flush()
+            stations_changed(station.id)
             station.insert()
 
-            stations = Station.query.order_by(Station.id).all()
-            current_page = paginate(request, stations)
+            current_page, total = paginate(request, Station.query.order_by(Station.id))
 
             # if none found on page return 404
             if len(current_page) == 0:
@@ -294,7 +512,7 @@ def create_app():
                     "success": True,
                     "created_station_id": station.id,
                     "stations": current_page,
-                    "total_num_stations": len(stations),
+                    "total_num_stations": total,
                     "page": request.args.get("page", 1, type=int),
                 }
             )
@@ -312,9 +530,9 @@ def create_app():
             abort(404)
 
         try:
+            stations_changed(station.id)
             station.delete()
-            remaining_stations = Station.query.all()
-            current_page = paginate(request, remaining_stations)
+            current_page, total = paginate(request, Station.query.order_by(Station.id))
 
             return jsonify(
                 {
@@ -322,7 +540,7 @@ def create_app():
                     "deleted_station_id": int(station_id),
                     "stations": current_page,
                     "page": request.args.get("page", 1, type=int),
-                    "total_num_stations": len(remaining_stations),
+                    "total_num_stations": total,
                 }
             )
         except:
@@ -333,36 +551,33 @@ def create_app():
     @requires_auth(permission="edit:stations")
     def update_station(payload, station_id):
 
-        body = request.get_json()
-
-        name = body.get("name", None)
-        capacity = body.get("capacity", None)
-        latitude = body.get("latitude", None)
-        longitude = body.get("longitude", None)
-        active = body.get("active", None)
-
         station = Station.query.get(station_id)
 
-        # only update is attribute is present
+        # return 404 if station not found
         if station is None:
             abort(404)
 
-        if name is not None:
-            station.name = name
+        # return 422 if request is invalid
+        body = decode_body(StationUpdate)
+
+        # only update is attribute is present
+        if body.name is not None:
+            station.name = body.name
 
-        if capacity is not None:
-            station.capacity = capacity
+        if body.capacity is not None:
+            station.capacity = body.capacity
 
-        if latitude is not None:
-            station.latitude = latitude
+        if body.latitude is not None:
+            station.latitude = body.latitude
 
-        if longitude is not None:
-            station.longitude = longitude
+        if body.longitude is not None:
+            station.longitude = body.longitude
 
-        if active is not None:
-            station.active = active
+        if body.active is not None:
+            station.active = body.active
 
         try:
+            stations_changed(station.id)
             station.update()
 
             return jsonify({"success": True, "station_updated": station.format()})
@@ -370,19 +585,122 @@ def create_app():
         except Exception as error:
             abort(422)
 
+    # close a station, moving its bikes to the nearest stations with docks
+    @app.route("/stations/<station_id>/decommission", methods=["POST"])
+    @requires_auth(permission="edit:stations")
+    def decommission_station(payload, station_id):
+
+        state = load_decommission_state(station_id)
+
+        # return 404 if station not found
+        if state is None:
+            abort(404)
+
+        station = state["station"]
+        num_bikes = len(state["bike_ids"])
+
+        # return 400 if the other stations cannot dock all of its bikes
+        if state["spare"].sum() < num_bikes:
+            abort(400)
+
+        try:
+            assignment = assign_targets(state, num_bikes)
+        except Exception as error:
+            abort(422)
+
+        # return 400 if concurrent writes took the docks that were spare
+        if assignment is None:
+            abort(400)
+
+        try:
+            moves = decommission(state, *assignment)
+
+            stations_changed(station.id, *(move["station_id"] for move in moves))
+            commit(Station)
+
+            return jsonify(
+                {
+                    "success": True,
+                    "decommissioned_station_id": station.id,
+                    "moves": moves,
+                    "num_bikes_moved": num_bikes,
+                    "num_bikes_on_trip": state["num_bikes_on_trip"],
+                }
+            )
+        except Exception as error:
+            abort(422)
+
+    # update every station matching a filter in one statement
+    @app.route("/stations", methods=["PATCH"])
+    @requires_auth(permission="edit:stations")
+    def update_stations(payload):
+
+        # get filter and changes from request, return 422 if invalid
+        body = decode_body(StationBulkUpdate)
+
+        try:
+            rows = bulk_update(
+                Station, bulk_criteria(Station, body.filter), bulk_values(body.changes)
+            )
+
+            stations_changed(*(row.id for row in rows))
+            commit(Station)
+
+            return jsonify(
+                {
+                    "success": True,
+                    "updated_station_ids": [row.id for row in rows],
+                    "num_stations_updated": len(rows),
+                }
+            )
+        except Exception as error:
+            abort(422)
+
     #### Riders ####
     # get riders
     @app.route("/riders")
     @requires_auth(permission="get:riders")
+    @cached("riders", "trips")
     def get_riders(payload):
 
+        fields = parse_fields(request, Rider)
+        query = select_query(request, Rider, fields)
+        sync = delta_sync(request, Rider)
+
+        try:
+            current_page, total = paginate(request, query, fields)
+        except Exception as e:
+            abort(422)
+
+        # return 404 if no riders on page, unless delta syncing
+        if len(current_page) == 0 and sync is None:
+            abort(404)
+
+        return jsonify(
+            {
+                "success": True,
+                "riders": current_page,
+                "total_num_riders": total,
+                "page": request.args.get("page", 1, type=int),
+                **(sync or {}),
+            }
+        )
+
+    # search riders by name or email, best matches first
+    @app.route("/riders/search")
+    @requires_auth(permission="get:riders")
+    @cached("riders", "trips")
+    def search_riders(payload):
+
+        fields = parse_fields(request, Rider)
+        query = project_query(search_query(request, Rider), Rider, fields)
+
         try:
-            riders = Rider.query.order_by(Rider.id).all()
-            current_page = paginate(request, riders)
+            current_page, total = paginate(request, query, fields)
         except Exception as e:
             abort(422)
 
-        # return 404 if no riders on page
+        # return 404 if no matches on page
         if len(current_page) == 0:
             abort(404)
 
@@ -390,7 +708,7 @@ def create_app():
             {
                 "success": True,
                 "riders": current_page,
-                "total_num_riders": len(riders),
+                "total_num_results": total,
                 "page": request.args.get("page", 1, type=int),
             }
         )
@@ -399,16 +717,38 @@ def create_app():
 
     @app.route("/riders/<rider_id>/trips")
     @requires_auth(permission="get:riders")
+    @cached("riders", "trips", "stations")
     def get_trips_of_rider(payload, rider_id):
 
         rider = Rider.query.get(rider_id)
 
-        # return 404 if station not found
+        # return 404 if rider not found
         if rider is None:
             abort(404)
 
-        # gets bikes at station
-        trips = [trip.format() for trip in rider.trips]
+        start = parse_datetime_arg(request, "from")
+        end = parse_datetime_arg(request, "to")
+        limit = request.args.get("limit", RIDER_TRIPS_LIMIT, type=int)
+        fields = parse_fields(request, Trip)
+
+        # return 400 if limit is not positive
+        if limit < 1:
+            abort(400)
+
+        limit = min(limit, MAX_RIDER_TRIPS_LIMIT)
+
+        # newest trips first, served by the rider/start_time index
+        query = Trip.query.filter(Trip.rider_id == rider.id)
+
+        if start is not None:
+            query = query.filter(Trip.start_time >= start)
+
+        if end is not None:
+            query = query.filter(Trip.start_time < end)
+
+        query = query.order_by(Trip.start_time.desc(), Trip.id.desc()).limit(limit)
+        selection = project_query(query, Trip, fields).all()
+        trips = [trip.format(fields) for trip in selection]
 
         return jsonify(
             {
@@ -416,35 +756,31 @@ def create_app():
                 "rider_info": rider.format(),
                 "trips": trips,
                 "num_trips": len(trips),
+                "limit": limit,
             }
         )
 
     # create new rider
     @app.route("/riders", methods=["POST"])
     @requires_auth(permission="edit:riders")
+    @idempotent
     def create_rider(payload):
 
-        # get data from request
-        body = request.get_json()
-
-        name = body.get("name", None)
-        email = body.get("email", None)
-        address = body.get("address", None)
-        membership = body.get("membership", None)
+        # get data from request, return 422 if invalid
+        body = decode_body(RiderCreate)
 
         try:
             # create new rider
             rider = Rider(
-                name=name,
-                email=email,
-                address=address,
-                membership=membership,
+                name=body.name,
+                email=body.email,
+                address=body.address,
+                membership=body.membership,
             )
 
             rider.insert()
 
-            riders = Rider.query.order_by(Rider.id).all()
-            current_page = paginate(request, riders)
+            current_page, total = paginate(request, Rider.query.order_by(Rider.id))
 
             # return 404 if no riders on page
             if len(current_page) == 0:
@@ -455,7 +791,7 @@ def create_app():
                     "success": True,
                     "created_rider_id": rider.id,
                     "riders": current_page,
-                    "total_num_riders": len(riders),
+                    "total_num_riders": total,
                     "page": request.args.get("page", 1, type=int),
                 }
             )
@@ -475,8 +811,7 @@ def create_app():
 
         try:
             rider.delete()
-            remaining_riders = Rider.query.all()
-            current_page = paginate(request, remaining_riders)
+            current_page, total = paginate(request, Rider.query.order_by(Rider.id))
 
             # return 404 if no riders on page
             if len(current_page) == 0:
@@ -488,7 +823,7 @@ def create_app():
                     "deleted_rider_id": int(rider_id),
                     "riders": current_page,
                     "page": request.args.get("page", 1, type=int),
-                    "total_num_riders": len(remaining_riders),
+                    "total_num_riders": total,
                 }
             )
         except Exception as e:
@@ -499,14 +834,6 @@ def create_app():
     @requires_auth(permission="edit:riders")
     def update_rider(payload, rider_id):
 
-        # get data
-        body = request.get_json()
-
-        name = body.get("name", None)
-        email = body.get("email", None)
-        address = body.get("address", None)
-        membership = body.get("membership", None)
-
         # get rider
         rider = Rider.query.get(rider_id)
 
@@ -514,18 +841,21 @@ def create_app():
         if rider is None:
             abort(404)
 
+        # get data, return 422 if invalid
+        body = decode_body(RiderUpdate)
+
         # onlu update rider information as needed
-        if name is not None:
-            rider.name = name
+        if body.name is not None:
+            rider.name = body.name
 
-        if email is not None:
-            rider.email = email
+        if body.email is not None:
+            rider.email = body.email
 
-        if address is not None:
-            rider.address = address
+        if body.address is not None:
+            rider.address = body.address
 
-        if membership is not None:
-            rider.membership = membership
+        if body.membership is not None:
+            rider.membership = body.membership
 
         try:
             rider.update()
@@ -539,11 +869,14 @@ def create_app():
     # get list of trips
     @app.route("/trips")
     @requires_auth(permission="get:trips")
+    @cached("trips", "riders", "stations")
     def get_trips(payload):
 
+        fields = parse_fields(request, Trip)
+        query = select_query(request, Trip, fields)
+
         try:
-            trips = Trip.query.order_by(Trip.id).all()
-            current_page = paginate(request, trips)
+            current_page, total = paginate(request, query, fields)
         except Exception as e:
             abort(422)
 
@@ -555,7 +888,7 @@ def create_app():
             {
                 "success": True,
                 "trips": current_page,
-                "total_num_trips": len(trips),
+                "total_num_trips": total,
                 "page": request.args.get("page", 1, type=int),
             }
         )
@@ -563,19 +896,18 @@ def create_app():
     # Start a trip
     @app.route("/trips", methods=["POST"])
     @requires_auth("create:trips")
+    @idempotent
     def start_trip(payload):
 
-        # get trip info from request
-        body = request.get_json()
+        # get trip info from request, return 422 if invalid
+        body = decode_body(TripStart)
 
-        bike_id = body.get("bike_id", None)
-        rider_id = body.get("rider_id", None)
+        bike_id = body.bike_id
+        rider_id = body.rider_id
         start_time = dt.now()
 
         # abort if bike is already taken on unended trip
-        if bike_id in [
-            trip.bike_id for trip in Trip.query.filter(Trip.end_time == None).all()
-        ]:
+        if Trip.open_trip_of(bike_id) is not None:
             abort(400)
 
         try:
@@ -584,6 +916,7 @@ def create_app():
 
             # create strip and insert into db
             trip = Trip(rider_id, origination_station_id, bike_id, start_time)
+            stations_changed(origination_station_id)
             trip.insert()
 
             return jsonify(
@@ -606,16 +939,15 @@ def create_app():
     @requires_auth("create:trips")
     def end_trip(payload, trip_id):
 
-        # get ending location
-        body = request.get_json()
-        destination_station_id = body.get("destination_station_id", None)
-
-        trip = Trip.query.get(trip_id)
+        trip = Trip.find(trip_id)
 
         # abort if trip not found
         if trip is None:
             abort(404)
 
+        # get ending location, return 422 if invalid
+        destination_station_id = decode_body(TripEnd).destination_station_id
+
         # get bike used in trip and end station
         bike = Bike.query.get(trip.bike_id)
         end_station = Station.query.get(destination_station_id)
@@ -627,7 +959,7 @@ def create_app():
         elif trip.end_time is not None:
             abort(400)
         # abort if there are too many bikes at station
-        elif end_station.capacity <= len(end_station.bikes):
+        elif end_station.capacity <= docked_bikes(end_station.id):
             abort(400)
         # if ok end trip
         else:
@@ -637,8 +969,12 @@ def create_app():
             trip.end_time = end_time
             trip.destination_station_id = destination_station_id
 
+            stations_changed(bike.current_station_id, destination_station_id)
             bike.current_station_id = destination_station_id
 
+            # fold the closed trip into this worker's demand profiles on commit
+            observe_trip(trip)
+
             bike.update()
             trip.update()
 
@@ -651,6 +987,208 @@ def create_app():
         except:
             abort(422)
 
+    #### Rebalancing ####
+    # plan truck moves between surplus and deficit stations
+    @app.route("/rebalance/plan")
+    @requires_auth(permission="edit:bikes")
+    def get_rebalance_plan(payload):
+
+        target = request.args.get("target", TARGET_FILL_RATIO, type=float)
+
+        # return 400 if target fill ratio is not a fraction of capacity
+        if not 0 <= target <= 1:
+            abort(400)
+
+        try:
+            plan = build_plan(target_ratio=target)
+        except Exception as e:
+            abort(422)
+
+        return jsonify({"success": True, **plan})
+
+    #### Stats ####
+    # average trip duration and distance per station, bike model and membership
+    @app.route("/stats/trips")
+    @requires_auth(permission="get:trips")
+    def get_stats_trips(payload):
+
+        source = request.args.get("source", "db")
+        start = parse_datetime_arg(request, "from")
+        end = parse_datetime_arg(request, "to")
+
+        # return 400 if the source is unknown or the range is empty
+        if source not in TRIP_STATS_SOURCES or (start and end and start >= end):
+            abort(400)
+
+        try:
+            stats = get_trip_stats(source, start, end)
+        except Exception as e:
+            abort(422)
+
+        return jsonify({"success": True, **stats})
+
+    #### Batch ####
+    def run_operation(operation):
+        """Dispatches one batched operation through the normal route handlers"""
+        headers = {"Authorization": request.headers.get("Authorization", "")}
+
+        with app.test_request_context(
+            operation["path"],
+            method=operation["method"],
+            json=operation.get("body", None),
+            headers=headers,
+        ):
+            try:
+                return app.full_dispatch_request()
+            except Exception as e:
+                return app.make_response(internal_error(e))
+
+    # run several operations in one request and one transaction
+    @app.route("/batch", methods=["POST"])
+    @requires_auth()
+    @idempotent
+    def run_batch(payload):
+
+        body = request.get_json()
+        operations = body.get("operations", None) if isinstance(body, dict) else None
+        atomic = body.get("atomic", True) if isinstance(body, dict) else True
+
+        # return 400 if operations are missing or too many
+        if not isinstance(operations, list) or not (
+            0 < len(operations) <= MAX_BATCH_OPERATIONS
+        ):
+            abort(400)
+
+        # return 400 if an operation is malformed or batches another batch
+        for operation in operations:
+            if (
+                not isinstance(operation, dict)
+                or operation.get("method", None) not in BATCH_METHODS
+                or not isinstance(operation.get("path", None), str)
+                or not operation["path"].startswith("/")
+                or operation["path"].split("?")[0].rstrip("/") == "/batch"
+            ):
+                abort(400)
+
+        results = []
+        failed = False
+
+        # model writes only flush here, each operation runs in a savepoint
+        with batch_transaction() as session:
+            for operation in operations:
+                savepoint = session.begin_nested()
+                response = run_operation(operation)
+
+                if response.status_code < 400:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+                    failed = True
+
+                results.append(
+                    {"status": response.status_code, "body": response.get_json()}
+                )
+
+                # all or nothing batches stop at the first failure
+                if failed and atomic:
+                    break
+
+            if failed and atomic:
+                session.rollback()
+            else:
+                session.commit()
+
+        # return 422 with the results so far if an all or nothing batch failed
+        if failed and atomic:
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "error": 422,
+                        "message": "Unprocessable",
+                        "results": results,
+                    }
+                ),
+                422,
+            )
+
+        return jsonify(
+            {
+                "success": True,
+                "atomic": atomic,
+                "results": results,
+            }
+        )
+
+    #### Change feed ####
+    # trip and fleet writes in order, resumable from the last seq read
+    @app.route("/changes")
+    @requires_auth(permission="get:changes")
+    def get_changes(payload):
+
+        since = request.args.get("since", 0, type=int)
+        limit = request.args.get("limit", CHANGES_LIMIT, type=int)
+
+        # return 400 if position is negative or limit is not positive
+        if since < 0 or limit < 1:
+            abort(400)
+
+        limit = min(limit, MAX_CHANGES_LIMIT)
+
+        try:
+            assign_sequence()
+            selection = read_changes(since, limit + 1)
+        except Exception as e:
+            abort(422)
+
+        changes = [change.format() for change in selection[:limit]]
+
+        return jsonify(
+            {
+                "success": True,
+                "changes": changes,
+                "next_since": changes[-1]["seq"] if changes else since,
+                "has_more": len(selection) > limit,
+            }
+        )
+
+    #### Local signing authority ####
+    # public keys of the local authority, so clients can verify its tokens
+    @app.route("/.well-known/jwks.json")
+    def get_jwks():
+
+        # Auth0 serves its own JWKS
+        if not isinstance(auth.key_provider, auth.LocalAuthority):
+            abort(404)
+
+        return jsonify(auth.key_provider.jwks())
+
+    #### Admin ####
+    # response cache hit ratio and evictions for this worker
+    @app.route("/cache/stats")
+    @requires_auth(permission="get:admin")
+    def get_cache_stats(payload):
+
+        return jsonify({"success": True, "cache": response_cache.stats()})
+
+    # statements over the slow query threshold in this worker, by total time
+    @app.route("/queries/slow")
+    @requires_auth(permission="get:admin")
+    def get_slow_queries(payload):
+        limit = request.args.get("limit", SLOW_QUERIES_LIMIT, type=int)
+
+        # return 400 if limit is not positive
+        if limit < 1:
+            abort(400)
+
+        return jsonify(
+            {
+                "success": True,
+                "threshold_ms": slow_queries.threshold_ms,
+                "queries": slow_queries.top(limit),
+            }
+        )
+
     ##### ERROR HANDLERS ######
 
     @app.errorhandler(400)
@@ -679,19 +1217,33 @@ def create_app():
             404,
         )
 
-    @app.errorhandler(422)
-    def unprocessable(error):
+    @app.errorhandler(409)
+    def conflict(error):
         return (
             jsonify(
                 {
                     "success": False,
-                    "error": 422,
-                    "message": "Unprocessable",
+                    "error": 409,
+                    "message": "Conflict. Request is already being processed",
                 }
             ),
-            422,
+            409,
         )
 
+    @app.errorhandler(422)
+    def unprocessable(error):
+        response = {
+            "success": False,
+            "error": 422,
+            "message": "Unprocessable",
+        }
+
+        # invalid request bodies say which fields are wrong
+        if isinstance(error.description, list):
+            response["errors"] = error.description
+
+        return jsonify(response), 422
+
     @app.errorhandler(500)
     def internal_error(error):
         return (
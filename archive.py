@@ -0,0 +1,355 @@
+import io
+import json
+import os
+from datetime import datetime as dt, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from sqlalchemy import func
+
+from models import db, Trip
+
+####### Settings ########
+
+ARCHIVE_DIR = os.getenv("TRIP_ARCHIVE_DIR", "trip_archive")
+EXPORT_BATCH_SIZE = 100000
+# uncompressed by default so TripArchive reads map the files without
+# copying them. "zstd" or "lz4" shrink an archive kept in cold storage, at
+# the cost of decompressing every buffer on each read
+COMPRESSION = os.getenv("TRIP_ARCHIVE_COMPRESSION") or None
+
+# open trips older than this no longer hold back the export watermark, they
+# are recorded in the manifest and exported once they close
+OPEN_TRIP_GRACE = timedelta(days=2)
+
+SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("rider_id", pa.int32()),
+        ("bike_id", pa.int32()),
+        ("origination_station_id", pa.int32()),
+        ("destination_station_id", pa.int32()),
+        ("start_time", pa.timestamp("us")),
+        ("end_time", pa.timestamp("us")),
+    ]
+)
+COLUMNS = tuple(SCHEMA.names)
+
+
+####### DATABASE COLUMNS #######
+
+
+def read_trip_columns(columns=None, chunk_size=EXPORT_BATCH_SIZE):
+    """Loads columns of closed trips from the database as NumPy arrays.
+
+    Returns the same dict as TripArchive.read so analytics can run against
+    either source. Rows are streamed in chunks instead of building ORM objects.
+    """
+    columns = list(columns or COLUMNS)
+    query = db.session.query(*[getattr(Trip, column) for column in columns]).filter(
+        Trip.end_time != None
+    )
+
+    chunks = {column: [] for column in columns}
+    rows = []
+
+    for row in query.order_by(Trip.id).yield_per(chunk_size):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            _append_chunk(chunks, columns, rows)
+            rows = []
+    _append_chunk(chunks, columns, rows)
+
+    return {
+        column: np.concatenate(chunks[column])
+        if chunks[column]
+        else np.empty(0, dtype=_numpy_type(column))
+        for column in columns
+    }
+
+
+def copy_trip_columns(columns=None, start=None, end=None):
+    """Loads columns of closed trips started in [start, end) through COPY.
+
+    The rows leave Postgres as CSV and are parsed by Arrow in C, skipping
+    Python tuples entirely, for analytics over tens of millions of trips.
+    Returns the same dict as TripArchive.read.
+    """
+    columns = list(columns or COLUMNS)
+    select = db.session.query(*[getattr(Trip, column) for column in columns]).filter(
+        Trip.end_time != None
+    )
+    if start is not None:
+        select = select.filter(Trip.start_time >= start)
+    if end is not None:
+        select = select.filter(Trip.start_time < end)
+
+    statement = select.statement.compile(dialect=db.engine.dialect)
+    cursor = db.session.connection().connection.cursor()
+    query = cursor.mogrify(str(statement), statement.params).decode()
+
+    buffer = io.BytesIO()
+    cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV", buffer)
+    buffer.seek(0)
+
+    # Arrow refuses to parse an empty CSV, a range without trips has no rows
+    if not buffer.getbuffer().nbytes:
+        table = SCHEMA.empty_table().select(columns)
+    else:
+        table = pa_csv.read_csv(
+            buffer,
+            read_options=pa_csv.ReadOptions(column_names=columns),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={column: SCHEMA.field(column).type for column in columns}
+            ),
+        )
+    return {name: table.column(name).to_numpy() for name in columns}
+
+
+def _numpy_type(column):
+    return SCHEMA.field(column).type.to_pandas_dtype()
+
+
+def _append_chunk(chunks, columns, rows):
+    if not rows:
+        return
+    for column, values in zip(columns, zip(*rows)):
+        chunks[column].append(np.array(values, dtype=_numpy_type(column)))
+
+
+####### MANIFEST #######
+
+
+def manifest_path(archive_dir):
+    return os.path.join(archive_dir, "manifest.json")
+
+
+def read_manifest(archive_dir=ARCHIVE_DIR):
+    """Returns the archive manifest, an empty one if nothing was exported yet"""
+    try:
+        with open(manifest_path(archive_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {
+            "last_trip_id": 0,
+            "num_trips": 0,
+            "files": [],
+            "open_trip_ids": [],
+            "open_trips_since": None,
+        }
+
+
+def write_manifest(manifest, archive_dir=ARCHIVE_DIR):
+    path = manifest_path(archive_dir)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+####### EXPORT #######
+
+
+def export_watermark(now=None):
+    """Highest trip id the export reads up to.
+
+    Trip ids are handed out at start, so recently started trips that are
+    still open hold the watermark back, they usually close soon. Trips open
+    for longer than OPEN_TRIP_GRACE are passed and left to the manifest's
+    open_trip_ids.
+    """
+    cutoff = (now or dt.now()) - OPEN_TRIP_GRACE
+    oldest_open = (
+        db.session.query(func.min(Trip.id))
+        .filter(Trip.end_time == None, Trip.start_time >= cutoff)
+        .scalar()
+    )
+    if oldest_open is not None:
+        return oldest_open - 1
+
+    return db.session.query(func.max(Trip.id)).scalar() or 0
+
+
+def write_month(archive_dir, month, table):
+    """Writes one Arrow IPC file for the trips of one month"""
+    ids = table.column("id")
+    directory = os.path.join(archive_dir, "trips", f"month={month}")
+    name = f"part-{ids[0].as_py():012d}-{ids[-1].as_py():012d}.arrow"
+    path = os.path.join(directory, name)
+    os.makedirs(directory, exist_ok=True)
+
+    options = pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+    with pa.OSFile(path + ".tmp", "wb") as sink:
+        with pa.ipc.new_file(sink, SCHEMA, options=options) as writer:
+            writer.write_table(table)
+    os.replace(path + ".tmp", path)
+
+    return os.path.relpath(path, archive_dir)
+
+
+def trip_rows(*criteria, limit=None):
+    query = (
+        db.session.query(*[getattr(Trip, column) for column in COLUMNS])
+        .filter(*criteria)
+        .order_by(Trip.id)
+    )
+    return query.limit(limit).all() if limit else query.all()
+
+
+def export_rows(archive_dir, manifest, rows):
+    """Writes closed trip rows to the archive and adds their files to the manifest"""
+    if not rows:
+        return 0
+
+    table = pa.Table.from_arrays(
+        [
+            pa.array([row[index] for row in rows], type=field.type)
+            for index, field in enumerate(SCHEMA)
+        ],
+        schema=SCHEMA,
+    )
+
+    # split the rows by month of start_time
+    months = np.array(
+        [row[COLUMNS.index("start_time")].strftime("%Y-%m") for row in rows]
+    )
+    for month in np.unique(months):
+        mask = pa.array(months == month)
+        path = write_month(archive_dir, month, table.filter(mask))
+        manifest["files"].append(path)
+
+    manifest["num_trips"] += len(rows)
+    return len(rows)
+
+
+def record_open_trips(manifest, rows):
+    """Adds the open trips among rows to the manifest's open_trip_ids"""
+    end_time = COLUMNS.index("end_time")
+    start_time = COLUMNS.index("start_time")
+    open_rows = [row for row in rows if row[end_time] is None]
+
+    if not open_rows:
+        return
+
+    since = min(row[start_time] for row in open_rows)
+    if manifest["open_trips_since"] is not None:
+        since = min(since, dt.fromisoformat(manifest["open_trips_since"]))
+
+    manifest["open_trip_ids"] += [row[0] for row in open_rows]
+    manifest["open_trips_since"] = since.isoformat()
+
+
+def export_closed_trips(archive_dir=ARCHIVE_DIR, batch_size=EXPORT_BATCH_SIZE):
+    """Appends closed trips exported since the last run to the archive.
+
+    Files are partitioned by start_time month and the manifest records the
+    last exported trip id so every run only reads new rows. Trips still open
+    when the export passed their id are recorded in the manifest and
+    exported by the first run after they close.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    manifest = read_manifest(archive_dir)
+    manifest.setdefault("open_trip_ids", [])
+    manifest.setdefault("open_trips_since", None)
+    end_time = COLUMNS.index("end_time")
+    exported = 0
+
+    # trips passed while open, those that are gone were deleted. Bounded by
+    # the earliest start among them so only their partitions are scanned
+    if manifest["open_trip_ids"]:
+        criteria = [Trip.id.in_(manifest["open_trip_ids"])]
+        if manifest["open_trips_since"] is not None:
+            since = dt.fromisoformat(manifest["open_trips_since"])
+            criteria.append(Trip.start_time >= since)
+
+        rows = trip_rows(*criteria)
+        exported += export_rows(
+            archive_dir, manifest, [row for row in rows if row[end_time] is not None]
+        )
+        manifest["open_trip_ids"] = []
+        manifest["open_trips_since"] = None
+        record_open_trips(manifest, rows)
+        write_manifest(manifest, archive_dir)
+
+    watermark = export_watermark()
+
+    while manifest["last_trip_id"] < watermark:
+        # open trips are read too, so every id is either exported or recorded
+        rows = trip_rows(
+            Trip.id > manifest["last_trip_id"],
+            Trip.id <= watermark,
+            limit=batch_size,
+        )
+
+        if not rows:
+            break
+
+        exported += export_rows(
+            archive_dir, manifest, [row for row in rows if row[end_time] is not None]
+        )
+        record_open_trips(manifest, rows)
+        manifest["last_trip_id"] = rows[-1][0]
+        write_manifest(manifest, archive_dir)
+
+        if len(rows) < batch_size:
+            break
+
+    # trips up to the watermark are exported, recorded as open or deleted
+    manifest["last_trip_id"] = max(manifest["last_trip_id"], watermark)
+    write_manifest(manifest, archive_dir)
+
+    return exported
+
+
+####### READER #######
+
+
+class TripArchive:
+    """Memory-mapped reader over an exported trip archive.
+
+    read() returns a dict of NumPy arrays keyed by Trip column name, the same
+    shape the analytics code builds from the database.
+    """
+
+    def __init__(self, archive_dir=ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+
+    def months(self):
+        directory = os.path.join(self.archive_dir, "trips")
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            name.split("=", 1)[1]
+            for name in os.listdir(directory)
+            if name.startswith("month=")
+        )
+
+    def files(self, start=None, end=None):
+        """Yields archive files for months between start and end (YYYY-MM)"""
+        for month in self.months():
+            if start is not None and month < start:
+                continue
+            if end is not None and month > end:
+                continue
+
+            directory = os.path.join(self.archive_dir, "trips", f"month={month}")
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".arrow"):
+                    yield os.path.join(directory, name)
+
+    def read_table(self, columns=None, start=None, end=None):
+        columns = list(columns or COLUMNS)
+        tables = []
+
+        for path in self.files(start, end):
+            with pa.memory_map(path, "r") as source:
+                tables.append(pa.ipc.open_file(source).read_all().select(columns))
+
+        if not tables:
+            return SCHEMA.empty_table().select(columns)
+
+        return pa.concat_tables(tables)
+
+    def read(self, columns=None, start=None, end=None):
+        table = self.read_table(columns, start, end)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
@@ -1,14 +1,33 @@
+import base64
+import hashlib
 import json
+import os
+import threading
+import time
 from os import stat
-from flask import request
+from flask import g, request
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from urllib.request import Request, urlopen
+
+from tracing import inject, traced
+
+import rsa
 
 AUTH0_DOMAIN = "mk-bike-system.us.auth0.com"
 ALGORITHMS = ["RS256"]
 API_AUDIENCE = "bikes"
 
+# "auth0" verifies Auth0 tokens, "local" tokens minted by LocalAuthority
+AUTH_PROVIDER = os.getenv("AUTH_PROVIDER", "auth0")
+JWKS_CACHE_TTL = 600
+# unknown key ids refetch the JWKS at most this often, for key rotation
+JWKS_MIN_REFRESH = 30
+
+LOCAL_AUTHORITY_KEY = os.getenv("LOCAL_AUTHORITY_KEY", "local_authority.pem")
+LOCAL_AUTHORITY_ISSUER = "https://local-authority/"
+LOCAL_TOKEN_LIFETIME = 24 * 60 * 60
+
 ## Define standard AuthError
 
 
@@ -21,6 +40,7 @@ class AuthError(Exception):
 ## Auth Header
 
 
+@traced
 def get_token_auth_header():
     """Gets the token from the authorization header"""
 
@@ -92,70 +112,170 @@ def check_permissions(permission, payload):
     return True
 
 
+## Key providers
+
+
+class Auth0KeyProvider:
+    """Looks up Auth0 signing keys, caching the tenant's JWKS"""
+
+    def __init__(self, domain=AUTH0_DOMAIN, audience=API_AUDIENCE):
+        self.issuer = f"https://{domain}/"
+        self.audience = audience
+        self.jwks_url = f"https://{domain}/.well-known/jwks.json"
+        self.keys = {}
+        self.fetched_at = None
+        self.lock = threading.Lock()
+
+    @traced
+    def fetch(self):
+        jsonurl = urlopen(Request(self.jwks_url, headers=inject({})), timeout=5)
+        jwks = json.loads(jsonurl.read())
+        self.keys = {key["kid"]: key for key in jwks["keys"]}
+        self.fetched_at = time.monotonic()
+
+    def warm(self):
+        """Fetches the JWKS ahead of the first request"""
+        with self.lock:
+            self.fetch()
+
+    def get_key(self, kid):
+        with self.lock:
+            age = (
+                None if self.fetched_at is None else time.monotonic() - self.fetched_at
+            )
+
+            if (
+                age is None
+                or age > JWKS_CACHE_TTL
+                or (kid not in self.keys and age > JWKS_MIN_REFRESH)
+            ):
+                try:
+                    self.fetch()
+                # keep verifying with cached keys while Auth0 is unreachable
+                except Exception as e:
+                    if not self.keys:
+                        raise AuthError(
+                            {
+                                "code": "jwks_unavailable",
+                                "description": "Unable to fetch signing keys",
+                            },
+                            503,
+                        )
+
+            return self.keys.get(kid, None)
+
+
+def b64_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+class LocalAuthority:
+    """Offline RS256 signing authority for tests and load runs.
+
+    Mints tokens with any permissions and serves the matching JWKS, so the
+    API can run without reaching Auth0. The key pair is kept in key_path so
+    every process started with the same path shares it.
+    """
+
+    def __init__(self, key_path=LOCAL_AUTHORITY_KEY, audience=API_AUDIENCE):
+        self.issuer = LOCAL_AUTHORITY_ISSUER
+        self.audience = audience
+        self.private_key = self.load_or_create(key_path)
+        self.public_key = rsa.PublicKey(self.private_key.n, self.private_key.e)
+        self.kid = hashlib.sha256(b64_uint(self.private_key.n).encode()).hexdigest()[
+            :16
+        ]
+
+    @staticmethod
+    def load_or_create(key_path):
+        if key_path and os.path.exists(key_path):
+            with open(key_path, "rb") as f:
+                return rsa.PrivateKey.load_pkcs1(f.read())
+
+        # generated once per key_path, spread over all cores
+        _, private_key = rsa.newkeys(2048, poolsize=os.cpu_count() or 1)
+
+        if key_path:
+            with open(key_path, "wb") as f:
+                f.write(private_key.save_pkcs1())
+
+        return private_key
+
+    def jwks(self):
+        return {
+            "keys": [
+                {
+                    "kty": "RSA",
+                    "kid": self.kid,
+                    "use": "sig",
+                    "alg": "RS256",
+                    "n": b64_uint(self.public_key.n),
+                    "e": b64_uint(self.public_key.e),
+                }
+            ]
+        }
+
+    def get_key(self, kid):
+        return self.jwks()["keys"][0] if kid == self.kid else None
+
+    def warm(self):
+        pass
+
+    def mint(self, permissions, sub="local|user", expires_in=LOCAL_TOKEN_LIFETIME):
+        """Signs a token carrying permissions, like the ones Auth0 issues"""
+        now = int(time.time())
+        claims = {
+            "iss": self.issuer,
+            "sub": sub,
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + expires_in,
+            "permissions": list(permissions),
+        }
+        return jwt.encode(
+            claims,
+            self.private_key.save_pkcs1().decode(),
+            algorithm="RS256",
+            headers={"kid": self.kid},
+        )
+
+
+def create_key_provider(name=AUTH_PROVIDER):
+    if name == "local":
+        return LocalAuthority()
+    return Auth0KeyProvider()
+
+
+key_provider = create_key_provider()
+
+
+def set_key_provider(provider):
+    """Swaps the provider tokens are verified against, e.g. for a LocalAuthority"""
+    global key_provider
+    key_provider = provider
+
+
+@traced
 def verify_decode_jwt(token):
     """Decodes and parse jwt"""
 
-    jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-    jwts = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception as e:
+        raise AuthError(
+            {"code": "invalid_header", "description": "Authorization malformed"}, 401
+        )
 
     if "kid" not in unverified_header:
         raise AuthError(
             {"code": "invalid_header", "description": "Authorization malformed"}, 401
         )
 
-    # loop over keys in jwts and parse parts
-    for key in jwts["keys"]:
-
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
-
-        if rsa_key:
-            # if jwt is decodeable return payload
-            try:
-                payload = jwt.decode(
-                    token,
-                    rsa_key,
-                    algorithms=ALGORITHMS,
-                    audience=API_AUDIENCE,
-                    issuer=f"https://{AUTH0_DOMAIN}/",
-                )
-                return payload
-            # if jwt is expired return 401
-            except jwt.ExpiredSignatureError:
-                raise AuthError(
-                    {"code": "token_expired", "description": "token expired"}, 401
-                )
-
-            # if jwt looks for incorrect audience return 401
-            except jwt.JWTClaimsError:
-                raise AuthError(
-                    {
-                        "code": "invalid_claims",
-                        "description": "Incorrect Claims. Please check audience and issuer.",
-                    },
-                    401,
-                )
-
-            # catch other jwt parsing error
-            except Exception as e:
-                print(e)
-                raise AuthError(
-                    {
-                        "code": "invalid_header",
-                        "description": "Unable to parse authorization token",
-                    },
-                    400,
-                )
-
-        # if no keys are found raise error
+    key = key_provider.get_key(unverified_header["kid"])
+
+    # if no keys are found raise error
+    if key is None:
         raise AuthError(
             {
                 "code": "invalid_headers",
@@ -164,6 +284,59 @@ def verify_decode_jwt(token):
             400,
         )
 
+    rsa_key = {
+        "kty": key["kty"],
+        "kid": key["kid"],
+        "use": key["use"],
+        "n": key["n"],
+        "e": key["e"],
+    }
+
+    # if jwt is decodeable return payload
+    try:
+        payload = jwt.decode(
+            token,
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=key_provider.audience,
+            issuer=key_provider.issuer,
+        )
+        return payload
+    # if jwt is expired return 401
+    except jwt.ExpiredSignatureError:
+        raise AuthError({"code": "token_expired", "description": "token expired"}, 401)
+
+    # if jwt looks for incorrect audience return 401
+    except jwt.JWTClaimsError:
+        raise AuthError(
+            {
+                "code": "invalid_claims",
+                "description": "Incorrect Claims. Please check audience and issuer.",
+            },
+            401,
+        )
+
+    # catch other jwt parsing error
+    except Exception as e:
+        print(e)
+        raise AuthError(
+            {
+                "code": "invalid_header",
+                "description": "Unable to parse authorization token",
+            },
+            400,
+        )
+
+
+def verified_payload(token):
+    """Decodes a token once per app context, so batched requests verify it once"""
+    verified = g.setdefault("verified_tokens", {})
+
+    if token not in verified:
+        verified[token] = verify_decode_jwt(token)
+
+    return verified[token]
+
 
 ### Create decorator to authorize certain actions on requests in app
 def requires_auth(permission=""):
@@ -173,9 +346,10 @@ def requires_auth(permission=""):
             # get token
             token = get_token_auth_header()
             # decode token
-            payload = verify_decode_jwt(token)
-            # validate permissions for token
-            check_permissions(permission, payload)
+            payload = verified_payload(token)
+            # validate permissions for token, routes without one only authenticate
+            if permission:
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
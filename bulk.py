@@ -0,0 +1,114 @@
+from sqlalchemy import Integer, column, select, values as value_rows
+
+from models import db, append_changes, json_values, pending_commit, Bike, Station
+from fleet import fleet_changed
+
+####### FILTERS #######
+
+
+def bulk_criteria(model, filters):
+    """WHERE clauses of a decoded bulk filter, ids matches any of the ids"""
+    criteria = []
+
+    for name, value in filters._asdict().items():
+        if value is None:
+            continue
+        if name == "ids":
+            criteria.append(model.id.in_(value))
+        else:
+            criteria.append(getattr(model, name) == value)
+
+    return criteria
+
+
+def bulk_values(changes):
+    """Column values of a decoded update, fields left out are not changed"""
+    return {
+        name: value for name, value in changes._asdict().items() if value is not None
+    }
+
+
+####### UPDATES #######
+
+
+def record_updates(model, rows):
+    """Tells the change outbox, response cache and fleet state about updated rows.
+
+    Bulk statements skip the session's flush hooks that do this for model
+    writes.
+    """
+    table = model.__table__
+
+    append_changes(
+        db.session,
+        [
+            {
+                "table_name": table.name,
+                "row_id": row.id,
+                "op": "update",
+                "data": json_values({c.name: row._mapping[c.name] for c in table.c}),
+            }
+            for row in rows
+        ],
+    )
+    pending_commit().setdefault("tables", set()).add(table.name)
+
+    ids = [row.id for row in rows]
+    if model is Bike:
+        fleet_changed(bike_ids=ids)
+    elif model is Station:
+        fleet_changed(station_ids=ids)
+
+
+def bulk_update(model, criteria, values, previous=()):
+    """Updates every row matching criteria in one UPDATE ... RETURNING.
+
+    Matching rows are locked first, so the values of the previous columns
+    returned as previous_<name> are the ones each row was updated from.
+    The caller commits.
+    """
+    table = model.__table__
+
+    matched = (
+        select(table.c.id, *(table.c[name] for name in previous))
+        .where(*criteria)
+        .with_for_update()
+        .cte("matched")
+    )
+    statement = (
+        table.update()
+        .where(table.c.id == matched.c.id)
+        .values(**values)
+        .returning(
+            *table.c,
+            *(matched.c[name].label(f"previous_{name}") for name in previous),
+        )
+    )
+    rows = db.session.execute(statement).fetchall()
+
+    record_updates(model, rows)
+    return rows
+
+
+def bulk_assign(model, name, assignments):
+    """Sets column name of every row id to its own value in one UPDATE ... FROM (VALUES ...).
+
+    assignments maps row ids to values. The caller commits.
+    """
+    if not assignments:
+        return []
+
+    table = model.__table__
+    assigned = value_rows(
+        column("id", Integer), column("value", table.c[name].type), name="assigned"
+    ).data(list(assignments.items()))
+    statement = (
+        table.update()
+        .where(table.c.id == assigned.c.id)
+        .values({name: assigned.c.value})
+        .returning(*table.c)
+    )
+    rows = db.session.execute(statement).fetchall()
+
+    record_updates(model, rows)
+    return rows
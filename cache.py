@@ -0,0 +1,326 @@
+import os
+import pickle
+import select
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import Response, request
+from sqlalchemy import text
+
+from models import db, on_commit
+
+####### Settings ########
+
+# worker processes serving the app, exported by gunicorn.conf.py
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# "memory" (default for one worker), "postgres" (default for more) to bump
+# every worker's generations through LISTEN/NOTIFY, "local" for the
+# in-process shared stand-in, "redis://..." for a redis server, or "none"
+# to turn caching off
+CACHE_URL = os.getenv("CACHE_URL", "postgres" if WORKERS > 1 else "memory")
+CACHE_CHANNEL = "cache_generations"
+LISTEN_TIMEOUT_SECONDS = 15
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+
+# bounds staleness from writes this process never sees, e.g. other workers
+# on the memory backend or changes made outside the models
+CACHE_TTL = int(os.getenv("CACHE_TTL", 300))
+
+CACHE_HEADER = "X-Cache"
+
+
+####### BACKENDS #######
+
+
+class MemoryBackend:
+    """Per-process LRU of cached responses and table generations"""
+
+    name = "memory"
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=CACHE_TTL):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_generations(self, tables):
+        with self.lock:
+            return [self.generations.get(table, 0) for table in tables]
+
+    def bump_generations(self, tables):
+        with self.lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+
+    def size(self):
+        return len(self.entries)
+
+
+class PostgresBackend(MemoryBackend):
+    """Per-process LRU whose table generations are bumped in every worker.
+
+    Writes NOTIFY the tables they bump and each process LISTENs on one
+    connection, so a write in any worker invalidates every worker's entries.
+    Nothing is served while the listener is not connected, notifications
+    sent meanwhile would be missed.
+    """
+
+    name = "postgres"
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        super().__init__(max_entries)
+        self.listener = None
+        self.listening = threading.Event()
+
+    def get(self, key):
+        if not self.listening.is_set():
+            return None
+        return super().get(key)
+
+    def get_generations(self, tables):
+        with self.lock:
+            # started lazily so the thread belongs to the worker, not a
+            # preloading master
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, daemon=True)
+                self.listener.start()
+        return super().get_generations(tables)
+
+    def bump_generations(self, tables):
+        super().bump_generations(tables)
+        with db.engine.begin() as connection:
+            connection.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": CACHE_CHANNEL, "payload": ",".join(tables)},
+            )
+
+    def listen(self):
+        while True:
+            try:
+                connection = db.engine.raw_connection()
+                connection.detach()
+                connection.set_isolation_level(0)
+                connection.cursor().execute(f"LISTEN {CACHE_CHANNEL}")
+
+                # writes may have been missed while not listening
+                with self.lock:
+                    self.entries.clear()
+                self.listening.set()
+
+                while True:
+                    if select.select([connection], [], [], LISTEN_TIMEOUT_SECONDS)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            notify = connection.notifies.pop(0)
+                            super().bump_generations(notify.payload.split(","))
+            except Exception:
+                # reconnect after losing the database connection
+                self.listening.clear()
+                time.sleep(1)
+
+
+class LocalClient:
+    """In-process stand-in for the subset of the redis client the cache uses"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.store = MemoryBackend(max_entries)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def set(self, key, value, ex=CACHE_TTL):
+        self.store.set(key, value, ttl=ex)
+
+    def incr(self, key):
+        with self.store.lock:
+            value, expires_at = self.store.entries.get(key, (b"0", float("inf")))
+            value = str(int(value) + 1).encode()
+            self.store.entries[key] = (value, expires_at)
+            return int(value)
+
+    def dbsize(self):
+        return self.store.size()
+
+    def info(self, section=None):
+        return {"evicted_keys": self.store.evictions}
+
+
+class SharedBackend:
+    """Cache shared by every worker through a redis compatible client.
+
+    Generations are counters in the same store, so a write in any worker
+    invalidates the entries every other worker would read.
+    """
+
+    name = "shared"
+
+    def __init__(self, client, prefix="bike_system:cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=CACHE_TTL):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def get_generations(self, tables):
+        values = self.client.mget([self.prefix + "gen:" + table for table in tables])
+        return [int(value or 0) for value in values]
+
+    def bump_generations(self, tables):
+        for table in tables:
+            self.client.incr(self.prefix + "gen:" + table)
+
+    @property
+    def evictions(self):
+        return int(self.client.info("stats").get("evicted_keys", 0))
+
+    def size(self):
+        return self.client.dbsize()
+
+
+def backend_from_url(url=CACHE_URL):
+    """Builds the backend named by CACHE_URL, None turns caching off"""
+    if url == "none":
+        return None
+
+    # a write in one worker would leave every other worker's entries stale
+    if url in ("memory", "local") and WORKERS > 1:
+        raise ValueError(
+            f"{url} cache is per process, use postgres or redis with {WORKERS} workers"
+        )
+
+    if url == "memory":
+        return MemoryBackend()
+    if url == "postgres":
+        return PostgresBackend()
+    if url == "local":
+        return SharedBackend(LocalClient())
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        # optional dependency, only needed when a redis server is configured
+        import redis
+
+        return SharedBackend(redis.Redis.from_url(url))
+
+    raise ValueError(f"unknown cache backend: {url}")
+
+
+####### RESPONSE CACHE #######
+
+
+class ResponseCache:
+    """Caches GET responses until a table they were built from is written.
+
+    Keys combine the path, the sorted query arguments, the caller's
+    permissions and the current generation of every table the route reads.
+    Model writes bump the generations of their tables once committed, so
+    later requests build new keys and stale entries age out of the LRU.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, payload, tables):
+        args = urlencode(sorted(request.args.items(multi=True)))
+        scope = ",".join(sorted(payload.get("permissions", [])))
+        generations = self.backend.get_generations(tables)
+        versions = ",".join(f"{t}:{g}" for t, g in zip(tables, generations))
+        return f"{request.path}?{args}|{scope}|{versions}"
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, pending):
+        if self.backend is not None and pending.get("tables"):
+            self.backend.bump_generations(sorted(pending["tables"]))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name if self.backend else None,
+            "entries": self.backend.size() if self.backend else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.backend.evictions if self.backend else 0,
+        }
+
+
+response_cache = ResponseCache(backend_from_url())
+on_commit(response_cache.invalidate)
+
+
+### Create decorator to cache read routes in app
+def cached(*tables):
+    """Caches successful responses of a GET route reading from tables"""
+
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            # skip the cache while this session holds uncommitted writes (batches)
+            if response_cache.backend is None or db.session.info.get("pending_commit"):
+                return f(payload, *args, **kwargs)
+
+            key = response_cache.key(payload, tables)
+            entry = response_cache.backend.get(key)
+            response_cache.count(entry is not None)
+
+            if entry is not None:
+                body, mimetype = entry
+                response = Response(body, status=200, mimetype=mimetype)
+                response.headers[CACHE_HEADER] = "HIT"
+                return response
+
+            response = f(payload, *args, **kwargs)
+
+            # only complete successful responses are stored
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.backend.set(
+                    key, (response.get_data(), response.mimetype)
+                )
+            response.headers[CACHE_HEADER] = "MISS"
+            return response
+
+        return wrapper
+
+    return cached_decorator
@@ -0,0 +1,122 @@
+from datetime import datetime as dt, timedelta
+
+from sqlalchemy import text
+
+from filters import parse_datetime_arg
+from models import db, Change
+
+####### Settings ########
+
+CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
+CHANGE_RETENTION = timedelta(days=30)
+
+# advisory lock key held while feed positions are handed out
+SEQUENCER_LOCK = 38001
+
+# Changes commit in a different order than they are written, so feed
+# positions are only given to changes of transactions older than the
+# oldest one still running (the snapshot xmin). No change can be handed a
+# position lower than one a consumer has already read. Positions come
+# from the change_feed_seq sequence, so purging old changes never reuses
+# them, and nextval runs after the ORDER BY so they follow txid order.
+ASSIGN_SEQUENCE = text(
+    """
+    UPDATE changes SET seq = ready.seq
+    FROM (
+        SELECT id, nextval('change_feed_seq') AS seq
+        FROM changes
+        WHERE seq IS NULL
+        AND txid < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY txid, id
+    ) AS ready
+    WHERE changes.id = ready.id
+    """
+)
+
+
+def assign_sequence():
+    """Gives feed positions to changes that can no longer be preceded.
+
+    Returns the number of changes sequenced. Skipped while another request
+    holds the sequencer, that request assigns the same changes.
+    """
+    locked = db.session.execute(
+        text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": SEQUENCER_LOCK}
+    ).scalar()
+
+    sequenced = db.session.execute(ASSIGN_SEQUENCE).rowcount if locked else 0
+
+    # inside a batch the outer transaction commits
+    if not db.session.info.get("batch"):
+        db.session.commit()
+
+    return sequenced
+
+
+def read_changes(since=0, limit=CHANGES_LIMIT):
+    """Changes after feed position since, oldest first"""
+    return (
+        Change.query.filter(Change.seq > since).order_by(Change.seq).limit(limit).all()
+    )
+
+
+def purge_changes(now=None, retention=CHANGE_RETENTION):
+    """Deletes sequenced changes older than the retention, returns the number removed"""
+    cutoff = (now or dt.now()) - retention
+    removed = Change.query.filter(
+        Change.seq != None, Change.changed_at < cutoff
+    ).delete()
+    db.session.commit()
+    return removed
+
+
+####### DELTA SYNC #######
+
+
+def sync_horizon():
+    """Latest updated_at a delta sync can promise to have seen.
+
+    Rows get the start time of the transaction writing them, so a write
+    still running may commit rows older than now. Writes read before their
+    first change, when they have no xid yet, so the horizon stops at the
+    oldest open transaction of any kind.
+    """
+    return db.session.execute(
+        text(
+            """
+            SELECT least(
+                now(),
+                (SELECT min(xact_start) FROM pg_stat_activity
+                 WHERE xact_start IS NOT NULL AND datname = current_database())
+            )::timestamp
+            """
+        )
+    ).scalar()
+
+
+def delta_sync(request, model):
+    """High-water mark and deleted ids for ?updated_since=, None without it"""
+    since = parse_datetime_arg(request, "updated_since")
+
+    if since is None:
+        return None
+
+    # taken before the rows are read so no write can fall in between
+    high_water_mark = sync_horizon()
+
+    deleted = (
+        db.session.query(Change.row_id)
+        .filter(
+            Change.table_name == model.__tablename__,
+            Change.op == "delete",
+            Change.changed_at >= since,
+        )
+        .distinct()
+        .all()
+    )
+
+    return {
+        "high_water_mark": high_water_mark.isoformat(),
+        "deleted_ids": sorted(row_id for row_id, in deleted),
+    }
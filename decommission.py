@@ -0,0 +1,168 @@
+import numpy as np
+from sqlalchemy import and_, exists, func, select
+
+from bulk import bulk_assign, bulk_update
+from geo import haversine_km
+from models import db, Bike, Station, Trip
+
+####### STATE #######
+
+
+def docked_count():
+    return (
+        select(func.count(Bike.id))
+        .where(Bike.current_station_id == Station.id)
+        .scalar_subquery()
+    )
+
+
+def load_decommission_state(station_id):
+    """Locks the station and its docked bikes, reads the stations that could take them.
+
+    Bikes out on an open trip are not at the station and are left to be
+    docked wherever their trip ends. Other active stations are read with
+    their docked counts but not locked, assign_targets locks the ones it
+    picks. Rows are locked FOR NO KEY UPDATE, which the foreign key checks
+    of bike and trip writes do not wait for. Returns None if the station
+    does not exist.
+    """
+    station = (
+        db.session.query(Station.id, Station.latitude, Station.longitude)
+        .filter(Station.id == station_id)
+        .with_for_update(key_share=True)
+        .first()
+    )
+
+    if station is None:
+        return None
+
+    on_trip = exists().where(and_(Trip.bike_id == Bike.id, Trip.end_time == None))
+    bikes = (
+        db.session.query(Bike.id, on_trip)
+        .filter(Bike.current_station_id == station.id)
+        .order_by(Bike.id)
+        .with_for_update(of=Bike, key_share=True)
+        .all()
+    )
+
+    candidates = (
+        db.session.query(
+            Station.id,
+            Station.capacity,
+            Station.latitude,
+            Station.longitude,
+            docked_count(),
+        )
+        .filter(Station.active.isnot(False), Station.id != station.id)
+        .order_by(Station.id)
+        .all()
+    )
+
+    return {
+        "station": station,
+        "bike_ids": np.array([b[0] for b in bikes if not b[1]], dtype=np.int64),
+        "num_bikes_on_trip": sum(1 for b in bikes if b[1]),
+        "id": np.array([c[0] for c in candidates], dtype=np.int64),
+        "spare": np.array([max(c[1] - c[4], 0) for c in candidates], dtype=np.int64),
+        "latitude": np.array([c[2] for c in candidates], dtype=np.float64),
+        "longitude": np.array([c[3] for c in candidates], dtype=np.float64),
+    }
+
+
+####### ASSIGNMENT #######
+
+
+def assign_nearest(latitude, longitude, candidates, num_bikes):
+    """Candidate index of each of num_bikes bikes, filling the nearest spare docks first.
+
+    Also returns the distance to every candidate. The candidates' spare
+    docks must add up to at least num_bikes.
+    """
+    distance = haversine_km(
+        latitude, longitude, candidates["latitude"], candidates["longitude"]
+    )
+    order = np.argsort(distance, kind="stable")
+
+    # one slot per spare dock, nearest stations first
+    slots = np.repeat(order, candidates["spare"][order])
+    return slots[:num_bikes], distance
+
+
+def lock_targets(state, indexes):
+    """Locks candidate stations in id order and re-counts their spare docks.
+
+    Counted after the lock is granted, so the counts include every write
+    that committed while waiting for it.
+    """
+    station_ids = state["id"][indexes].tolist()
+
+    (
+        db.session.query(Station.id)
+        .filter(Station.id.in_(station_ids))
+        .order_by(Station.id)
+        .with_for_update(key_share=True)
+        .all()
+    )
+
+    spare = dict(
+        db.session.query(Station.id, Station.capacity - docked_count())
+        .filter(Station.id.in_(station_ids))
+        .all()
+    )
+    # a station deleted meanwhile has no docks left
+    state["spare"][indexes] = [max(spare.get(i, 0), 0) for i in station_ids]
+
+
+def assign_targets(state, num_bikes):
+    """Assigns bikes to the nearest spare docks, locking the stations picked.
+
+    Bikes are assigned again when writes committed before a lock took docks
+    the assignment counted on. Returns the targets and distances like
+    assign_nearest, or None once the stations cannot dock every bike.
+    """
+    station = state["station"]
+
+    while state["spare"].sum() >= num_bikes:
+        targets, distance = assign_nearest(
+            station.latitude, station.longitude, state, num_bikes
+        )
+        indexes = np.unique(targets)
+        assigned = np.bincount(targets, minlength=len(state["id"]))[indexes]
+
+        lock_targets(state, indexes)
+        if (assigned <= state["spare"][indexes]).all():
+            return targets, distance
+
+    return None
+
+
+####### DECOMMISSION #######
+
+
+def decommission(state, targets, distance):
+    """Moves the station's bikes to their target stations and deactivates it.
+
+    Two set-based statements whatever the number of bikes. The caller
+    commits.
+    """
+    station_id = state["station"].id
+    target_ids = state["id"][targets]
+
+    bulk_assign(
+        Bike,
+        "current_station_id",
+        dict(zip(state["bike_ids"].tolist(), target_ids.tolist())),
+    )
+    bulk_update(Station, [Station.id == station_id], {"active": False})
+
+    moves = []
+    for index in np.unique(targets):
+        moves.append(
+            {
+                "station_id": int(state["id"][index]),
+                "bike_ids": state["bike_ids"][targets == index].tolist(),
+                "distance_km": round(float(distance[index]), 3),
+            }
+        )
+
+    return sorted(moves, key=lambda move: move["distance_km"])
@@ -0,0 +1,261 @@
+from datetime import datetime as dt, timedelta
+
+from flask import abort
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm import defaultload, load_only, noload
+from models import Bike, Station, Rider, Trip
+
+####### Settings ########
+
+# query arguments that compile to WHERE clauses, by model
+FILTER_FIELDS = {
+    Bike: ("model", "electric", "needs_maintenance", "current_station_id"),
+    Station: ("name", "active", "capacity"),
+    Rider: ("membership",),
+    Trip: ("rider_id", "bike_id", "origination_station_id", "destination_station_id"),
+}
+
+# columns allowed in ?sort=, prefix with - for descending
+SORT_FIELDS = {
+    Bike: ("id", "model", "manufactured_at", "current_station_id"),
+    Station: ("id", "name", "capacity"),
+    Rider: ("id", "name"),
+    Trip: ("id", "start_time", "end_time", "rider_id", "bike_id"),
+}
+
+# column filtered by ?from= and ?to=
+TIME_FIELDS = {Trip: "start_time"}
+
+# columns matched by /<collection>/search?q=
+SEARCH_FIELDS = {Rider: ("name", "email"), Station: ("name",)}
+
+# shorter terms have no trigrams and only match as a prefix
+MIN_TRIGRAM_LENGTH = 3
+
+TRUE_VALUES = ("true", "1", "yes")
+FALSE_VALUES = ("false", "0", "no")
+
+
+####### VALUE PARSING #######
+
+
+def parse_bool(value):
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(f"not a boolean: {value}")
+
+
+def parse_datetime(value, upper=False):
+    """Parses an ISO date or datetime, a bare date as upper bound includes the whole day"""
+    parsed = dt.fromisoformat(value)
+
+    if upper and len(value) == 10:
+        parsed += timedelta(days=1)
+
+    return parsed
+
+
+def parse_column_value(column, value):
+    """Converts a query argument to the python type of a model column"""
+    python_type = column.type.python_type
+
+    if python_type is bool:
+        return parse_bool(value)
+    if python_type is dt:
+        return parse_datetime(value)
+
+    return python_type(value)
+
+
+def parse_datetime_arg(request, name):
+    """Returns the datetime in a query argument, None if absent and 400 if malformed"""
+    value = request.args.get(name, None)
+
+    if value is None:
+        return None
+
+    try:
+        return parse_datetime(value, upper=(name == "to"))
+    except ValueError:
+        abort(400)
+
+
+####### QUERY BUILDING #######
+
+
+def filter_query(request, model, query):
+    """Adds WHERE clauses for whitelisted query arguments.
+
+    Comma separated values match any of them. Values are validated against
+    the model column types and malformed ones return 400.
+    """
+    columns = model.__table__.columns
+
+    for name in FILTER_FIELDS.get(model, ()):
+        raw = request.args.get(name, None)
+
+        if raw is None:
+            continue
+
+        try:
+            values = [
+                parse_column_value(columns[name], value) for value in raw.split(",")
+            ]
+        except ValueError:
+            abort(400)
+
+        attribute = getattr(model, name)
+        if len(values) == 1:
+            query = query.filter(attribute == values[0])
+        else:
+            query = query.filter(attribute.in_(values))
+
+    if model in TIME_FIELDS:
+        attribute = getattr(model, TIME_FIELDS[model])
+        start = parse_datetime_arg(request, "from")
+        end = parse_datetime_arg(request, "to")
+
+        if start is not None:
+            query = query.filter(attribute >= start)
+
+        if end is not None:
+            query = query.filter(attribute < end)
+
+    # delta sync, rows written at or after updated_since
+    if hasattr(model, "updated_at"):
+        updated_since = parse_datetime_arg(request, "updated_since")
+
+        if updated_since is not None:
+            query = query.filter(model.updated_at >= updated_since)
+
+    # trips can also be narrowed to those still out or already ended
+    if model is Trip and "open" in request.args:
+        try:
+            open_trips = parse_bool(request.args["open"])
+        except ValueError:
+            abort(400)
+
+        if open_trips:
+            query = query.filter(Trip.end_time == None)
+        else:
+            query = query.filter(Trip.end_time != None)
+
+    return query
+
+
+def sort_query(request, model, query):
+    """Adds ORDER BY clauses from ?sort=, always ending on id for stable pages"""
+    keys = request.args.get("sort", "id").split(",")
+    clauses = []
+    names = []
+
+    for key in keys:
+        name = key.strip().lstrip("-")
+
+        # return 400 if column may not be sorted on
+        if name not in SORT_FIELDS.get(model, ()):
+            abort(400)
+
+        attribute = getattr(model, name)
+        clauses.append(attribute.desc() if key.strip().startswith("-") else attribute)
+        names.append(name)
+
+    if "id" not in names:
+        clauses.append(model.id)
+
+    return query.order_by(*clauses)
+
+
+def select_query(request, model, fields=None):
+    """Builds the filtered, sorted and projected query behind a collection route"""
+    query = sort_query(request, model, filter_query(request, model, model.query))
+    return project_query(query, model, fields)
+
+
+####### SPARSE FIELDSETS #######
+
+
+def parse_fields(request, model):
+    """Returns the format() keys named in ?fields=, None for all and 400 if unknown"""
+    raw = request.args.get("fields", None)
+
+    if raw is None:
+        return None
+
+    fields = {name.strip() for name in raw.split(",") if name.strip()}
+    known = set(model.FORMAT_COLUMNS) | set(model.DERIVED_FIELDS)
+
+    # return 400 if no fields or a field format() does not have
+    if not fields or not fields <= known:
+        abort(400)
+
+    return fields
+
+
+def project_query(query, model, fields):
+    """Loads only the columns and relationships the requested fields need.
+
+    Relationships no requested field depends on are not loaded at all, which
+    drops the eager joins behind num_bikes and num_trips.
+    """
+    if fields is None:
+        return query
+
+    needed = set()
+    for name in fields:
+        needed.update(model.DERIVED_FIELDS.get(name, (name,)))
+
+    relationships = model.__mapper__.relationships.keys()
+    columns = [getattr(model, name) for name in needed if name not in relationships]
+
+    options = [load_only(*(columns or [model.id]))]
+    for name in relationships:
+        if name in needed:
+            # a loaded relationship is only counted, skip its own eager joins
+            options.append(defaultload(getattr(model, name)).noload("*"))
+        else:
+            options.append(noload(getattr(model, name)))
+
+    return query.options(*options)
+
+
+####### SEARCH #######
+
+
+def escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_query(request, model):
+    """Builds a ranked prefix/fuzzy search over the model's search columns.
+
+    Prefix matches rank first, then trigram similarity. Both are served by
+    the lowercase prefix and trigram indexes on the searched columns.
+    """
+    term = request.args.get("q", "").strip()
+
+    # return 400 if there is nothing to search for
+    if not term:
+        abort(400)
+
+    columns = [getattr(model, name) for name in SEARCH_FIELDS[model]]
+    prefix = escape_like(term.lower()) + "%"
+    prefix_matches = [func.lower(column).like(prefix) for column in columns]
+    score = case((or_(*prefix_matches), 1.0), else_=0.0)
+
+    if len(term) < MIN_TRIGRAM_LENGTH:
+        condition = or_(*prefix_matches)
+    else:
+        contains = "%" + escape_like(term) + "%"
+        condition = or_(
+            *prefix_matches,
+            *[column.ilike(contains) for column in columns],
+            *[column.op("%")(term) for column in columns],
+        )
+        score = score + func.greatest(
+            *[func.similarity(column, term) for column in columns]
+        )
+
+    return model.query.filter(condition).order_by(score.desc(), model.id)
@@ -0,0 +1,355 @@
+import os
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import and_, event, exists
+from sqlalchemy.orm import Session
+
+from models import db, Bike, Station, Trip, on_commit, pending_commit
+from stream import broker, station_availability
+
+####### Settings ########
+
+# how often reads compare the fleet state with the database, catching writes
+# made by other workers or outside the models
+FLEET_CHECK_SECONDS = int(os.getenv("FLEET_CHECK_SECONDS", 60))
+
+NO_STATION = -1
+
+
+####### ROWS #######
+
+
+def bike_rows(bike_ids=None):
+    """(id, current_station_id, on_trip) of bikes, all of them by default"""
+    on_trip = exists().where(and_(Trip.bike_id == Bike.id, Trip.end_time == None))
+    query = db.session.query(Bike.id, Bike.current_station_id, on_trip)
+
+    if bike_ids is not None:
+        query = query.filter(Bike.id.in_(bike_ids))
+
+    return query.all()
+
+
+def station_rows(station_ids=None):
+    """(id, capacity, active) of stations, all of them by default"""
+    query = db.session.query(Station.id, Station.capacity, Station.active)
+
+    if station_ids is not None:
+        query = query.filter(Station.id.in_(station_ids))
+
+    return query.all()
+
+
+def fleet_rows(bike_ids, station_ids):
+    """Rows of bikes and stations to apply to the fleet state, missing ones removed"""
+    bikes = bike_rows(bike_ids) if bike_ids else []
+    stations = station_rows(station_ids) if station_ids else []
+
+    return {
+        "bikes": bikes,
+        "stations": stations,
+        "removed_bikes": set(bike_ids) - {row[0] for row in bikes},
+        "removed_stations": set(station_ids) - {row[0] for row in stations},
+    }
+
+
+def grow(array, size, fill):
+    """array padded with fill to hold index size - 1, doubling to amortize"""
+    if len(array) >= size:
+        return array
+
+    grown = np.full(max(size, 2 * len(array)), fill, dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+####### FLEET STATE #######
+
+
+class FleetState:
+    """Station occupancy and bike whereabouts of the fleet in NumPy columns.
+
+    Columns are indexed by station and bike id. Docked counts include bikes
+    out on a trip, which still hold a dock at their station, the same way
+    station_availability counts them.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.checked_at = None
+        self.reloads = 0
+
+        self.station_exists = np.zeros(0, dtype=bool)
+        self.station_active = np.zeros(0, dtype=bool)
+        self.station_capacity = np.zeros(0, dtype=np.int32)
+        self.station_docked = np.zeros(0, dtype=np.int32)
+        self.station_available = np.zeros(0, dtype=np.int32)
+
+        self.bike_exists = np.zeros(0, dtype=bool)
+        self.bike_station = np.zeros(0, dtype=np.int32)
+        self.bike_on_trip = np.zeros(0, dtype=bool)
+
+    def load(self):
+        """Replaces the state with the fleet in the database"""
+        # changes committed by other workers are relayed from now on
+        broker.start()
+
+        stations = station_rows()
+        bikes = bike_rows()
+
+        station_ids = np.array([row[0] for row in stations], dtype=np.int64)
+        bike_ids = np.array([row[0] for row in bikes], dtype=np.int64)
+        bike_station = np.array(
+            [NO_STATION if row[1] is None else row[1] for row in bikes],
+            dtype=np.int32,
+        )
+        on_trip = np.array([row[2] for row in bikes], dtype=bool)
+
+        num_stations = int(
+            max(station_ids.max(initial=-1), bike_station.max(initial=-1))
+        )
+        num_stations += 1
+        num_bikes = int(bike_ids.max(initial=-1)) + 1
+        docked = bike_station != NO_STATION
+
+        with self.lock:
+            self.station_exists = np.zeros(num_stations, dtype=bool)
+            self.station_exists[station_ids] = True
+            self.station_active = np.zeros(num_stations, dtype=bool)
+            self.station_active[station_ids] = [row[2] is not False for row in stations]
+            self.station_capacity = np.zeros(num_stations, dtype=np.int32)
+            self.station_capacity[station_ids] = [row[1] for row in stations]
+            self.station_docked = np.bincount(
+                bike_station[docked], minlength=num_stations
+            ).astype(np.int32)
+            self.station_available = np.bincount(
+                bike_station[docked & ~on_trip], minlength=num_stations
+            ).astype(np.int32)
+
+            self.bike_exists = np.zeros(num_bikes, dtype=bool)
+            self.bike_exists[bike_ids] = True
+            self.bike_station = np.full(num_bikes, NO_STATION, dtype=np.int32)
+            self.bike_station[bike_ids] = bike_station
+            self.bike_on_trip = np.zeros(num_bikes, dtype=bool)
+            self.bike_on_trip[bike_ids] = on_trip
+
+            self.loaded = True
+            self.checked_at = time.monotonic()
+
+    ### Reads ###
+
+    def availability(self, station_ids=None):
+        """Bikes and docks available at stations, keyed by station id"""
+        with self.lock:
+            if station_ids is None:
+                ids = np.flatnonzero(self.station_exists)
+            else:
+                ids = np.array(
+                    [i for i in station_ids if 0 <= i < len(self.station_exists)],
+                    dtype=np.int64,
+                )
+                ids = ids[self.station_exists[ids]]
+
+            docks = np.maximum(self.station_capacity[ids] - self.station_docked[ids], 0)
+            available = self.station_available[ids]
+
+        return {
+            int(station_id): {
+                "station_id": int(station_id),
+                "bikes_available": int(bikes),
+                "docks_available": int(free),
+            }
+            for station_id, bikes, free in zip(ids, available, docks)
+        }
+
+    def bikes_at(self, station_id):
+        """Ids of the bikes docked at a station, including those on a trip"""
+        with self.lock:
+            return np.flatnonzero(self.bike_exists & (self.bike_station == station_id))
+
+    def bikes_on_trip(self):
+        with self.lock:
+            return np.flatnonzero(self.bike_on_trip)
+
+    ### Writes ###
+
+    def ensure_size(self, station_id=None, bike_id=None):
+        if station_id is not None and station_id >= len(self.station_exists):
+            size = station_id + 1
+            self.station_exists = grow(self.station_exists, size, False)
+            self.station_active = grow(self.station_active, size, False)
+            self.station_capacity = grow(self.station_capacity, size, 0)
+            self.station_docked = grow(self.station_docked, size, 0)
+            self.station_available = grow(self.station_available, size, 0)
+
+        if bike_id is not None and bike_id >= len(self.bike_exists):
+            size = bike_id + 1
+            self.bike_exists = grow(self.bike_exists, size, False)
+            self.bike_station = grow(self.bike_station, size, NO_STATION)
+            self.bike_on_trip = grow(self.bike_on_trip, size, False)
+
+    def count_bike(self, bike_id, change):
+        station_id = self.bike_station[bike_id]
+        if self.bike_exists[bike_id] and station_id != NO_STATION:
+            self.station_docked[station_id] += change
+            if not self.bike_on_trip[bike_id]:
+                self.station_available[station_id] += change
+
+    def set_bike(self, bike_id, station_id, on_trip):
+        station_id = NO_STATION if station_id is None else station_id
+        self.ensure_size(station_id=station_id, bike_id=bike_id)
+
+        self.count_bike(bike_id, -1)
+        self.bike_exists[bike_id] = True
+        self.bike_station[bike_id] = station_id
+        self.bike_on_trip[bike_id] = on_trip
+        self.count_bike(bike_id, 1)
+
+    def remove_bike(self, bike_id):
+        if bike_id < len(self.bike_exists):
+            self.count_bike(bike_id, -1)
+            self.bike_exists[bike_id] = False
+            self.bike_station[bike_id] = NO_STATION
+            self.bike_on_trip[bike_id] = False
+
+    def set_station(self, station_id, capacity, active):
+        self.ensure_size(station_id=station_id)
+        self.station_exists[station_id] = True
+        self.station_capacity[station_id] = capacity
+        self.station_active[station_id] = active is not False
+
+    def remove_station(self, station_id):
+        if station_id < len(self.station_exists):
+            self.station_exists[station_id] = False
+
+    def apply(self, changes):
+        """Applies rows read by read_fleet_changes once their write committed"""
+        if not self.loaded:
+            return
+
+        with self.lock:
+            for station_id, capacity, active in changes["stations"]:
+                self.set_station(station_id, capacity, active)
+            for station_id in changes["removed_stations"]:
+                self.remove_station(station_id)
+            for bike_id, station_id, on_trip in changes["bikes"]:
+                self.set_bike(bike_id, station_id, on_trip)
+            for bike_id in changes["removed_bikes"]:
+                self.remove_bike(bike_id)
+
+    def reload(self, station_ids=None):
+        """Re-reads stations other workers changed, every station for None.
+
+        Bikes docked at the stations in the database or in the state are
+        re-read too, so bikes that left, arrived or were removed are moved.
+        Runs on the broker's listener thread, with a session of its own.
+        """
+        if not self.loaded:
+            return
+
+        try:
+            if station_ids is None:
+                self.load()
+                return
+
+            with self.lock:
+                bike_ids = set(
+                    np.flatnonzero(
+                        self.bike_exists & np.isin(self.bike_station, list(station_ids))
+                    ).tolist()
+                )
+            docked = db.session.query(Bike.id).filter(
+                Bike.current_station_id.in_(station_ids)
+            )
+            bike_ids.update(bike_id for bike_id, in docked)
+
+            self.apply(fleet_rows(bike_ids, station_ids))
+        finally:
+            db.session.remove()
+
+    ### Consistency ###
+
+    def check(self):
+        """Compares availability with the database, reloads and returns True on drift"""
+        expected = station_availability()
+        self.checked_at = time.monotonic()
+
+        if self.availability() == expected:
+            return False
+
+        self.load()
+        self.reloads += 1
+        return True
+
+    def refresh(self, max_age=FLEET_CHECK_SECONDS):
+        """Loads the state, or checks it for drift when the last check is old"""
+        if not self.loaded:
+            self.load()
+        elif time.monotonic() - self.checked_at >= max_age:
+            self.check()
+
+
+fleet = FleetState()
+broker.watch(fleet.reload)
+
+
+####### WRITE TRACKING #######
+
+
+def fleet_changed(bike_ids=(), station_ids=(), session=None):
+    """Marks rows to re-read into the fleet state when the write commits.
+
+    Flushed model writes are tracked on their own, bulk statements that skip
+    the session report their rows here.
+    """
+    if bike_ids or station_ids:
+        pending = pending_commit(session)
+        pending.setdefault("fleet_bike_ids", set()).update(bike_ids)
+        pending.setdefault("fleet_station_ids", set()).update(station_ids)
+
+
+@event.listens_for(Session, "after_flush")
+def track_fleet_writes(session, flush_context):
+    bike_ids = set()
+    station_ids = set()
+
+    for item in set(session.new) | set(session.dirty) | set(session.deleted):
+        if isinstance(item, Bike):
+            bike_ids.add(item.id)
+        elif isinstance(item, Trip):
+            bike_ids.add(item.bike_id)
+        elif isinstance(item, Station):
+            station_ids.add(item.id)
+
+    fleet_changed(bike_ids, station_ids, session)
+
+
+@event.listens_for(Session, "before_commit")
+def read_fleet_changes(session):
+    # rows are read inside the transaction, so writes rolled back to a
+    # savepoint are not applied
+    if session.in_nested_transaction():
+        return
+
+    if not fleet.loaded:
+        return
+
+    # flushed first so reading the rows cannot flush more writes
+    session.flush()
+    pending = session.info.get("pending_commit", {})
+    bike_ids = set(pending.get("fleet_bike_ids", ()))
+    station_ids = set(pending.get("fleet_station_ids", ()))
+
+    if not (bike_ids or station_ids):
+        return
+
+    pending["fleet"] = fleet_rows(bike_ids, station_ids)
+
+
+@on_commit
+def apply_fleet_changes(pending):
+    if pending.get("fleet"):
+        fleet.apply(pending["fleet"])
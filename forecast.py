@@ -0,0 +1,225 @@
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime as dt, timedelta
+
+import numpy as np
+
+from archive import read_trip_columns
+from models import on_commit, pending_commit
+
+####### Settings ########
+
+FORECAST_PATH = os.getenv("FORECAST_PATH", "forecast_profiles.npz")
+HOURS_PER_WEEK = 7 * 24
+FORECAST_HOURS = 3
+MAX_FORECAST_HOURS = 24
+SMALL_BATCH = 1024
+
+# the epoch (1970-01-01) was a Thursday, hour of week counts from Monday 00:00
+EPOCH_HOUR_OF_WEEK = 3 * 24
+
+PROFILE_COLUMNS = (
+    "origination_station_id",
+    "destination_station_id",
+    "start_time",
+    "end_time",
+)
+ClosedTrip = namedtuple("ClosedTrip", PROFILE_COLUMNS)
+
+
+def hour_of_week(times):
+    """Hour of the week (Monday 00:00 is 0) for an array of datetime64 values"""
+    hours = np.asarray(times, dtype="datetime64[h]").astype(np.int64)
+    return (hours + EPOCH_HOUR_OF_WEEK) % HOURS_PER_WEEK
+
+
+class DemandProfiles:
+    """Per-station, per-hour-of-week departure and arrival counts.
+
+    Counts live in two (stations x 168) uint32 arrays. Dividing a slot by the
+    number of weeks observed gives the expected trips in that hour.
+    """
+
+    def __init__(self):
+        self.station_ids = np.empty(0, dtype=np.int64)
+        self.departures = np.zeros((0, HOURS_PER_WEEK), dtype=np.uint32)
+        self.arrivals = np.zeros((0, HOURS_PER_WEEK), dtype=np.uint32)
+        self.first_seen = None
+        self.last_seen = None
+        self.lock = threading.Lock()
+
+    ####### STATION ROWS #######
+
+    def _add_stations(self, station_ids):
+        new_ids = np.setdiff1d(station_ids, self.station_ids)
+        if len(new_ids) == 0:
+            return
+
+        station_ids = np.concatenate([self.station_ids, new_ids])
+        order = np.argsort(station_ids)
+        padding = np.zeros((len(new_ids), HOURS_PER_WEEK), dtype=np.uint32)
+
+        self.station_ids = station_ids[order]
+        self.departures = np.concatenate([self.departures, padding])[order]
+        self.arrivals = np.concatenate([self.arrivals, padding])[order]
+
+    def _rows(self, station_ids):
+        """Maps station ids to profile rows, adding rows for unseen stations"""
+        unique_ids, inverse = np.unique(
+            np.asarray(station_ids, dtype=np.int64), return_inverse=True
+        )
+        self._add_stations(unique_ids)
+        return np.searchsorted(self.station_ids, unique_ids)[inverse]
+
+    def _count(self, target, rows, times):
+        slots = rows * HOURS_PER_WEEK + hour_of_week(times)
+
+        # a few closing trips are added in place, whole histories are binned
+        if len(slots) < SMALL_BATCH:
+            np.add.at(target.reshape(-1), slots, 1)
+        else:
+            counts = np.bincount(slots, minlength=target.size)
+            target += counts.reshape(target.shape).astype(np.uint32)
+
+    def _extend_span(self, times):
+        if len(times) == 0:
+            return
+        first, last = np.min(times), np.max(times)
+        if self.first_seen is None or first < self.first_seen:
+            self.first_seen = first
+        if self.last_seen is None or last > self.last_seen:
+            self.last_seen = last
+
+    ####### FITTING #######
+
+    def fit(self, columns):
+        """Adds a batch of closed trips given as column arrays"""
+        starts = np.asarray(columns["start_time"], dtype="datetime64[us]")
+        ends = np.asarray(columns["end_time"], dtype="datetime64[us]")
+
+        with self.lock:
+            rows = self._rows(
+                np.concatenate(
+                    [
+                        columns["origination_station_id"],
+                        columns["destination_station_id"],
+                    ]
+                )
+            )
+            self._count(self.departures, rows[: len(starts)], starts)
+            self._count(self.arrivals, rows[len(starts) :], ends)
+            self._extend_span(np.concatenate([starts, ends]))
+
+        return self
+
+    def observe(self, trip):
+        """Adds one trip as it closes"""
+        self.fit(
+            {
+                "origination_station_id": [trip.origination_station_id],
+                "destination_station_id": [trip.destination_station_id],
+                "start_time": [np.datetime64(trip.start_time, "us")],
+                "end_time": [np.datetime64(trip.end_time, "us")],
+            }
+        )
+
+    ####### FORECASTING #######
+
+    def weeks_observed(self):
+        if self.first_seen is None:
+            return 1.0
+        span = (self.last_seen - self.first_seen) / np.timedelta64(7, "D")
+        return max(float(span), 1.0)
+
+    def forecast(self, station_id, start, hours=FORECAST_HOURS):
+        """Expected departures and arrivals for each hour from start"""
+        start = start.replace(minute=0, second=0, microsecond=0)
+        slots = hour_of_week(
+            np.datetime64(start, "h") + np.arange(hours).astype("timedelta64[h]")
+        )
+        weeks = self.weeks_observed()
+
+        with self.lock:
+            row = np.searchsorted(self.station_ids, station_id)
+            known = row < len(self.station_ids) and self.station_ids[row] == station_id
+            departures = self.departures[row, slots] if known else np.zeros(hours)
+            arrivals = self.arrivals[row, slots] if known else np.zeros(hours)
+
+        return [
+            {
+                "hour_start": start + timedelta(hours=offset),
+                "expected_departures": round(float(departures[offset]) / weeks, 3),
+                "expected_arrivals": round(float(arrivals[offset]) / weeks, 3),
+            }
+            for offset in range(hours)
+        ]
+
+    ####### PERSISTENCE #######
+
+    def save(self, path=FORECAST_PATH):
+        with self.lock:
+            np.savez_compressed(
+                path,
+                station_ids=self.station_ids,
+                departures=self.departures,
+                arrivals=self.arrivals,
+                span=np.array(
+                    [self.first_seen, self.last_seen], dtype="datetime64[us]"
+                ),
+            )
+
+    @classmethod
+    def load(cls, path=FORECAST_PATH):
+        profiles = cls()
+        with np.load(path) as data:
+            profiles.station_ids = data["station_ids"]
+            profiles.departures = data["departures"]
+            profiles.arrivals = data["arrivals"]
+            first_seen, last_seen = data["span"]
+
+        if not np.isnat(first_seen):
+            profiles.first_seen, profiles.last_seen = first_seen, last_seen
+        return profiles
+
+
+def fit_profiles(columns=None):
+    """Fits profiles in one batch over trip columns, read from the database by default"""
+    columns = columns or read_trip_columns(PROFILE_COLUMNS)
+    return DemandProfiles().fit(columns)
+
+
+####### APP PROFILES #######
+
+_profiles = None
+_profiles_lock = threading.Lock()
+
+
+def get_profiles():
+    """Returns this process's profiles, loading the saved file or fitting on first use"""
+    global _profiles
+
+    with _profiles_lock:
+        if _profiles is None:
+            if os.path.exists(FORECAST_PATH):
+                _profiles = DemandProfiles.load(FORECAST_PATH)
+            else:
+                _profiles = fit_profiles()
+        return _profiles
+
+
+def observe_trip(trip):
+    """Folds a closed trip into this process's profiles once its write commits.
+
+    Call before committing. The trip is copied, so a batch that rolls back
+    never reaches the profiles.
+    """
+    closed = ClosedTrip(*(getattr(trip, column) for column in PROFILE_COLUMNS))
+    pending_commit().setdefault("closed_trips", []).append(closed)
+
+
+@on_commit
+def observe_closed_trips(pending):
+    if _profiles is not None:
+        for trip in pending.get("closed_trips", ()):
+            _profiles.observe(trip)
@@ -0,0 +1,23 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between coordinates, broadcasting over arrays"""
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(value, dtype=np.float64))
+        for value in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def distance_matrix_km(lat_a, lon_a, lat_b, lon_b):
+    """Matrix of distances from every point in a (rows) to every point in b (columns)"""
+    lat_a = np.asarray(lat_a, dtype=np.float64)
+    lon_a = np.asarray(lon_a, dtype=np.float64)
+    return haversine_km(lat_a[:, None], lon_a[:, None], lat_b, lon_b)
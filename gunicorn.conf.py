@@ -0,0 +1,93 @@
+from gevent import monkey
+
+# patched before the app is preloaded, so the locks, queues and sockets its
+# modules create cooperate with the worker's greenlets
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+
+# psycopg2 waits for the database without blocking the other greenlets
+patch_psycopg()
+
+import multiprocessing
+import os
+
+####### Settings ########
+
+# "io" (default) for the database bound API, "cpu" when workers mostly
+# crunch numbers (forecasts, rebalancing plans) that greenlets cannot
+# overlap, one worker per core
+WORKLOAD = os.getenv("GUNICORN_WORKLOAD", "io")
+CPUS = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# heroku sets WEB_CONCURRENCY from the dyno size, it wins over the CPU count
+# which reports the host's cores rather than the dyno's share
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * CPUS + 1 if WORKLOAD == "io" else CPUS))
+
+# the app reads it to pick cache and stream backends shared by the workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+# an open /stations/stream waits on its subscriber queue for as long as the
+# client listens. gevent workers serve every connection on a greenlet, so
+# idle streams cost memory rather than one of a few request threads and
+# each worker fans out to as many clients as it holds connections
+worker_class = "gevent"
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# imports and route compilation happen once in the master, workers fork
+# with the app already built
+preload_app = True
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers now and then, jittered so they do not restart together
+max_requests = 2000
+max_requests_jitter = 200
+
+# heroku's router terminates TLS and forwards the client address
+forwarded_allow_ips = "*"
+accesslog = "-"
+
+
+####### HOOKS #######
+
+
+def pre_fork(server, worker):
+    # connections opened while preloading belong to the master, a worker
+    # sharing one would interleave its queries with another's
+    from models import db
+    from app import app
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    # fill this worker's caches before it takes traffic instead of on the
+    # first requests after a deploy or scale up
+    import auth
+    from forecast import FORECAST_PATH, get_profiles
+    from models import db
+    from app import app
+    from fleet import fleet
+
+    with app.app_context():
+        try:
+            # opens the first pooled connection and loads the fleet state
+            fleet.load()
+            db.session.remove()
+        except Exception:
+            server.log.exception("worker %s could not reach the database", worker.pid)
+
+        # only a saved file is loaded, fitting is left to the first forecast
+        if os.path.exists(FORECAST_PATH):
+            get_profiles()
+
+    try:
+        auth.key_provider.warm()
+    except Exception:
+        server.log.exception("worker %s could not fetch signing keys", worker.pid)
@@ -0,0 +1,141 @@
+from datetime import datetime as dt, timedelta
+from functools import wraps
+from hashlib import sha256
+
+from flask import Response, abort, current_app, make_response, request
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from werkzeug.exceptions import HTTPException
+
+from models import db, IdempotencyKey
+
+####### Settings ########
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+IDEMPOTENCY_TTL = timedelta(hours=24)
+MAX_KEY_LENGTH = 255
+
+# a claimed key with no stored response after this long is assumed abandoned
+IN_PROGRESS_TIMEOUT = timedelta(seconds=60)
+
+
+def key_scope(payload):
+    """Keys are only shared by the same caller on the same method and path"""
+    return f"{payload.get('sub', '')} {request.method} {request.path}"
+
+
+def replay(record):
+    response = Response(
+        record.response_body, status=record.status_code, mimetype="application/json"
+    )
+    response.headers[REPLAYED_HEADER] = "true"
+    return response
+
+
+def release(key, scope):
+    """Drops a claim so the request can be retried after it failed"""
+    db.session.rollback()
+    IdempotencyKey.query.filter_by(key=key, scope=scope).delete()
+    db.session.commit()
+
+
+@event.listens_for(Session, "after_flush")
+@event.listens_for(Session, "after_commit")
+def mark_written(session, *args):
+    # a request rejected after this point may already have written
+    session.info["written"] = True
+
+
+def purge_expired_keys(now=None):
+    """Deletes keys past their TTL, returns the number removed"""
+    cutoff = (now or dt.now()) - IDEMPOTENCY_TTL
+    removed = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete()
+    db.session.commit()
+    return removed
+
+
+### Create decorator to replay retried create requests in app
+def idempotent(f):
+    """Replays the stored response when a request repeats its Idempotency-Key.
+
+    The first request claims the key before running the handler and stores
+    its response afterwards. Repeats within the TTL get the stored response
+    without running the handler again. A repeat while the first request is
+    still running gets 409, and reusing a key with a different body gets 422.
+    Requests rejected (4xx) before writing anything are stored like any
+    other response. Server errors, and rejections raised once the handler
+    has flushed or committed, release their key so they can be retried.
+    """
+
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER, None)
+
+        # requests without a key run as usual
+        if key is None:
+            return f(payload, *args, **kwargs)
+
+        # return 400 if key is empty or too long
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        scope = key_scope(payload)
+        request_hash = sha256(request.get_data()).hexdigest()
+        now = dt.now()
+        record = IdempotencyKey.query.get((key, scope))
+
+        if record is not None:
+            expired = record.created_at < now - IDEMPOTENCY_TTL
+            abandoned = (
+                record.status_code is None
+                and record.created_at < now - IN_PROGRESS_TIMEOUT
+            )
+
+            if expired or abandoned:
+                db.session.delete(record)
+                db.session.commit()
+            # return 422 if key is reused for a different request
+            elif record.request_hash != request_hash:
+                abort(422)
+            # return 409 if the first request has not finished yet
+            elif record.status_code is None:
+                abort(409)
+            else:
+                return replay(record)
+
+        # claim the key, a concurrent request with the same key gets 409
+        try:
+            db.session.add(IdempotencyKey(key, scope, request_hash, now))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            abort(409)
+
+        db.session.info.pop("written", None)
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except HTTPException as error:
+            # the rejection may hide a write that committed, a retry reruns it
+            written = db.session.info.pop("written", False)
+            if error.code is None or error.code >= 500 or written:
+                release(key, scope)
+                raise
+
+            # a rejected request is rejected again when repeated
+            db.session.rollback()
+            response = make_response(current_app.handle_http_exception(error))
+        except Exception:
+            release(key, scope)
+            raise
+
+        record = IdempotencyKey.query.get((key, scope))
+        record.status_code = response.status_code
+        record.response_body = response.get_data(as_text=True)
+        db.session.commit()
+
+        return response
+
+    return wrapper
@@ -1,8 +1,19 @@
+import os
+from datetime import timedelta
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from auth import LocalAuthority
+from models import db, backfill_rider_summaries as backfill_summaries
+from partitions import create_trip_partitions, archive_trip_partitions
+from archive import ARCHIVE_DIR, TripArchive, export_closed_trips
+from forecast import FORECAST_PATH, PROFILE_COLUMNS, fit_profiles
+from idempotency import purge_expired_keys
+from changes import purge_changes as purge_change_feed
+from profiling import PROFILE_DIR, merge_profiles as merge_route_profiles
+from schemas import ROUTE_SCHEMAS, benchmark
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +21,90 @@ manager = Manager(app)
 manager.add_command("db", MigrateCommand)
 
 
+@manager.command
+def create_partitions(months=3):
+    """Creates monthly trips partitions for the current and coming months"""
+    created = create_trip_partitions(months_ahead=int(months))
+    print(f"created {len(created)} partitions: {', '.join(created)}")
+
+
+@manager.command
+def archive_partitions(keep_months=12):
+    """Detaches trips partitions older than keep_months into the archive schema"""
+    archived, skipped = archive_trip_partitions(keep_months=int(keep_months))
+    print(f"archived {len(archived)} partitions: {', '.join(archived)}")
+    if skipped:
+        print(f"skipped partitions with open trips: {', '.join(skipped)}")
+
+
+@manager.command
+def export_trips(archive_dir=ARCHIVE_DIR):
+    """Appends trips closed since the last export to the columnar archive"""
+    exported = export_closed_trips(archive_dir=archive_dir)
+    print(f"exported {exported} trips to {archive_dir}")
+
+
+@manager.command
+def fit_forecast(path=FORECAST_PATH, archive_dir=None):
+    """Fits station demand profiles from trip history and saves them for the app"""
+    columns = None
+    if archive_dir is not None:
+        columns = TripArchive(archive_dir).read(PROFILE_COLUMNS)
+
+    profiles = fit_profiles(columns)
+    profiles.save(path)
+    print(f"fitted {len(profiles.station_ids)} stations, saved to {path}")
+
+
+@manager.command
+def purge_idempotency_keys():
+    """Deletes idempotency keys older than their TTL"""
+    removed = purge_expired_keys()
+    print(f"purged {removed} idempotency keys")
+
+
+@manager.command
+def purge_changes(keep_days=30):
+    """Deletes change feed entries older than keep_days"""
+    removed = purge_change_feed(retention=timedelta(days=int(keep_days)))
+    print(f"purged {removed} changes")
+
+
+@manager.command
+def backfill_rider_summaries():
+    """Recomputes rider trip counts, minutes ridden and last rides, archived trips included"""
+    updated = backfill_summaries()
+    print(f"backfilled {updated} rider summaries")
+
+
+@manager.command
+def mint_token(permissions="", sub="local|user", expires_in=24 * 60 * 60):
+    """Prints a token from the local signing authority (run the app with AUTH_PROVIDER=local)"""
+    authority = LocalAuthority()
+    names = [name for name in permissions.split(",") if name]
+    print(authority.mint(names, sub=sub, expires_in=int(expires_in)))
+
+
+@manager.command
+def merge_profiles(profile_dir=PROFILE_DIR, output_dir=None, top=10):
+    """Merges saved request profiles by route and prints each route's hottest calls"""
+    output_dir = output_dir or profile_dir.rstrip("/") + "_merged"
+    os.makedirs(output_dir, exist_ok=True)
+
+    for route, (stats, count) in merge_route_profiles(profile_dir).items():
+        path = os.path.join(output_dir, f"{route}.prof")
+        stats.dump_stats(path)
+        print(f"{route}: {count} profiles merged into {path}")
+        stats.sort_stats("cumulative").print_stats(int(top))
+
+
+@manager.command
+def bench_validation(iterations=10000):
+    """Times decoding a representative request body for every route with a schema"""
+    for route, (schema, body) in ROUTE_SCHEMAS.items():
+        micros = benchmark(schema, body, iterations=int(iterations))
+        print(f"{route}: {micros:.2f} us per body")
+
+
 if __name__ == "__main__":
     manager.run()
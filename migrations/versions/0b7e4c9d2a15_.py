@@ -0,0 +1,29 @@
+"""change_feed_seq for change feed positions
+
+Revision ID: 0b7e4c9d2a15
+Revises: 9d3e6b1f4a82
+Create Date: 2026-10-19 21:04:11.208344
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b7e4c9d2a15'
+down_revision = '9d3e6b1f4a82'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # feed positions continue after the highest one already handed out
+    op.execute("CREATE SEQUENCE change_feed_seq")
+    op.execute("""
+        SELECT setval('change_feed_seq', coalesce(max(seq), 0) + 1, false)
+        FROM changes
+    """)
+
+
+def downgrade():
+    op.execute("DROP SEQUENCE change_feed_seq")
@@ -0,0 +1,24 @@
+"""index rider trip history
+
+Revision ID: 3c9a4f1e2b7d
+Revises: 68987b587c38
+Create Date: 2026-10-19 09:12:41.301842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a4f1e2b7d'
+down_revision = '68987b587c38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_trips_rider_id_start_time', 'trips', ['rider_id', 'start_time', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_trips_rider_id_start_time', table_name='trips')
@@ -0,0 +1,30 @@
+"""index filter columns of bikes and trips
+
+Revision ID: 5e8b2d6a1c03
+Revises: a41d7c0e9f52
+Create Date: 2026-10-19 11:26:05.918274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b2d6a1c03'
+down_revision = 'a41d7c0e9f52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_bikes_current_station_id'), 'bikes', ['current_station_id'], unique=False)
+    op.create_index(op.f('ix_trips_bike_id'), 'trips', ['bike_id'], unique=False)
+    op.create_index(op.f('ix_trips_destination_station_id'), 'trips', ['destination_station_id'], unique=False)
+    op.create_index('ix_trips_origination_station_id_start_time', 'trips', ['origination_station_id', 'start_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_trips_origination_station_id_start_time', table_name='trips')
+    op.drop_index(op.f('ix_trips_destination_station_id'), table_name='trips')
+    op.drop_index(op.f('ix_trips_bike_id'), table_name='trips')
+    op.drop_index(op.f('ix_bikes_current_station_id'), table_name='bikes')
@@ -0,0 +1,82 @@
+"""partition trips by start_time month
+
+Revision ID: a41d7c0e9f52
+Revises: 3c9a4f1e2b7d
+Create Date: 2026-10-19 10:03:17.559120
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41d7c0e9f52'
+down_revision = '3c9a4f1e2b7d'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _create_trips_table(name, partitioned):
+    op.execute(f"""
+        CREATE TABLE {name} (
+            id INTEGER NOT NULL DEFAULT nextval('trips_id_seq'),
+            origination_station_id INTEGER NOT NULL REFERENCES stations (id),
+            destination_station_id INTEGER REFERENCES stations (id),
+            bike_id INTEGER NOT NULL REFERENCES bikes (id),
+            rider_id INTEGER NOT NULL REFERENCES riders (id),
+            start_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            end_time TIMESTAMP WITHOUT TIME ZONE,
+            {'PRIMARY KEY (id, start_time)' if partitioned else 'PRIMARY KEY (id)'}
+        ) {'PARTITION BY RANGE (start_time)' if partitioned else ''}
+    """)
+
+
+def _swap_trips_table(name, partitioned):
+    # move rows across, keep the id sequence and restore the usual names
+    op.execute(f"INSERT INTO {name} SELECT * FROM trips")
+    op.execute("ALTER SEQUENCE trips_id_seq OWNED BY NONE")
+    op.execute("DROP TABLE trips")
+    op.execute(f"ALTER TABLE {name} RENAME TO trips")
+    op.execute("ALTER SEQUENCE trips_id_seq OWNED BY trips.id")
+    op.execute(f"ALTER TABLE trips RENAME CONSTRAINT {name}_pkey TO trips_pkey")
+    for column in ('origination_station_id', 'destination_station_id', 'bike_id', 'rider_id'):
+        op.execute(f"ALTER TABLE trips RENAME CONSTRAINT {name}_{column}_fkey TO trips_{column}_fkey")
+    op.create_index('ix_trips_rider_id_start_time', 'trips', ['rider_id', 'start_time', 'id'], unique=False)
+    if partitioned:
+        op.create_index('ix_trips_open_bike_id', 'trips', ['bike_id'], unique=False, postgresql_where=sa.text('end_time IS NULL'))
+
+
+def upgrade():
+    _create_trips_table('trips_partitioned', partitioned=True)
+
+    # one partition per month from the first trip to a few months ahead
+    first_trip = op.get_bind().execute(sa.text("SELECT min(start_time) FROM trips")).scalar()
+    now = datetime.now()
+    month = datetime((first_trip or now).year, (first_trip or now).month, 1)
+    last = _add_months(datetime(now.year, now.month, 1), MONTHS_AHEAD)
+
+    while month <= last:
+        following = _add_months(month, 1)
+        op.execute(
+            f"CREATE TABLE trips_y{month.year}m{month.month:02d} PARTITION OF trips_partitioned "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        )
+        month = following
+
+    op.execute("CREATE TABLE trips_default PARTITION OF trips_partitioned DEFAULT")
+
+    _swap_trips_table('trips_partitioned', partitioned=True)
+
+
+def downgrade():
+    _create_trips_table('trips_unpartitioned', partitioned=False)
+    _swap_trips_table('trips_unpartitioned', partitioned=False)
@@ -0,0 +1,35 @@
+"""trigram and prefix search indexes on riders and stations
+
+Revision ID: c7f3e91a4d26
+Revises: 5e8b2d6a1c03
+Create Date: 2026-10-19 12:48:52.104377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7f3e91a4d26'
+down_revision = '5e8b2d6a1c03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_riders_name_trgm', 'riders', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_riders_email_trgm', 'riders', ['email'], unique=False, postgresql_using='gin', postgresql_ops={'email': 'gin_trgm_ops'})
+    op.create_index('ix_riders_name_prefix', 'riders', [sa.text('lower(name) text_pattern_ops')], unique=False)
+    op.create_index('ix_riders_email_prefix', 'riders', [sa.text('lower(email) text_pattern_ops')], unique=False)
+    op.create_index('ix_stations_name_trgm', 'stations', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_stations_name_prefix', 'stations', [sa.text('lower(name) text_pattern_ops')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_stations_name_prefix', table_name='stations')
+    op.drop_index('ix_stations_name_trgm', table_name='stations')
+    op.drop_index('ix_riders_email_prefix', table_name='riders')
+    op.drop_index('ix_riders_name_prefix', table_name='riders')
+    op.drop_index('ix_riders_email_trgm', table_name='riders')
+    op.drop_index('ix_riders_name_trgm', table_name='riders')
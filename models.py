@@ -1,5 +1,8 @@
 import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from sqlalchemy import (
+    BigInteger,
     Column,
     String,
     Integer,
@@ -7,11 +10,20 @@ from sqlalchemy import (
     ForeignKey,
     Float,
     DateTime,
+    Text,
+    func,
     null,
+    select,
+    text,
 )
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import Session, attributes
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 
+from tracing import traced
+
 ### DB URI to run locally
 # DATABASE_NAME = os.getenv("DB_NAME", "bike_system")
 # DATABASE_USER = os.getenv("DB_USER", "postgres")
@@ -40,22 +52,152 @@ def setup_db(app, databasepath=DATABASE_PATH):
     migrate = Migrate(app, db)
 
 
+# Transactions
+
+
+# called with the pending state of each committed transaction
+commit_listeners = []
+
+
+def on_commit(listener):
+    """Registers a listener for what committed transactions wrote"""
+    commit_listeners.append(listener)
+    return listener
+
+
+def pending_commit(session=None):
+    """State collected for commit listeners during the current transaction.
+
+    Holds the "tables" written by the models and whatever else other modules
+    record. It is handed to listeners on commit and dropped on rollback.
+    """
+    return (session or db.session).info.setdefault("pending_commit", {})
+
+
+@event.listens_for(Session, "after_commit")
+def notify_commit_listeners(session):
+    # a released savepoint is still part of the outer transaction
+    if session.in_nested_transaction():
+        return
+
+    pending = session.info.pop("pending_commit", None)
+
+    if pending:
+        for listener in commit_listeners:
+            listener(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def drop_pending_commit(session):
+    if not session.in_nested_transaction():
+        session.info.pop("pending_commit", None)
+
+
+def referencing_tables(table):
+    """Tables with foreign keys to table, deleting its rows may change theirs"""
+    return {
+        other.name
+        for other in db.Model.metadata.tables.values()
+        if any(key.column.table is table for key in other.foreign_keys)
+    }
+
+
+@event.listens_for(Session, "after_flush")
+def track_written_tables(session, flush_context):
+    # rows written by ORM cascades are flushed alongside the item committed,
+    # rows the database cascades to or sets NULL on deletes are not seen
+    # by the session, so every table referencing a deleted row counts
+    tables = pending_commit(session).setdefault("tables", set())
+
+    for item in set(session.new) | set(session.dirty) | set(session.deleted):
+        tables.add(item.__table__.name)
+    for item in session.deleted:
+        tables.update(referencing_tables(item.__table__))
+
+
+def commit(item):
+    """Commits the session, or only flushes it inside a batch transaction.
+
+    The item's table is recorded so commit listeners hear about the write
+    once the transaction it belongs to commits.
+    """
+    pending_commit().setdefault("tables", set()).add(item.__tablename__)
+
+    if db.session.info.get("batch"):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+@contextmanager
+def batch_transaction():
+    """Defers model commits so several operations share one transaction.
+
+    The caller commits or rolls back the session once the batch is done.
+    """
+    db.session.info["batch"] = True
+    try:
+        yield db.session
+    finally:
+        db.session.info.pop("batch", None)
+
+
+# Serialization
+
+
+def selected(fields, name):
+    """True if a format() key was requested, fields of None means all keys"""
+    return fields is None or name in fields
+
+
+def column_values(item, columns, fields):
+    """Formats the requested columns, leaving unloaded ones untouched"""
+    return {name: getattr(item, name) for name in columns if selected(fields, name)}
+
+
 # Bikes
 
 
 class Bike(db.Model):
     __tablename__ = "bikes"
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True)
     model = Column(String, nullable=False)
     manufactured_at = Column(DateTime, nullable=False)
     electric = Column(Boolean, nullable=False)
     needs_maintenance = Column(Boolean, default=False)
-    current_station_id = Column(Integer, ForeignKey("stations.id"))
+    current_station_id = Column(Integer, ForeignKey("stations.id"), index=True)
+    # maintained on every write, ?updated_since= reads updated_at
+    created_at = Column(
+        DateTime,
+        nullable=False,
+        default=func.now(),
+        server_default=func.now(),
+        index=True,
+    )
+    updated_at = Column(
+        DateTime,
+        nullable=False,
+        default=func.now(),
+        onupdate=func.now(),
+        server_default=func.now(),
+        index=True,
+    )
     trips = db.relationship(
         "Trip", backref="bikes", lazy="joined", cascade="save-update"
     )
 
+    # keys of format(), derived keys list the attributes they load
+    FORMAT_COLUMNS = (
+        "id",
+        "model",
+        "electric",
+        "needs_maintenance",
+        "current_station_id",
+    )
+    DERIVED_FIELDS = {"num_trips": ("trips",)}
+
     def __init__(self, model, electric, manufactured_at, current_station_id):
         self.model = model
         self.electric = electric
@@ -64,28 +206,38 @@ class Bike(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self)
 
     def update(self):
-        db.session.commit()
+        commit(self)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit(self)
 
-    def format(self):
-        return {
-            "id": self.id,
-            "model": self.model,
-            "electric": self.electric,
-            "needs_maintenance": self.needs_maintenance,
-            "current_station_id": self.current_station_id,
-            "num_trips": len(self.trips),
-        }
+    @traced
+    def format(self, fields=None):
+        formatted = column_values(self, self.FORMAT_COLUMNS, fields)
+
+        if selected(fields, "num_trips"):
+            formatted["num_trips"] = len(self.trips)
+
+        return formatted
 
 
 class Station(db.Model):
     __tablename__ = "stations"
+    __mapper_args__ = {"eager_defaults": True}
+    __table_args__ = (
+        # trigram and lowercase prefix indexes behind /stations/search
+        db.Index(
+            "ix_stations_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ),
+        db.Index("ix_stations_name_prefix", text("lower(name) text_pattern_ops")),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
@@ -93,10 +245,28 @@ class Station(db.Model):
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     active = Column(Boolean, default=True)
+    created_at = Column(
+        DateTime,
+        nullable=False,
+        default=func.now(),
+        server_default=func.now(),
+        index=True,
+    )
+    updated_at = Column(
+        DateTime,
+        nullable=False,
+        default=func.now(),
+        onupdate=func.now(),
+        server_default=func.now(),
+        index=True,
+    )
     bikes = db.relationship(
         "Bike", backref="stations", lazy="joined", cascade="save-update"
     )
 
+    FORMAT_COLUMNS = ("id", "name", "capacity", "latitude", "longitude")
+    DERIVED_FIELDS = {"num_bikes": ("bikes",)}
+
     def __init__(self, name, capacity, latitude, longitude):
         self.name = name
         self.capacity = capacity
@@ -105,38 +275,81 @@ class Station(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self)
 
     def update(self):
-        db.session.commit()
+        commit(self)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit(self)
 
-    def format(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "capacity": self.capacity,
-            "latitude": self.latitude,
-            "longitude": self.longitude,
-            "num_bikes": len(self.bikes),
-        }
+    @traced
+    def format(self, fields=None):
+        formatted = column_values(self, self.FORMAT_COLUMNS, fields)
+
+        if selected(fields, "num_bikes"):
+            formatted["num_bikes"] = len(self.bikes)
+
+        return formatted
 
 
 class Rider(db.Model):
     __tablename__ = "riders"
+    __mapper_args__ = {"eager_defaults": True}
+    __table_args__ = (
+        # trigram and lowercase prefix indexes behind /riders/search
+        db.Index(
+            "ix_riders_name_trgm",
+            "name",
+            postgresql_using="gin",
+            postgresql_ops={"name": "gin_trgm_ops"},
+        ),
+        db.Index(
+            "ix_riders_email_trgm",
+            "email",
+            postgresql_using="gin",
+            postgresql_ops={"email": "gin_trgm_ops"},
+        ),
+        db.Index("ix_riders_name_prefix", text("lower(name) text_pattern_ops")),
+        db.Index("ix_riders_email_prefix", text("lower(email) text_pattern_ops")),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     email = Column(String, nullable=False)
     address = Column(String, nullable=False)
     membership = Column(Boolean, nullable=False)
+    created_at = Column(
+        DateTime,
+        nullable=False,
+        default=func.now(),
+        server_default=func.now(),
+        index=True,
+    )
+    updated_at = Column(
+        DateTime,
+        nullable=False,
+        default=func.now(),
+        onupdate=func.now(),
+        server_default=func.now(),
+        index=True,
+    )
     trips = db.relationship(
-        "Trip", backref="riders", lazy="joined", cascade="all, delete"
+        "Trip", backref="riders", lazy="select", cascade="all, delete"
+    )
+    # written by update_rider_summaries, never through the relationship
+    summary = db.relationship(
+        "RiderSummary", uselist=False, lazy="joined", viewonly=True
     )
 
+    FORMAT_COLUMNS = ("id", "name", "email", "address", "membership")
+    DERIVED_FIELDS = {
+        "num_trips": ("summary",),
+        "minutes_ridden": ("summary",),
+        "last_ride_at": ("summary",),
+    }
+
     def __init__(self, name, email, address, membership):
         self.name = name
         self.email = email
@@ -145,37 +358,143 @@ class Rider(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self)
 
     def update(self):
-        db.session.commit()
+        commit(self)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit(self)
 
-    def format(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "email": self.email,
-            "address": self.address,
-            "membership": self.membership,
-            "num_trips": len(self.trips),
-        }
+    @traced
+    def format(self, fields=None):
+        formatted = column_values(self, self.FORMAT_COLUMNS, fields)
+
+        # riders without trips have no summary yet
+        summary = self.summary
+
+        if selected(fields, "num_trips"):
+            formatted["num_trips"] = summary.num_trips if summary else 0
+
+        if selected(fields, "minutes_ridden"):
+            formatted["minutes_ridden"] = (
+                round(summary.seconds_ridden / 60, 1) if summary else 0
+            )
+
+        if selected(fields, "last_ride_at"):
+            formatted["last_ride_at"] = summary.last_ride_at if summary else None
+
+        return formatted
+
+
+class RiderSummary(db.Model):
+    """Running totals of a rider's trips.
+
+    Lifetime totals, trips archived out of the trips table still count.
+    """
+
+    __tablename__ = "rider_summaries"
+
+    rider_id = Column(
+        Integer, ForeignKey("riders.id", ondelete="CASCADE"), primary_key=True
+    )
+    num_trips = Column(Integer, nullable=False, default=0, server_default="0")
+    # whole seconds of closed trips
+    seconds_ridden = Column(BigInteger, nullable=False, default=0, server_default="0")
+    # start of the rider's latest trip
+    last_ride_at = Column(DateTime)
+
+
+# every rider is upserted, riders left without trips go back to zero
+BACKFILL_RIDER_SUMMARIES = """
+WITH all_trips AS ({trips}),
+totals AS (
+    SELECT rider_id,
+           count(*) AS num_trips,
+           sum(floor(extract(epoch FROM end_time - start_time))) AS seconds_ridden,
+           max(start_time) AS last_ride_at
+    FROM all_trips
+    GROUP BY rider_id
+)
+INSERT INTO rider_summaries (rider_id, num_trips, seconds_ridden, last_ride_at)
+SELECT riders.id,
+       coalesce(totals.num_trips, 0),
+       coalesce(totals.seconds_ridden, 0),
+       totals.last_ride_at
+FROM riders
+LEFT JOIN totals ON totals.rider_id = riders.id
+ON CONFLICT (rider_id) DO UPDATE SET
+    num_trips = excluded.num_trips,
+    seconds_ridden = excluded.seconds_ridden,
+    last_ride_at = excluded.last_ride_at
+"""
+
+
+def backfill_rider_summaries():
+    """Recomputes every rider's summary from the trips table and the archived partitions"""
+    # partitions imports the models
+    from partitions import list_archived_partitions
+
+    tables = ["trips"] + list_archived_partitions()
+    trips = " UNION ALL ".join(
+        f"SELECT rider_id, start_time, end_time FROM {table}" for table in tables
+    )
+
+    result = db.session.execute(text(BACKFILL_RIDER_SUMMARIES.format(trips=trips)))
+    db.session.commit()
+    return result.rowcount
+
+
+# Trips are range partitioned by start_time month (see partitions.py)
+
+# trips are first looked up among those started this recently, a start_time
+# bound the planner prunes the older monthly partitions with
+RECENT_TRIP_WINDOW = timedelta(days=2)
 
 
 class Trip(db.Model):
     __tablename__ = "trips"
+    __table_args__ = (
+        # serves rider trip history newest first without sorting
+        db.Index("ix_trips_rider_id_start_time", "rider_id", "start_time", "id"),
+        # trips leaving a station over a time range
+        db.Index(
+            "ix_trips_origination_station_id_start_time",
+            "origination_station_id",
+            "start_time",
+        ),
+        # only open trips are indexed so the bike availability check stays small
+        db.Index(
+            "ix_trips_open_bike_id",
+            "bike_id",
+            postgresql_where=text("end_time IS NULL"),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     origination_station_id = Column(Integer, ForeignKey("stations.id"), nullable=False)
-    destination_station_id = Column(Integer, ForeignKey("stations.id"))
-    bike_id = Column(Integer, ForeignKey("bikes.id"), nullable=False)
+    destination_station_id = Column(Integer, ForeignKey("stations.id"), index=True)
+    bike_id = Column(Integer, ForeignKey("bikes.id"), nullable=False, index=True)
     rider_id = Column(Integer, ForeignKey("riders.id"), nullable=False)
     start_time = Column(DateTime, nullable=False)
     end_time = Column(DateTime)
 
+    FORMAT_COLUMNS = (
+        "id",
+        "rider_id",
+        "origination_station_id",
+        "destination_station_id",
+        "bike_id",
+        "start_time",
+        "end_time",
+    )
+    DERIVED_FIELDS = {
+        "rider": ("rider_id",),
+        "origination_station": ("origination_station_id",),
+        "destination_station": ("destination_station_id",),
+    }
+
     def __init__(
         self,
         rider_id,
@@ -190,47 +509,264 @@ class Trip(db.Model):
         self.destination_station_id = None
         self.end_time = None
 
+    @classmethod
+    def find(cls, trip_id):
+        """Trip by id, looked up in recent partitions before all of them"""
+        cutoff = datetime.now() - RECENT_TRIP_WINDOW
+        trip = cls.query.filter(cls.id == trip_id, cls.start_time >= cutoff).first()
+        return trip if trip is not None else cls.query.get(trip_id)
+
+    @classmethod
+    def open_trip_of(cls, bike_id):
+        """The bike's open trip, None if it is docked.
+
+        A trip only starts once the bike's previous one ended, so an open
+        trip is always the bike's latest. That is looked up in recent partitions, and in all
+        of them only for bikes without a recent trip.
+        """
+        cutoff = datetime.now() - RECENT_TRIP_WINDOW
+        latest = cls.query.filter(cls.bike_id == bike_id).order_by(
+            cls.start_time.desc(), cls.id.desc()
+        )
+        trip = latest.filter(cls.start_time >= cutoff).first() or latest.first()
+        return trip if trip is not None and trip.end_time is None else None
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit(self)
 
     def update(self):
-        db.session.commit()
+        commit(self)
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit(self)
+
+    @traced
+    def format(self, fields=None):
+        formatted = column_values(self, self.FORMAT_COLUMNS, fields)
+
+        if selected(fields, "rider"):
+            formatted["rider"] = Rider.query.get(self.rider_id).name
+
+        if selected(fields, "origination_station"):
+            orgi_station = Station.query.get(self.origination_station_id)
+            formatted["origination_station"] = orgi_station.name
+
+        # destination is empty if trip has not ended
+        if selected(fields, "destination_station"):
+            if self.destination_station_id is not None:
+                dest_station = Station.query.get(self.destination_station_id)
+                formatted["destination_station"] = dest_station.name
+            else:
+                formatted["destination_station"] = None
+
+        return formatted
+
+
+# Idempotency keys
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    # caller, method and path the key was used for
+    scope = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    # status and body stay empty while the first request is still running
+    status_code = Column(Integer)
+    response_body = Column(Text)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, key, scope, request_hash, created_at):
+        self.key = key
+        self.scope = scope
+        self.request_hash = request_hash
+        self.created_at = created_at
+
+
+# Change feed outbox
+
+# tables whose writes are appended to the outbox
+OUTBOX_TABLES = ("bikes", "stations", "riders", "trips")
+
+
+class Change(db.Model):
+    __tablename__ = "changes"
+    __table_args__ = (
+        # deleted rows reported to ?updated_since= delta syncs
+        db.Index(
+            "ix_changes_table_name_op_changed_at", "table_name", "op", "changed_at"
+        ),
+        # changes still waiting for a feed position, in the order they get one
+        db.Index(
+            "ix_changes_unsequenced",
+            "txid",
+            "id",
+            postgresql_where=text("seq IS NULL"),
+        ),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    # feed position, assigned once no running transaction can precede it
+    seq = Column(BigInteger, unique=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    data = Column(JSONB)
+    txid = Column(BigInteger, nullable=False, server_default=text("txid_current()"))
+    changed_at = Column(DateTime, nullable=False, server_default=func.now())
 
     def format(self):
-        rider = Rider.query.get(self.rider_id)
-        orgi_station = Station.query.get(self.origination_station_id)
-
-        # return if trip has ended
-        if self.destination_station_id is not None:
-            dest_station = Station.query.get(self.destination_station_id)
-            return {
-                "id": self.id,
-                "rider_id": self.rider_id,
-                "rider": rider.name,
-                "origination_station_id": self.origination_station_id,
-                "origination_station": orgi_station.name,
-                "destination_station_id": self.destination_station_id,
-                "destination_station": dest_station.name,
-                "bike_id": self.bike_id,
-                "start_time": self.start_time,
-                "end_time": self.end_time,
-            }
-        # return if not ended
-        else:
-            return {
-                "id": self.id,
-                "rider_id": self.rider_id,
-                "rider": rider.name,
-                "origination_station_id": self.origination_station_id,
-                "origination_station": orgi_station.name,
-                "destination_station_id": self.destination_station_id,
-                "destination_station": None,
-                "bike_id": self.bike_id,
-                "start_time": self.start_time,
-                "end_time": self.end_time,
-            }
+        return {
+            "seq": self.seq,
+            "table": self.table_name,
+            "row_id": self.row_id,
+            "op": self.op,
+            "data": self.data,
+            "changed_at": self.changed_at,
+        }
+
+
+def json_values(values):
+    """Column values in JSON friendly types"""
+    return {
+        name: value.isoformat() if isinstance(value, datetime) else value
+        for name, value in values.items()
+    }
+
+
+def row_data(item):
+    """Column values of a row in JSON friendly types"""
+    return json_values(
+        {column.name: getattr(item, column.name) for column in item.__table__.columns}
+    )
+
+
+def append_changes(session, rows):
+    """Appends change rows to the outbox within the session's transaction"""
+    if rows:
+        session.connection().execute(Change.__table__.insert(), rows)
+
+
+@event.listens_for(Session, "after_flush")
+def write_outbox(session, flush_context):
+    """Appends every flushed write of an outbox table to the changes table.
+
+    Runs inside the flush, so the change commits or rolls back with the
+    write itself, including rows deleted by cascades.
+    """
+    rows = []
+
+    for op, items in (
+        ("insert", session.new),
+        ("update", session.dirty),
+        ("delete", session.deleted),
+    ):
+        for item in items:
+            if getattr(item, "__tablename__", None) not in OUTBOX_TABLES:
+                continue
+            # skip objects that were only touched without changing a column
+            if op == "update" and not session.is_modified(
+                item, include_collections=False
+            ):
+                continue
+
+            rows.append(
+                {
+                    "table_name": item.__tablename__,
+                    "row_id": item.id,
+                    "op": op,
+                    "data": row_data(item),
+                }
+            )
+
+    append_changes(session, rows)
+
+
+def ride_seconds(trip):
+    return int((trip.end_time - trip.start_time).total_seconds())
+
+
+@event.listens_for(Session, "after_flush")
+def update_rider_summaries(session, flush_context):
+    """Adds flushed trip starts, ends and deletions to the rider summaries.
+
+    Runs inside the flush like write_outbox, so summaries change in the same
+    transaction as the trips they count.
+    """
+    totals = {}
+    removed = {}
+
+    for item in session.new:
+        if isinstance(item, Trip):
+            total = totals.setdefault(item.rider_id, [0, 0, None])
+            total[0] += 1
+            total[1] += ride_seconds(item) if item.end_time is not None else 0
+            if total[2] is None or item.start_time > total[2]:
+                total[2] = item.start_time
+
+    for item in session.dirty:
+        if not isinstance(item, Trip) or item in session.new:
+            continue
+        # only a trip being ended adds to the time ridden
+        ended = attributes.get_history(item, "end_time")
+        if ended.added and ended.added[0] is not None and not any(ended.deleted):
+            totals.setdefault(item.rider_id, [0, 0, None])[1] += ride_seconds(item)
+
+    for item in session.deleted:
+        if isinstance(item, Trip):
+            total = removed.setdefault(item.rider_id, [0, 0])
+            total[0] += 1
+            total[1] += ride_seconds(item) if item.end_time is not None else 0
+
+    table = RiderSummary.__table__
+    connection = session.connection()
+
+    if totals:
+        statement = insert(table)
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[table.c.rider_id],
+                set_={
+                    "num_trips": table.c.num_trips + statement.excluded.num_trips,
+                    "seconds_ridden": table.c.seconds_ridden
+                    + statement.excluded.seconds_ridden,
+                    # greatest() skips nulls
+                    "last_ride_at": func.greatest(
+                        table.c.last_ride_at, statement.excluded.last_ride_at
+                    ),
+                },
+            ),
+            [
+                {
+                    "rider_id": rider_id,
+                    "num_trips": num_trips,
+                    "seconds_ridden": seconds,
+                    "last_ride_at": last_ride_at,
+                }
+                for rider_id, (num_trips, seconds, last_ride_at) in totals.items()
+            ],
+        )
+
+    # updated rather than upserted, the rider may be deleted in the same flush.
+    # The last ride is read back from the trips left, archived months are
+    # older than any of them. A rider left with only archived trips has no
+    # last ride until the next backfill
+    trips = Trip.__table__
+    for rider_id, (num_trips, seconds) in removed.items():
+        last_ride_at = (
+            select(func.max(trips.c.start_time))
+            .where(trips.c.rider_id == rider_id)
+            .scalar_subquery()
+        )
+        connection.execute(
+            table.update()
+            .where(table.c.rider_id == rider_id)
+            .values(
+                num_trips=table.c.num_trips - num_trips,
+                seconds_ridden=table.c.seconds_ridden - seconds,
+                last_ride_at=last_ride_at,
+            )
+        )
@@ -0,0 +1,172 @@
+from datetime import datetime as dt
+
+from sqlalchemy import text
+from models import db
+
+####### Settings ########
+
+PARENT_TABLE = "trips"
+DEFAULT_PARTITION = "trips_default"
+ARCHIVE_SCHEMA = "archive"
+
+
+####### MONTH HELPERS #######
+
+
+def month_start(value):
+    """Returns midnight on the first day of the month of value"""
+    return dt(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    """Shifts a month start forwards (or backwards) by a number of months"""
+    index = month.year * 12 + month.month - 1 + months
+    return dt(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARENT_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def partition_month(name):
+    """Parses the month back out of a partition name, None if not a month partition"""
+    try:
+        return dt.strptime(name[len(PARENT_TABLE) + 1 :], "y%Ym%m")
+    except ValueError:
+        return None
+
+
+####### PARTITION MANAGEMENT #######
+
+
+def list_trip_partitions():
+    """Returns names of partitions currently attached to the trips table"""
+    rows = db.session.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :parent ORDER BY child.relname"
+        ),
+        {"parent": PARENT_TABLE},
+    )
+    return [row[0] for row in rows]
+
+
+def list_archived_partitions():
+    """Returns schema qualified names of trips partitions moved to the archive"""
+    rows = db.session.execute(
+        text(
+            "SELECT tablename FROM pg_tables "
+            "WHERE schemaname = :schema AND tablename LIKE :pattern "
+            "ORDER BY tablename"
+        ),
+        {"schema": ARCHIVE_SCHEMA, "pattern": f"{PARENT_TABLE}_y%"},
+    )
+    return [f"{ARCHIVE_SCHEMA}.{row[0]}" for row in rows]
+
+
+def create_trip_partition(month):
+    """Creates and attaches the partition for one month.
+
+    Rows that already landed in the default partition for that month are
+    moved into the new partition before it is attached.
+    """
+    name = partition_name(month)
+    bounds = {"start": month, "end": add_months(month, 1)}
+
+    db.session.execute(
+        text(
+            f"CREATE TABLE {name} "
+            f"(LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+    )
+    db.session.execute(
+        text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            "WHERE start_time >= :start AND start_time < :end RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ),
+        bounds,
+    )
+    db.session.execute(
+        text(
+            f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{bounds['start']:%Y-%m-%d}') "
+            f"TO ('{bounds['end']:%Y-%m-%d}')"
+        )
+    )
+    return name
+
+
+def create_trip_partitions(months_ahead=3, now=None):
+    """Makes sure partitions exist from the current month to months_ahead"""
+    current = month_start(now or dt.now())
+    existing = set(list_trip_partitions())
+    created = []
+
+    try:
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if partition_name(month) not in existing:
+                created.append(create_trip_partition(month))
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    return created
+
+
+def archive_trip_partitions(keep_months=12, now=None):
+    """Detaches closed monthly partitions and moves them to the archive schema.
+
+    A partition is only archived when it is older than keep_months and none
+    of its trips are still open. Archived tables lose their foreign keys so
+    riders, bikes and stations can still be deleted later on.
+    """
+    cutoff = add_months(month_start(now or dt.now()), -keep_months)
+    archived = []
+    skipped = []
+
+    db.session.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+    db.session.commit()
+
+    for name in list_trip_partitions():
+        month = partition_month(name)
+
+        if month is None or month >= cutoff:
+            continue
+
+        open_trips = db.session.execute(
+            text(f"SELECT EXISTS (SELECT 1 FROM {name} WHERE end_time IS NULL)")
+        ).scalar()
+
+        # never archive a month that still has a bike out on a trip
+        if open_trips:
+            skipped.append(name)
+            continue
+
+        try:
+            db.session.execute(
+                text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}")
+            )
+            foreign_keys = db.session.execute(
+                text(
+                    "SELECT conname FROM pg_constraint "
+                    "WHERE conrelid = CAST(:name AS regclass) AND contype = 'f'"
+                ),
+                {"name": name},
+            )
+            for (constraint,) in foreign_keys.fetchall():
+                db.session.execute(
+                    text(f"ALTER TABLE {name} DROP CONSTRAINT {constraint}")
+                )
+            db.session.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+            db.session.commit()
+            archived.append(name)
+        except:
+            db.session.rollback()
+            raise
+
+    return archived, skipped
@@ -0,0 +1,119 @@
+import cProfile
+import os
+import pstats
+import random
+import re
+import time
+from collections import defaultdict
+
+from flask import g, request
+
+from auth import AuthError, get_token_auth_header, verified_payload
+
+####### Settings ########
+
+# fraction of requests profiled, 0 (default) turns sampling off
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# profiles a single request when its token carries PROFILE_PERMISSION
+PROFILE_HEADER = "X-Profile"
+PROFILE_PERMISSION = "get:admin"
+
+
+def route_name(method, rule):
+    """File safe name of a route, e.g. GET_stations_station_id_bikes"""
+    rule = re.sub(r"<(?:[^:>]+:)?([^>]+)>", r"\1", rule)
+    return "_".join([method] + re.findall(r"\w+", rule))
+
+
+def profile_requested():
+    """Whether the caller asked for a profile and is allowed one"""
+    if PROFILE_HEADER not in request.headers:
+        return False
+
+    try:
+        payload = verified_payload(get_token_auth_header())
+    except AuthError:
+        # the route reports bad tokens, the header is just ignored
+        return False
+
+    return PROFILE_PERMISSION in payload.get("permissions", [])
+
+
+def dump_profile(profiler, route, profile_dir=PROFILE_DIR):
+    """Writes a request's profile under its route's directory, returns the path"""
+    directory = os.path.join(profile_dir, route)
+    os.makedirs(directory, exist_ok=True)
+
+    path = os.path.join(
+        directory,
+        f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{os.urandom(4).hex()}.prof",
+    )
+    profiler.dump_stats(path)
+    return path
+
+
+def merge_profiles(profile_dir=PROFILE_DIR):
+    """Merges the saved profiles of each route, returns {route: (pstats.Stats, count)}"""
+    files = defaultdict(list)
+    for route in sorted(os.listdir(profile_dir)):
+        directory = os.path.join(profile_dir, route)
+        if os.path.isdir(directory):
+            files[route] = [
+                os.path.join(directory, name)
+                for name in sorted(os.listdir(directory))
+                if name.endswith(".prof")
+            ]
+
+    return {
+        route: (pstats.Stats(*paths), len(paths))
+        for route, paths in files.items()
+        if paths
+    }
+
+
+def setup_profiling(app, sample_rate=PROFILE_SAMPLE_RATE, profile_dir=PROFILE_DIR):
+    """Profiles sampled or requested calls to app's routes into profile_dir"""
+    app.config.setdefault("PROFILE_DIR", profile_dir)
+
+    def current_profiler():
+        # batched operations dispatch inside the batch's app context, only
+        # the request that started a profile may stop it
+        profile = g.get("profile", None)
+        if profile is not None and profile[0] is request._get_current_object():
+            return g.pop("profile")[1]
+        return None
+
+    @app.before_request
+    def start_profile():
+        # unmatched urls have no route to file the profile under, and
+        # batched operations are part of the batch's profile
+        if request.url_rule is None or "profile" in g:
+            return
+
+        sampled = sample_rate > 0 and random.random() < sample_rate
+        if sampled or profile_requested():
+            profiler = cProfile.Profile()
+            g.profile = (request._get_current_object(), profiler)
+            profiler.enable()
+
+    @app.after_request
+    def stop_profile(response):
+        profiler = current_profiler()
+        if profiler is None:
+            return response
+
+        profiler.disable()
+        # streamed bodies run after the request, only the setup is profiled
+        route = route_name(request.method, request.url_rule.rule)
+        path = dump_profile(profiler, route, app.config["PROFILE_DIR"])
+        response.headers[PROFILE_HEADER] = os.path.basename(path)
+        return response
+
+    @app.teardown_request
+    def discard_profile(exception):
+        # requests failing before a response was built
+        profiler = current_profiler()
+        if profiler is not None:
+            profiler.disable()
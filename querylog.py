@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+####### Settings ########
+
+# statements slower than this are logged and tracked
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+
+# fraction of slow SELECTs re-run under EXPLAIN (ANALYZE, BUFFERS), which
+# executes them a second time, 0 (default) turns it off
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", 0))
+
+# distinct statements kept for the admin endpoint, later ones are only logged
+MAX_TRACKED_QUERIES = 500
+SLOW_QUERIES_LIMIT = 20
+
+logger = logging.getLogger("slow_query")
+
+# rows are locked or functions called for their side effects, running these
+# twice is not safe
+UNSAFE_TO_EXPLAIN = re.compile(r"\bFOR (UPDATE|SHARE)\b|\bpg_\w+\(|\bnextval\(", re.I)
+
+
+def normalize_statement(statement):
+    """Statement text with whitespace and expanded IN/VALUES lists collapsed"""
+    statement = " ".join(statement.split())
+    return re.sub(r"(%\(\w+\)s)(, %\(\w+\)s)+", r"\1, ...", statement)
+
+
+def params_shape(parameters, executemany):
+    """Number and types of the parameters, never their values"""
+    rows = parameters if executemany else [parameters]
+    first = rows[0] if rows else {}
+    values = first.values() if isinstance(first, dict) else first or ()
+
+    shape = {
+        "count": len(values),
+        "types": sorted({type(value).__name__ for value in values}),
+    }
+    if executemany:
+        shape["rows"] = len(rows)
+    return shape
+
+
+def current_route():
+    if has_request_context() and request.url_rule is not None:
+        return f"{request.method} {request.url_rule.rule}"
+    return None
+
+
+def explain(cursor, statement, parameters):
+    """Plan of a statement run again under EXPLAIN ANALYZE, None if it fails"""
+    connection = cursor.connection
+    # a failed EXPLAIN must not abort the transaction the request is using
+    savepoint = not connection.autocommit
+    explain_cursor = connection.cursor()
+
+    try:
+        if savepoint:
+            explain_cursor.execute("SAVEPOINT slow_query_explain")
+        explain_cursor.execute(
+            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters
+        )
+        plan = explain_cursor.fetchone()[0][0]
+        if savepoint:
+            explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    except Exception:
+        if savepoint:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        logger.exception("could not explain slow query")
+        return None
+    finally:
+        explain_cursor.close()
+
+
+class SlowQueryLog:
+    """Totals of slow statements in this process, grouped by statement text"""
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain_rate=EXPLAIN_SAMPLE_RATE):
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def record(self, cursor, statement, parameters, executemany, elapsed_ms):
+        entry = {
+            "route": current_route(),
+            "statement": normalize_statement(statement),
+            "params": params_shape(parameters, executemany),
+            "duration_ms": round(elapsed_ms, 3),
+        }
+
+        explainable = (
+            not executemany
+            and statement.lstrip()[:6].upper() == "SELECT"
+            and not UNSAFE_TO_EXPLAIN.search(statement)
+        )
+        if explainable and random.random() < self.explain_rate:
+            entry["plan"] = explain(cursor, statement, parameters)
+
+        logger.warning(json.dumps(entry, default=str))
+        self.track(entry)
+
+    def track(self, entry):
+        with self.lock:
+            query = self.queries.get(entry["statement"], None)
+            if query is None:
+                if len(self.queries) >= MAX_TRACKED_QUERIES:
+                    return
+                query = self.queries[entry["statement"]] = {
+                    "statement": entry["statement"],
+                    "params": entry["params"],
+                    "routes": {},
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "plan": None,
+                }
+
+            route = entry["route"] or "(no request)"
+            query["routes"][route] = query["routes"].get(route, 0) + 1
+            query["count"] += 1
+            query["total_ms"] += entry["duration_ms"]
+            query["max_ms"] = max(query["max_ms"], entry["duration_ms"])
+            if entry.get("plan") is not None:
+                query["plan"] = entry["plan"]
+
+    def top(self, limit=SLOW_QUERIES_LIMIT):
+        """Tracked statements ordered by total time spent in them"""
+        with self.lock:
+            queries = sorted(
+                self.queries.values(), key=lambda q: q["total_ms"], reverse=True
+            )[:limit]
+            return [
+                dict(
+                    query,
+                    routes=dict(query["routes"]),
+                    total_ms=round(query["total_ms"], 3),
+                    mean_ms=round(query["total_ms"] / query["count"], 3),
+                )
+                for query in queries
+            ]
+
+    def reset(self):
+        with self.lock:
+            self.queries.clear()
+
+
+slow_queries = SlowQueryLog()
+
+
+####### ENGINE EVENTS #######
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+
+    if elapsed_ms >= slow_queries.threshold_ms:
+        slow_queries.record(cursor, statement, parameters, executemany, elapsed_ms)
+
+
+@event.listens_for(Engine, "handle_error")
+def drop_query_timer(context):
+    # failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get(
+        "query_start_time"
+    ):
+        context.connection.info["query_start_time"].pop()
@@ -0,0 +1,129 @@
+import numpy as np
+from sqlalchemy import and_, exists, func
+
+from geo import distance_matrix_km
+from models import db, Bike, Station, Trip
+
+####### Settings ########
+
+TARGET_FILL_RATIO = 0.5
+
+# pairs are walked in blocks so exhausted stations are skipped with array ops
+PAIR_BLOCK_SIZE = 4096
+
+
+####### STATION STATE #######
+
+
+def load_station_state():
+    """Loads active stations and their docked bike counts as arrays.
+
+    Bikes out on an open trip still point at their origin station but cannot
+    be moved, so they are left out of the counts.
+    """
+    stations = (
+        db.session.query(
+            Station.id, Station.capacity, Station.latitude, Station.longitude
+        )
+        .filter(Station.active.isnot(False))
+        .order_by(Station.id)
+        .all()
+    )
+
+    on_trip = exists().where(and_(Trip.bike_id == Bike.id, Trip.end_time == None))
+    counts = dict(
+        db.session.query(Bike.current_station_id, func.count(Bike.id))
+        .filter(Bike.current_station_id != None, ~on_trip)
+        .group_by(Bike.current_station_id)
+        .all()
+    )
+
+    ids = np.array([station.id for station in stations], dtype=np.int64)
+    return {
+        "id": ids,
+        "capacity": np.array([s.capacity for s in stations], dtype=np.int64),
+        "latitude": np.array([s.latitude for s in stations], dtype=np.float64),
+        "longitude": np.array([s.longitude for s in stations], dtype=np.float64),
+        "num_bikes": np.array([counts.get(i, 0) for i in ids], dtype=np.int64),
+    }
+
+
+def station_balances(capacity, num_bikes, target_ratio=TARGET_FILL_RATIO):
+    """Bikes above (positive) or below (negative) each station's target fill"""
+    target = np.rint(capacity * target_ratio).astype(np.int64)
+    return num_bikes - target
+
+
+####### PLANNER #######
+
+
+def plan_moves(latitude, longitude, balance):
+    """Greedily matches surplus stations to the nearest deficit stations.
+
+    Every (surplus, deficit) pair is ranked by distance once, then bikes are
+    assigned along the cheapest pairs until supply or demand runs out.
+    Returns (from_index, to_index, num_bikes, distance_km) tuples.
+    """
+    donors = np.flatnonzero(balance > 0)
+    receivers = np.flatnonzero(balance < 0)
+
+    if len(donors) == 0 or len(receivers) == 0:
+        return []
+
+    supply = balance[donors].copy()
+    demand = -balance[receivers]
+    remaining = min(supply.sum(), demand.sum())
+
+    distances = distance_matrix_km(
+        latitude[donors], longitude[donors], latitude[receivers], longitude[receivers]
+    )
+    order = np.argsort(distances, axis=None, kind="stable")
+    moves = []
+
+    for start in range(0, order.size, PAIR_BLOCK_SIZE):
+        rows, cols = np.divmod(order[start : start + PAIR_BLOCK_SIZE], len(receivers))
+        live = (supply[rows] > 0) & (demand[cols] > 0)
+
+        for row, col in zip(rows[live], cols[live]):
+            num_bikes = min(supply[row], demand[col])
+            if num_bikes <= 0:
+                continue
+
+            supply[row] -= num_bikes
+            demand[col] -= num_bikes
+            remaining -= num_bikes
+            moves.append(
+                (donors[row], receivers[col], int(num_bikes), distances[row, col])
+            )
+
+            if remaining == 0:
+                return moves
+
+    return moves
+
+
+def build_plan(target_ratio=TARGET_FILL_RATIO, state=None):
+    """Plans truck moves that bring active stations towards target_ratio full"""
+    state = state or load_station_state()
+    balance = station_balances(state["capacity"], state["num_bikes"], target_ratio)
+    moves = plan_moves(state["latitude"], state["longitude"], balance)
+    ids = state["id"]
+
+    moved = sum(move[2] for move in moves)
+    return {
+        "target_fill_ratio": target_ratio,
+        "moves": [
+            {
+                "from_station_id": int(ids[source]),
+                "to_station_id": int(ids[destination]),
+                "num_bikes": num_bikes,
+                "distance_km": round(float(distance), 3),
+            }
+            for source, destination, num_bikes, distance in moves
+        ],
+        "num_moves": len(moves),
+        "bikes_moved": moved,
+        "total_distance_km": round(float(sum(move[3] for move in moves)), 3),
+        "surplus_remaining": int(balance[balance > 0].sum()) - moved,
+        "deficit_remaining": int(-balance[balance < 0].sum()) - moved,
+    }
@@ -0,0 +1,288 @@
+import re
+import timeit
+from collections import namedtuple
+from datetime import datetime as dt
+
+from flask import abort, request
+
+####### Settings ########
+
+MAX_STRING_LENGTH = 255
+MAX_BULK_IDS = 1000
+EMAIL = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+class ValidationError(Exception):
+    """Raised with the problems found in a request body"""
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+####### FIELD TYPES #######
+# each returns a check taking a decoded JSON value and returning it typed,
+# or raising ValueError with what is wrong
+
+
+def string(max_length=MAX_STRING_LENGTH, pattern=None):
+    def check(value):
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError("must be a non-empty string")
+        if len(value) > max_length:
+            raise ValueError(f"must be at most {max_length} characters")
+        if pattern is not None and not pattern.match(value):
+            raise ValueError("is not valid")
+        return value
+
+    return check
+
+
+def integer(minimum=None, maximum=None):
+    def check(value):
+        # bool is a subclass of int but never a valid count or id
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("must be an integer")
+        if minimum is not None and value < minimum:
+            raise ValueError(f"must be at least {minimum}")
+        if maximum is not None and value > maximum:
+            raise ValueError(f"must be at most {maximum}")
+        return value
+
+    return check
+
+
+def number(minimum=None, maximum=None):
+    def check(value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError("must be a number")
+        if minimum is not None and value < minimum:
+            raise ValueError(f"must be at least {minimum}")
+        if maximum is not None and value > maximum:
+            raise ValueError(f"must be at most {maximum}")
+        return float(value)
+
+    return check
+
+
+def boolean():
+    def check(value):
+        if not isinstance(value, bool):
+            raise ValueError("must be true or false")
+        return value
+
+    return check
+
+
+def timestamp():
+    def check(value):
+        try:
+            return dt.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError("must be an ISO 8601 date or date and time")
+
+    return check
+
+
+def ids(max_length=MAX_BULK_IDS):
+    def check(value):
+        if not isinstance(value, list) or not value:
+            raise ValueError("must be a non-empty list of ids")
+        if len(value) > max_length:
+            raise ValueError(f"must list at most {max_length} ids")
+        if not all(isinstance(i, int) and not isinstance(i, bool) for i in value):
+            raise ValueError("must only hold integers")
+        return tuple(value)
+
+    return check
+
+
+def nested(schema):
+    """A JSON object decoded by schema, with at least one field set"""
+
+    def check(value):
+        decoded = schema.decode(value)
+        if not any(v is not None for v in decoded):
+            raise ValueError("must set at least one field")
+        return decoded
+
+    return check
+
+
+####### SCHEMAS #######
+
+
+class Schema:
+    """Decodes a JSON object into a typed, immutable struct.
+
+    Fields absent from a partial schema, or sent as null, decode to None the
+    way handlers treated missing keys before. Unknown fields are rejected so
+    misspelled updates do not silently do nothing.
+    """
+
+    def __init__(self, name, fields, required=True):
+        self.name = name
+        self.required = required
+        self.fields = fields
+        self.struct = namedtuple(name, fields, defaults=(None,) * len(fields))
+        # checks in one flat tuple, decode only walks it once
+        self.checks = tuple(fields.items())
+
+    def partial(self, name, fields=None):
+        """Same fields, all optional, plus any extra fields"""
+        return Schema(name, dict(self.fields, **(fields or {})), required=False)
+
+    def decode(self, body):
+        if not isinstance(body, dict):
+            raise ValidationError([{"field": None, "error": "must be a JSON object"}])
+
+        errors = [
+            {"field": key, "error": "is not a known field"}
+            for key in body
+            if key not in self.fields
+        ]
+        values = {}
+
+        for key, check in self.checks:
+            value = body.get(key, None)
+            if value is None:
+                if self.required:
+                    errors.append({"field": key, "error": "is required"})
+                continue
+
+            try:
+                values[key] = check(value)
+            except ValueError as e:
+                errors.append({"field": key, "error": str(e)})
+            except ValidationError as e:
+                # errors of a nested object name the field they belong to
+                for error in e.errors:
+                    field = key if error["field"] is None else f"{key}.{error['field']}"
+                    errors.append({"field": field, "error": error["error"]})
+
+        if errors:
+            raise ValidationError(errors)
+        return self.struct(**values)
+
+
+BikeCreate = Schema(
+    "BikeCreate",
+    {
+        "model": string(),
+        "manufactured_at": timestamp(),
+        "electric": boolean(),
+        "current_station_id": integer(minimum=1),
+    },
+)
+BikeUpdate = BikeCreate.partial("BikeUpdate", {"needs_maintenance": boolean()})
+
+StationCreate = Schema(
+    "StationCreate",
+    {
+        "name": string(),
+        "capacity": integer(minimum=0),
+        "latitude": number(minimum=-90, maximum=90),
+        "longitude": number(minimum=-180, maximum=180),
+    },
+)
+StationUpdate = StationCreate.partial("StationUpdate", {"active": boolean()})
+
+RiderCreate = Schema(
+    "RiderCreate",
+    {
+        "name": string(),
+        "email": string(pattern=EMAIL),
+        "address": string(),
+        "membership": boolean(),
+    },
+)
+RiderUpdate = RiderCreate.partial("RiderUpdate")
+
+# bulk updates set the same changes on every row the filter matches
+BikeFilter = Schema(
+    "BikeFilter",
+    {
+        "ids": ids(),
+        "model": string(),
+        "electric": boolean(),
+        "needs_maintenance": boolean(),
+        "current_station_id": integer(minimum=1),
+    },
+    required=False,
+)
+BikeBulkUpdate = Schema(
+    "BikeBulkUpdate", {"filter": nested(BikeFilter), "changes": nested(BikeUpdate)}
+)
+
+StationFilter = Schema(
+    "StationFilter",
+    {"ids": ids(), "name": string(), "active": boolean()},
+    required=False,
+)
+StationBulkUpdate = Schema(
+    "StationBulkUpdate",
+    {"filter": nested(StationFilter), "changes": nested(StationUpdate)},
+)
+
+TripStart = Schema(
+    "TripStart", {"bike_id": integer(minimum=1), "rider_id": integer(minimum=1)}
+)
+TripEnd = Schema("TripEnd", {"destination_station_id": integer(minimum=1)})
+
+# schema and a representative body of every route taking one
+ROUTE_SCHEMAS = {
+    "POST /bikes": (
+        BikeCreate,
+        {
+            "model": "test",
+            "manufactured_at": "2021-01-03",
+            "electric": False,
+            "current_station_id": 4,
+        },
+    ),
+    "PATCH /bikes/<bike_id>": (BikeUpdate, {"needs_maintenance": True}),
+    "PATCH /bikes": (
+        BikeBulkUpdate,
+        {"filter": {"model": "test"}, "changes": {"needs_maintenance": True}},
+    ),
+    "POST /stations": (
+        StationCreate,
+        {
+            "name": "Testing Street",
+            "capacity": 10,
+            "latitude": 40.33,
+            "longitude": -45.66,
+        },
+    ),
+    "PATCH /stations/<station_id>": (StationUpdate, {"capacity": 12, "active": False}),
+    "PATCH /stations": (
+        StationBulkUpdate,
+        {"filter": {"ids": [1, 2, 3]}, "changes": {"active": False}},
+    ),
+    "POST /riders": (
+        RiderCreate,
+        {
+            "name": "Test",
+            "email": "test@abc.com",
+            "address": "123 Seasame Street",
+            "membership": True,
+        },
+    ),
+    "PATCH /riders/<rider_id>": (RiderUpdate, {"membership": False}),
+    "POST /trips": (TripStart, {"bike_id": 1, "rider_id": 1}),
+    "PATCH /trips/<trip_id>": (TripEnd, {"destination_station_id": 9}),
+}
+
+
+def decode_body(schema):
+    """Request body decoded by schema, aborts with 422 and the errors if invalid"""
+    try:
+        return schema.decode(request.get_json(silent=True))
+    except ValidationError as e:
+        abort(422, description=e.errors)
+
+
+def benchmark(schema, body, iterations=10000):
+    """Microseconds schema takes to decode body"""
+    seconds = timeit.timeit(lambda: schema.decode(body), number=iterations)
+    return seconds / iterations * 1e6
@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from datetime import datetime as dt
+
+import numpy as np
+
+from archive import ARCHIVE_DIR, TripArchive, copy_trip_columns
+from geo import distance_matrix_km, haversine_km
+from models import db, Bike, Rider, Station
+
+####### Settings ########
+
+# seconds computed trip stats are served before being computed again
+TRIP_STATS_TTL = int(os.getenv("TRIP_STATS_TTL", 600))
+TRIP_STATS_SOURCES = ("db", "archive")
+
+# station pairs precomputed when stations are few enough (8 bytes each)
+MAX_DISTANCE_MATRIX = 4_000_000
+
+STATS_COLUMNS = (
+    "rider_id",
+    "bike_id",
+    "origination_station_id",
+    "destination_station_id",
+    "start_time",
+    "end_time",
+)
+
+
+####### LOOKUPS #######
+
+
+def lookup_table(ids, values, fill):
+    """Array holding values at their ids, fill everywhere else"""
+    ids = np.asarray(ids, dtype=np.int64)
+    values = np.asarray(values)
+    table = np.full(int(ids.max(initial=-1)) + 1, fill, dtype=values.dtype)
+    table[ids] = values
+    return table
+
+
+def lookup(table, ids, fill):
+    """table[ids], with fill for ids beyond the table such as deleted rows"""
+    ids = np.asarray(ids, dtype=np.int64)
+    found = (ids >= 0) & (ids < len(table))
+    values = np.full(len(ids), fill, dtype=table.dtype)
+    values[found] = table[ids[found]]
+    return values
+
+
+def load_dimensions():
+    """Station coordinates, bike models and rider memberships as id-indexed arrays"""
+    stations = db.session.query(Station.id, Station.latitude, Station.longitude).all()
+    bikes = db.session.query(Bike.id, Bike.model).all()
+    riders = db.session.query(Rider.id, Rider.membership).all()
+
+    models, model_codes = np.unique(
+        np.array([bike.model for bike in bikes], dtype=object).astype(str),
+        return_inverse=True,
+    )
+
+    return {
+        "latitude": lookup_table(
+            [s.id for s in stations], [s.latitude for s in stations], np.nan
+        ),
+        "longitude": lookup_table(
+            [s.id for s in stations], [s.longitude for s in stations], np.nan
+        ),
+        "models": models,
+        "bike_model": lookup_table([b.id for b in bikes], model_codes, -1),
+        "rider_membership": lookup_table(
+            [r.id for r in riders],
+            np.array([r.membership for r in riders], dtype=np.int8),
+            -1,
+        ),
+    }
+
+
+####### METRICS #######
+
+
+def trip_measures(columns, dimensions):
+    """Duration in minutes and haversine distance in km of every trip"""
+    duration = (columns["end_time"] - columns["start_time"]).astype(
+        "timedelta64[s]"
+    ).astype(np.float64) / 60
+
+    latitude, longitude = dimensions["latitude"], dimensions["longitude"]
+    origin = columns["origination_station_id"]
+    destination = columns["destination_station_id"]
+
+    # trips repeat the same station pairs, so with few enough stations every
+    # pair is computed once and trips just index into the matrix
+    if len(latitude) ** 2 <= MAX_DISTANCE_MATRIX:
+        matrix = distance_matrix_km(latitude, longitude, latitude, longitude)
+        known = (origin < len(latitude)) & (destination < len(latitude))
+        distance = np.full(len(origin), np.nan)
+        distance[known] = matrix[origin[known], destination[known]]
+        return duration, distance
+
+    distance = haversine_km(
+        lookup(latitude, origin, np.nan),
+        lookup(longitude, origin, np.nan),
+        lookup(latitude, destination, np.nan),
+        lookup(longitude, destination, np.nan),
+    )
+
+    return duration, distance
+
+
+def grouped_averages(codes, duration, distance):
+    """Trip counts and mean duration and distance per non-negative code.
+
+    Trips whose stations were deleted have no distance, so distances are
+    averaged over the trips that have one.
+    """
+    known = codes >= 0
+    codes = codes[known].astype(np.int64)
+    duration, distance = duration[known], distance[known]
+    measured = ~np.isnan(distance)
+
+    size = int(codes.max(initial=-1)) + 1
+    trips = np.bincount(codes, minlength=size)
+    durations = np.bincount(codes, weights=duration, minlength=size)
+    measured_trips = np.bincount(codes[measured], minlength=size)
+    distances = np.bincount(codes[measured], weights=distance[measured], minlength=size)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_duration = durations / trips
+        avg_distance = distances / measured_trips
+
+    for code in np.flatnonzero(trips):
+        yield int(code), {
+            "num_trips": int(trips[code]),
+            "avg_duration_min": round(float(avg_duration[code]), 2),
+            "avg_distance_km": None
+            if measured_trips[code] == 0
+            else round(float(avg_distance[code]), 3),
+        }
+
+
+def trip_stats(columns, dimensions):
+    """Average trip duration and distance overall and per station, bike model and membership"""
+    duration, distance = trip_measures(columns, dimensions)
+    everything = np.zeros(len(duration), dtype=np.int64)
+
+    overall = dict(grouped_averages(everything, duration, distance)).get(
+        0, {"num_trips": 0, "avg_duration_min": None, "avg_distance_km": None}
+    )
+
+    by_station = [
+        dict(station_id=code, **values)
+        for code, values in grouped_averages(
+            columns["origination_station_id"], duration, distance
+        )
+    ]
+
+    bike_model = lookup(dimensions["bike_model"], columns["bike_id"], -1)
+    by_bike_model = [
+        dict(model=str(dimensions["models"][code]), **values)
+        for code, values in grouped_averages(bike_model, duration, distance)
+    ]
+
+    membership = lookup(dimensions["rider_membership"], columns["rider_id"], -1)
+    by_membership = [
+        dict(membership=bool(code), **values)
+        for code, values in grouped_averages(membership, duration, distance)
+    ]
+
+    return {
+        "overall": overall,
+        "by_station": by_station,
+        "by_bike_model": by_bike_model,
+        "by_membership": by_membership,
+    }
+
+
+def read_stats_columns(source, start=None, end=None, archive_dir=ARCHIVE_DIR):
+    """Closed trips started in [start, end) from the database or the archive"""
+    if source == "db":
+        return copy_trip_columns(STATS_COLUMNS, start, end)
+
+    # whole months are read, then trimmed to the exact range
+    columns = TripArchive(archive_dir).read(
+        STATS_COLUMNS,
+        start=start.strftime("%Y-%m") if start else None,
+        end=end.strftime("%Y-%m") if end else None,
+    )
+    keep = np.ones(len(columns["start_time"]), dtype=bool)
+    if start is not None:
+        keep &= columns["start_time"] >= np.datetime64(start)
+    if end is not None:
+        keep &= columns["start_time"] < np.datetime64(end)
+    return {name: values[keep] for name, values in columns.items()}
+
+
+####### APP STATS #######
+
+_stats = {}
+# guards _stats and _computing, never held while stats are computed
+_stats_lock = threading.Lock()
+# one lock per source and range being computed, so only identical
+# requests wait for each other
+_computing = {}
+
+
+def cached_stats(key, ttl):
+    cached = _stats.get(key, None)
+    if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    return None
+
+
+def get_trip_stats(source="db", start=None, end=None, ttl=TRIP_STATS_TTL):
+    """Trip stats for a source and range, computed at most once per ttl seconds"""
+    key = (source, start, end)
+
+    with _stats_lock:
+        stats = cached_stats(key, ttl)
+        if stats is not None:
+            return stats
+        computing = _computing.setdefault(key, threading.Lock())
+
+    with computing:
+        # computed meanwhile by the request this one waited for
+        with _stats_lock:
+            stats = cached_stats(key, ttl)
+            if stats is not None:
+                return stats
+
+        try:
+            columns = read_stats_columns(source, start, end)
+            stats = dict(
+                trip_stats(columns, load_dimensions()),
+                source=source,
+                generated_at=dt.now().isoformat(),
+            )
+        except Exception:
+            with _stats_lock:
+                _computing.pop(key, None)
+            raise
+
+        with _stats_lock:
+            # expired ranges are dropped so arbitrary ranges cannot pile up
+            now = time.monotonic()
+            for stale in [k for k, (at, _) in _stats.items() if now - at >= ttl]:
+                del _stats[stale]
+
+            _stats[key] = (now, stats)
+            _computing.pop(key, None)
+
+        return stats
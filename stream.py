@@ -0,0 +1,249 @@
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+from sqlalchemy import and_, event, exists, func, text
+from sqlalchemy.orm import Session
+
+from models import db, Bike, Station, Trip, on_commit, pending_commit
+
+####### Settings ########
+
+# worker processes serving the app, exported by gunicorn.conf.py
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# "memory" fans out within this process only, "postgres" relays deltas
+# between workers through LISTEN/NOTIFY on NOTIFY_CHANNEL, the default
+# whenever more than one worker runs
+STREAM_BACKEND = os.getenv("STREAM_BACKEND", "postgres" if WORKERS > 1 else "memory")
+NOTIFY_CHANNEL = "station_availability"
+
+# NOTIFY payloads are limited to 8000 bytes
+DELTAS_PER_NOTIFY = 50
+
+# a subscriber this far behind is dropped and reconnects for a fresh snapshot
+SUBSCRIBER_QUEUE_SIZE = 256
+HEARTBEAT_SECONDS = 15
+
+
+####### AVAILABILITY #######
+
+
+def station_availability(station_ids=None):
+    """Bikes and docks available at stations, keyed by station id.
+
+    Bikes out on a trip still count against their station's docks, the same
+    way ending a trip checks capacity, but are not available to ride.
+    """
+    on_trip = exists().where(and_(Trip.bike_id == Bike.id, Trip.end_time == None))
+    query = (
+        db.session.query(
+            Station.id,
+            Station.capacity,
+            func.count(Bike.id),
+            func.count(Bike.id).filter(~on_trip),
+        )
+        .outerjoin(Bike, Bike.current_station_id == Station.id)
+        .group_by(Station.id)
+    )
+
+    if station_ids is not None:
+        query = query.filter(Station.id.in_(station_ids))
+
+    return {
+        station_id: {
+            "station_id": station_id,
+            "bikes_available": available,
+            "docks_available": max(capacity - docked, 0),
+        }
+        for station_id, capacity, docked, available in query.all()
+    }
+
+
+def stations_changed(*station_ids):
+    """Publishes the availability of stations once the current write commits"""
+    ids = pending_commit().setdefault("station_ids", set())
+    ids.update(int(station_id) for station_id in station_ids if station_id is not None)
+
+
+@event.listens_for(Session, "before_commit")
+def load_changed_availability(session):
+    # counts are read inside the transaction so they match what commits
+    if session.in_nested_transaction():
+        return
+
+    pending = session.info.get("pending_commit", {})
+    if pending.get("station_ids"):
+        stations = station_availability(pending["station_ids"])
+
+        # deleted stations are sent once more, marked removed
+        for station_id in pending["station_ids"] - set(stations):
+            stations[station_id] = {"station_id": station_id, "removed": True}
+
+        pending["stations"] = stations
+
+
+####### BROKERS #######
+
+
+class StationBroker:
+    """Fans availability deltas out to the stream subscribers of this process"""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.watchers = []
+
+    def watch(self, watcher):
+        """Registers a watcher of changes committed by other processes.
+
+        It is called with the ids of the stations they changed, or None
+        when any station may have changed unseen. Only brokers relaying
+        between processes call it, writes of this process reach their
+        watchers through its own commit hooks.
+        """
+        self.watchers.append(watcher)
+
+    def start(self):
+        pass
+
+    def subscribe(self):
+        subscriber = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, deltas):
+        self.fan_out(deltas)
+
+    def fan_out(self, deltas):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(deltas)
+            except queue.Full:
+                # drop slow subscribers, None ends their stream
+                self.unsubscribe(subscriber)
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(None)
+
+
+class PostgresBroker(StationBroker):
+    """Relays deltas through Postgres so every worker's subscribers get them.
+
+    Each process holds one LISTEN connection and fans out locally, so the
+    database sees one listener per worker however many clients subscribe.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+        self.listening = threading.Event()
+
+    def publish(self, deltas):
+        with db.engine.begin() as connection:
+            for start in range(0, len(deltas), DELTAS_PER_NOTIFY):
+                connection.execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {
+                        "channel": NOTIFY_CHANNEL,
+                        "payload": json.dumps(
+                            deltas[start : start + DELTAS_PER_NOTIFY]
+                        ),
+                    },
+                )
+
+    def start(self):
+        # started lazily so the thread belongs to the worker, not a
+        # preloading master
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, daemon=True)
+                self.listener.start()
+
+    def subscribe(self):
+        self.start()
+        return super().subscribe()
+
+    def relay(self, station_ids):
+        for watcher in self.watchers:
+            watcher(station_ids)
+
+    def listen(self):
+        while True:
+            try:
+                connection = db.engine.raw_connection()
+                connection.detach()
+                connection.set_isolation_level(0)
+                connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+                # deltas may have been missed while not listening
+                self.relay(None)
+                self.listening.set()
+
+                while True:
+                    if select.select([connection], [], [], HEARTBEAT_SECONDS)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            notify = connection.notifies.pop(0)
+                            deltas = json.loads(notify.payload)
+
+                            # watchers first, a stream opening in between
+                            # takes a snapshot that already has the change
+                            self.relay({d["station_id"] for d in deltas})
+                            self.fan_out(deltas)
+            except Exception:
+                # reconnect after losing the database connection
+                self.listening.clear()
+                time.sleep(1)
+
+
+broker = PostgresBroker() if STREAM_BACKEND == "postgres" else StationBroker()
+
+
+@on_commit
+def publish_changed_availability(pending):
+    if pending.get("stations"):
+        broker.publish(list(pending["stations"].values()))
+
+
+####### SERVER-SENT EVENTS #######
+
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def event_stream(subscriber, snapshot, station_ids=None):
+    """Yields a snapshot event, then availability deltas as they are published"""
+    try:
+        yield format_event("snapshot", snapshot)
+
+        while True:
+            try:
+                deltas = subscriber.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+
+            if deltas is None:
+                return
+
+            if station_ids is not None:
+                deltas = [d for d in deltas if d["station_id"] in station_ids]
+
+            if deltas:
+                yield format_event("availability", deltas)
+    finally:
+        broker.unsubscribe(subscriber)
@@ -3,13 +3,61 @@ import json
 from wsgiref import headers
 from flask_sqlalchemy import SQLAlchemy
 import os
+import tempfile
+import threading
+import time
+from unittest import mock
+from datetime import datetime, timedelta
 from app import create_app
-from models import setup_db, Station, Bike, Trip, Rider, DATABASE_PATH
+from auth import LocalAuthority, set_key_provider
+from cache import PostgresBackend
+from archive import TripArchive, export_closed_trips, read_manifest
+from forecast import get_profiles
+from profiling import PROFILE_HEADER, merge_profiles
+from querylog import EXPLAIN_SAMPLE_RATE, SLOW_QUERY_MS, slow_queries
+import pyarrow as pa
+import tracing
+from fleet import FleetState, fleet
+from stream import PostgresBroker, station_availability
+from sqlalchemy import event, func
+from geo import haversine_km
+from decommission import assign_targets, load_decommission_state
+from changes import CHANGE_RETENTION, assign_sequence, purge_changes
+from models import (
+    setup_db,
+    db,
+    backfill_rider_summaries,
+    referencing_tables,
+    Station,
+    Bike,
+    Trip,
+    Rider,
+    Change,
+    DATABASE_PATH,
+)
 
 
 RIDER_BEARER_TOKEN = os.getenv("RIDER_TOKEN")
 MANAGER_BEARER_TOKEN = os.getenv("MANAGER_TOKEN")
 
+RIDER_PERMISSIONS = ["get:bikes", "get:stations", "create:trips"]
+MANAGER_PERMISSIONS = RIDER_PERMISSIONS + [
+    "edit:bikes",
+    "edit:stations",
+    "get:riders",
+    "edit:riders",
+    "get:trips",
+    "get:changes",
+    "get:admin",
+]
+
+# without Auth0 tokens the suite runs offline against a local signing authority
+if not (RIDER_BEARER_TOKEN and MANAGER_BEARER_TOKEN):
+    authority = LocalAuthority()
+    set_key_provider(authority)
+    RIDER_BEARER_TOKEN = authority.mint(RIDER_PERMISSIONS, sub="local|rider")
+    MANAGER_BEARER_TOKEN = authority.mint(MANAGER_PERMISSIONS, sub="local|manager")
+
 
 class BikeSystemTest(unittest.TestCase):
     def setUp(self):
@@ -91,6 +139,920 @@ class BikeSystemTest(unittest.TestCase):
         self.assertEqual(len(data["trips"]), 10)  # returns paginated trips info
         self.assertTrue(data["total_num_trips"])  # returns number of trips
 
+    def test_get_trips_of_rider(self):
+        """Test for successful GET of a rider's trips newest first"""
+        res = self.client().get(
+            "/riders/5/trips?limit=1", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["trips"]), 1)  # limit applied
+        self.assertTrue(data["rider_info"]["num_trips"] >= 2)  # total trip count
+
+    def test_get_trips_of_rider_date_range(self):
+        """Test for GET of a rider's trips filtered by date"""
+        res = self.client().get(
+            "/riders/5/trips?from=2022-01-01&to=2022-01-02",
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["num_trips"], 1)
+        self.assertEqual(data["trips"][0]["id"], 8)
+
+    def test_400_get_trips_of_rider_bad_date(self):
+        """Tests for 400 error on malformed date filter"""
+        res = self.client().get(
+            "/riders/5/trips?from=yesterday", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_export_and_read_trip_archive(self):
+        """Test closed trips round trip through the columnar archive"""
+        with tempfile.TemporaryDirectory() as archive_dir:
+            with self.app.app_context():
+                exported = export_closed_trips(archive_dir=archive_dir)
+                closed = Trip.query.filter(Trip.end_time != None).count()
+                # a second run only appends new trips
+                self.assertEqual(export_closed_trips(archive_dir=archive_dir), 0)
+
+            # buffers are read in place from the mapped files
+            allocated = pa.total_allocated_bytes()
+            table = TripArchive(archive_dir).read_table()
+            self.assertEqual(pa.total_allocated_bytes(), allocated)
+            columns = TripArchive(archive_dir).read()
+
+        self.assertTrue(exported)
+        self.assertTrue(exported <= closed)
+        self.assertEqual(table.num_rows, exported)
+        self.assertEqual(len(columns["id"]), exported)
+        self.assertTrue((columns["end_time"] >= columns["start_time"]).all())
+
+    def test_open_trip_lookups_prune_partitions(self):
+        """Test open trip lookups scan recent partitions first and still find old trips"""
+        statements = []
+
+        def record(connection, cursor, statement, parameters, context, many):
+            statements.append((statement, parameters))
+
+        with self.app.app_context():
+            bike = Bike("probe", False, datetime(2021, 1, 3), 2)
+            bike.insert()
+            trip = Trip(3, 2, bike.id, datetime(2022, 1, 15))
+            trip.insert()
+
+            try:
+                event.listen(db.engine, "before_cursor_execute", record)
+                try:
+                    open_trip = Trip.open_trip_of(bike.id)
+                finally:
+                    event.remove(db.engine, "before_cursor_execute", record)
+                found = Trip.find(trip.id)
+
+                statement, parameters = next(
+                    (statement, parameters)
+                    for statement, parameters in statements
+                    if "trips.start_time >=" in statement
+                )
+                plan = db.session.connection().exec_driver_sql(
+                    "EXPLAIN " + statement, parameters
+                )
+                plan = "\n".join(row[0] for row in plan)
+            finally:
+                trip.delete()
+                bike.delete()
+
+        self.assertEqual(open_trip.id, trip.id)
+        self.assertEqual(found.id, trip.id)
+        self.assertNotIn("trips_y2022m01", plan)
+
+    def test_export_trip_closed_after_export(self):
+        """Test a long open trip passed by an export is exported once it closes"""
+        with tempfile.TemporaryDirectory() as archive_dir:
+            with self.app.app_context():
+                trip = Trip(3, 2, 13, datetime.now() - timedelta(days=3))
+                trip.insert()
+                try:
+                    # other tests leave recent open trips holding the watermark
+                    with mock.patch("archive.OPEN_TRIP_GRACE", timedelta(0)):
+                        export_closed_trips(archive_dir=archive_dir)
+                    manifest = read_manifest(archive_dir)
+                    self.assertIn(trip.id, manifest["open_trip_ids"])
+                    # the re-scan is bounded to the partitions of open trips
+                    self.assertLessEqual(
+                        datetime.fromisoformat(manifest["open_trips_since"]),
+                        trip.start_time,
+                    )
+
+                    trip.end_time = datetime.now()
+                    trip.destination_station_id = 2
+                    trip.update()
+
+                    self.assertEqual(export_closed_trips(archive_dir=archive_dir), 1)
+                    columns = TripArchive(archive_dir).read()
+                    self.assertIn(trip.id, columns["id"])
+                finally:
+                    trip.delete()
+
+    def test_get_rebalance_plan(self):
+        """Test for successful GET of a rebalancing plan"""
+        res = self.client().get(
+            "/rebalance/plan?target=0.5", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["num_moves"], len(data["moves"]))
+        self.assertEqual(
+            data["bikes_moved"], sum(move["num_bikes"] for move in data["moves"])
+        )
+
+    def test_400_rebalance_plan_bad_target(self):
+        """Tests for 400 error on a target fill ratio above 1"""
+        res = self.client().get(
+            "/rebalance/plan?target=2", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_get_station_forecast(self):
+        """Test for successful GET of a station demand forecast"""
+        res = self.client().get(
+            "/stations/1/forecast?hours=4", headers=self.rider_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["station_id"], 1)
+        self.assertEqual(len(data["forecast"]), 4)  # one entry per hour
+
+    def test_404_station_forecast_not_found(self):
+        """Tests for 404 error on forecast of a missing station"""
+        res = self.client().get(
+            "/stations/10000/forecast", headers=self.rider_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
+    def test_get_bikes_filtered(self):
+        """Test for GET bikes filtered on a column in the database"""
+        res = self.client().get(
+            "/bikes?electric=true&sort=-id", headers=self.rider_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(bike["electric"] for bike in data["bikes"]))
+        ids = [bike["id"] for bike in data["bikes"]]
+        self.assertEqual(ids, sorted(ids, reverse=True))  # sorted descending
+
+    def test_get_trips_filtered(self):
+        """Test for GET trips narrowed to ended trips"""
+        res = self.client().get("/trips?open=false", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(trip["end_time"] for trip in data["trips"]))
+
+    def test_400_get_bikes_bad_filter(self):
+        """Tests for 400 error on unknown sort column and malformed filter"""
+        res = self.client().get("/bikes?sort=color", headers=self.rider_auth_header)
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().get("/bikes?electric=maybe", headers=self.rider_auth_header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_search_riders(self):
+        """Test for successful rider search by name prefix"""
+        res = self.client().get("/riders/search?q=mi", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(data["total_num_results"])
+        self.assertTrue(data["riders"][0]["name"].lower().startswith("mi"))
+
+    def test_search_stations(self):
+        """Test for successful station search by partial name"""
+        res = self.client().get(
+            "/stations/search?q=grand", headers=self.rider_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertIn("grand", data["stations"][0]["name"].lower())
+
+    def test_400_search_without_term(self):
+        """Tests for 400 error on a search without q"""
+        res = self.client().get("/riders/search", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_idempotent_rejected_request_replayed(self):
+        """Tests a retried POST rejected with 422 replays the rejection"""
+        headers = dict(self.manager_auth_header, **{"Idempotency-Key": "rider-invalid"})
+        body = dict(self.test_rider, email=5)
+
+        res = self.client().post("/riders", json=body, headers=headers)
+        retry = self.client().post("/riders", json=body, headers=headers)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(retry.status_code, 422)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(json.loads(retry.data), json.loads(res.data))
+
+    def test_idempotent_rejected_after_write_released(self):
+        """Tests a request rejected after it committed is not replayed"""
+        headers = dict(self.manager_auth_header, **{"Idempotency-Key": "rider-late"})
+        body = dict(self.test_rider, email="late@abc.com")
+
+        # the rider is created before the page is found to be empty
+        res = self.client().post("/riders?page=1000", json=body, headers=headers)
+        retry = self.client().post("/riders?page=1000", json=body, headers=headers)
+
+        with self.app.app_context():
+            Rider.query.filter_by(email="late@abc.com").delete()
+            db.session.commit()
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(retry.status_code, 422)
+        self.assertNotIn("Idempotent-Replayed", retry.headers)
+
+    def test_idempotent_create_rider(self):
+        """Tests a retried POST with the same Idempotency-Key is replayed"""
+        headers = dict(self.manager_auth_header, **{"Idempotency-Key": "rider-retry"})
+
+        res = self.client().post("/riders", json=self.test_rider, headers=headers)
+        data = json.loads(res.data)
+        retry = self.client().post("/riders", json=self.test_rider, headers=headers)
+        retry_data = json.loads(retry.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry_data["created_rider_id"], data["created_rider_id"])
+        self.assertEqual(retry_data["total_num_riders"], data["total_num_riders"])
+
+        # the same key with a different body is rejected
+        other = self.client().post(
+            "/riders", json=dict(self.test_rider, name="Other"), headers=headers
+        )
+        self.assertEqual(other.status_code, 422)
+
+    def test_batch_per_item(self):
+        """Tests a batch keeps going past a failed operation when not atomic"""
+        res = self.client().post(
+            "/batch",
+            json={
+                "atomic": False,
+                "operations": [
+                    {"method": "GET", "path": "/bikes?page=2"},
+                    {"method": "GET", "path": "/riders/100000/trips"},
+                    {"method": "GET", "path": "/stations/1/bikes"},
+                ],
+            },
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual([r["status"] for r in data["results"]], [200, 404, 200])
+        self.assertEqual(data["results"][0]["body"]["page"], 2)
+
+    def test_batch_atomic_rollback(self):
+        """Tests a failed operation rolls back the whole atomic batch"""
+        before = self.client().get("/riders", headers=self.manager_auth_header)
+
+        res = self.client().post(
+            "/batch",
+            json={
+                "operations": [
+                    {"method": "POST", "path": "/riders", "body": self.test_rider},
+                    {"method": "DELETE", "path": "/riders/100000"},
+                    {"method": "GET", "path": "/riders"},
+                ]
+            },
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+        after = self.client().get("/riders", headers=self.manager_auth_header)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual([r["status"] for r in data["results"]], [200, 404])
+        self.assertEqual(
+            json.loads(after.data)["total_num_riders"],
+            json.loads(before.data)["total_num_riders"],
+        )
+
+    def test_batch_rollback_skips_forecast(self):
+        """Tests a trip ended in a rolled back batch never reaches the forecast"""
+        with self.app.app_context():
+            profiles = get_profiles()
+            res = self.client().post(
+                "/trips",
+                json={"bike_id": 11, "rider_id": 8},
+                headers=self.manager_auth_header,
+            )
+            trip_id = json.loads(res.data)["started_trip"]["trip_id"]
+            arrivals = int(profiles.arrivals.sum())
+
+            res = self.client().post(
+                "/batch",
+                json={
+                    "operations": [
+                        {
+                            "method": "PATCH",
+                            "path": f"/trips/{trip_id}",
+                            "body": {"destination_station_id": 1},
+                        },
+                        {"method": "DELETE", "path": "/riders/100000"},
+                    ]
+                },
+                headers=self.manager_auth_header,
+            )
+
+            self.assertEqual(res.status_code, 422)
+            self.assertEqual(int(profiles.arrivals.sum()), arrivals)
+
+            self.client().patch(
+                f"/trips/{trip_id}",
+                json={"destination_station_id": 1},
+                headers=self.manager_auth_header,
+            )
+            self.assertEqual(int(profiles.arrivals.sum()), arrivals + 1)
+
+    def test_400_batch_without_operations(self):
+        """Tests for 400 error on a batch with no operations"""
+        res = self.client().post(
+            "/batch", json={"operations": []}, headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_get_stations_sparse_fields(self):
+        """Test for GET stations narrowed to requested fields"""
+        res = self.client().get(
+            "/stations?fields=id,latitude,longitude,num_bikes",
+            headers=self.rider_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            set(data["stations"][0]), {"id", "latitude", "longitude", "num_bikes"}
+        )
+
+    def test_400_get_trips_unknown_field(self):
+        """Tests for 400 error on a field trips do not have"""
+        res = self.client().get(
+            "/trips?fields=id,color", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_cache_hit_and_invalidation(self):
+        """Tests cached reads are served until a write to their tables"""
+        url = "/stations/1/bikes"
+        self.client().get(url, headers=self.rider_auth_header)
+        hit = self.client().get(url, headers=self.rider_auth_header)
+
+        self.client().patch("/stations/1", json={}, headers=self.manager_auth_header)
+        after_write = self.client().get(url, headers=self.rider_auth_header)
+
+        stats = self.client().get("/cache/stats", headers=self.manager_auth_header)
+        data = json.loads(stats.data)
+
+        self.assertEqual(hit.headers["X-Cache"], "HIT")
+        self.assertEqual(after_write.headers["X-Cache"], "MISS")
+        self.assertEqual(json.loads(after_write.data), json.loads(hit.data))
+        self.assertTrue(data["cache"]["hits"] >= 1)
+
+    def test_cache_invalidated_by_cascaded_writes(self):
+        """Tests deletes invalidate reads of the rows they cascade to"""
+        created = self.client().post(
+            "/stations", json=self.test_station, headers=self.manager_auth_header
+        )
+        station_id = json.loads(created.data)["created_station_id"]
+        self.client().post(
+            "/bikes",
+            json=dict(self.test_bike, model="probe", current_station_id=station_id),
+            headers=self.manager_auth_header,
+        )
+
+        url = "/bikes?model=probe"
+        before = self.client().get(url, headers=self.rider_auth_header)
+        self.client().delete(
+            f"/stations/{station_id}", headers=self.manager_auth_header
+        )
+        after = self.client().get(url, headers=self.rider_auth_header)
+        bike = json.loads(after.data)["bikes"][0]
+
+        with self.app.app_context():
+            Bike.query.filter_by(model="probe").delete()
+            db.session.commit()
+
+        self.assertEqual(
+            json.loads(before.data)["bikes"][0]["current_station_id"], station_id
+        )
+        self.assertEqual(after.headers["X-Cache"], "MISS")
+        self.assertIsNone(bike["current_station_id"])
+        # deleting a rider deletes their trips and summary
+        self.assertEqual(
+            referencing_tables(Rider.__table__), {"trips", "rider_summaries"}
+        )
+
+    def test_cache_generations_shared_between_workers(self):
+        """Tests a write bumps the table generations of every worker's cache"""
+        workers = [PostgresBackend(), PostgresBackend()]
+        for backend in workers:
+            backend.get_generations(["bikes"])
+            self.assertTrue(backend.listening.wait(5))
+
+        workers[0].bump_generations(["bikes"])
+
+        deadline = time.monotonic() + 5
+        while workers[1].get_generations(["bikes"]) == [0]:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        self.assertEqual(workers[1].get_generations(["stations"]), [0])
+
+    def test_stream_station_availability(self):
+        """Tests the station stream sends a snapshot, then changes"""
+        res = self.client().get(
+            "/stations/stream?station_id=1",
+            headers=self.rider_auth_header,
+            buffered=False,
+        )
+        events = iter(res.response)
+        snapshot = next(events).decode()
+
+        self.client().patch("/stations/1", json={}, headers=self.manager_auth_header)
+        change = next(events).decode()
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(snapshot.startswith("event: snapshot"))
+        self.assertTrue(change.startswith("event: availability"))
+        self.assertEqual(json.loads(change.split("data: ")[1])[0]["station_id"], 1)
+
+    def test_stream_added_and_removed_station(self):
+        """Tests the station stream announces created and deleted stations"""
+        res = self.client().get(
+            "/stations/stream", headers=self.rider_auth_header, buffered=False
+        )
+        events = iter(res.response)
+        next(events)
+
+        created = self.client().post(
+            "/stations", json=self.test_station, headers=self.manager_auth_header
+        )
+        station_id = json.loads(created.data)["created_station_id"]
+        added = next(events).decode()
+
+        self.client().delete(
+            f"/stations/{station_id}", headers=self.manager_auth_header
+        )
+        removed = next(events).decode()
+        res.close()
+
+        self.assertEqual(
+            json.loads(added.split("data: ")[1]),
+            [{"station_id": station_id, "bikes_available": 0, "docks_available": 10}],
+        )
+        self.assertEqual(
+            json.loads(removed.split("data: ")[1]),
+            [{"station_id": station_id, "removed": True}],
+        )
+
+    def test_get_changes(self):
+        """Test for GET of the change feed resumed from a position"""
+        res = self.client().get("/changes?limit=2", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+        resumed = self.client().get(
+            f"/changes?since={data['next_since']}", headers=self.manager_auth_header
+        )
+        resumed_data = json.loads(resumed.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["changes"]), 2)  # earlier tests wrote rows
+        self.assertTrue(data["changes"][0]["seq"] < data["changes"][1]["seq"])
+        self.assertTrue(
+            all(c["seq"] > data["next_since"] for c in resumed_data["changes"])
+        )
+
+    def test_get_changes_after_purge(self):
+        """Test feed positions keep growing after every change is purged"""
+
+        def create_and_delete_rider():
+            created = self.client().post(
+                "/riders", json=self.test_rider, headers=self.manager_auth_header
+            )
+            rider_id = json.loads(created.data)["created_rider_id"]
+            self.client().delete(
+                f"/riders/{rider_id}", headers=self.manager_auth_header
+            )
+            return rider_id
+
+        create_and_delete_rider()
+        with self.app.app_context():
+            assign_sequence()
+            since = db.session.query(func.max(Change.seq)).scalar()
+            purge_changes(now=datetime.now() + CHANGE_RETENTION)
+
+        rider_id = create_and_delete_rider()
+
+        res = self.client().get(
+            f"/changes?since={since}", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [(c["row_id"], c["op"]) for c in data["changes"] if c["table"] == "riders"],
+            [(rider_id, "insert"), (rider_id, "delete")],
+        )
+
+    def test_400_get_changes_bad_limit(self):
+        """Tests for 400 error on a change feed limit below 1"""
+        res = self.client().get("/changes?limit=0", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_get_stations_updated_since(self):
+        """Test for a delta sync of stations returning a high-water mark"""
+        res = self.client().get(
+            "/stations?updated_since=2000-01-01", headers=self.rider_auth_header
+        )
+        data = json.loads(res.data)
+        resumed = self.client().get(
+            "/stations?updated_since=" + data["high_water_mark"],
+            headers=self.rider_auth_header,
+        )
+        resumed_data = json.loads(resumed.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["total_num_stations"])
+        self.assertIsInstance(data["deleted_ids"], list)
+        self.assertEqual(resumed.status_code, 200)  # nothing new is not a 404
+        self.assertEqual(resumed_data["total_num_stations"], 0)
+
+    def test_high_water_mark_before_reading_transaction(self):
+        """Tests the high-water mark waits for a transaction that has not written yet"""
+        with self.app.app_context():
+            connection = db.engine.connect()
+            reading = connection.begin()
+            started = connection.execute("SELECT now()::timestamp").scalar()
+
+            try:
+                res = self.client().get(
+                    "/stations?updated_since=2000-01-01",
+                    headers=self.rider_auth_header,
+                )
+                data = json.loads(res.data)
+            finally:
+                reading.rollback()
+                connection.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(datetime.fromisoformat(data["high_water_mark"]), started)
+
+    @unittest.skipIf(os.getenv("RIDER_TOKEN"), "uses the local signing authority")
+    def test_get_local_jwks(self):
+        """Test the local authority serves the key its tokens are signed with"""
+        res = self.client().get("/.well-known/jwks.json")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["keys"][0]["kid"], authority.kid)
+
+    @unittest.skipIf(os.getenv("RIDER_TOKEN"), "uses the local signing authority")
+    def test_401_expired_token(self):
+        """Tests for 401 error on an expired token"""
+        token = authority.mint(RIDER_PERMISSIONS, expires_in=-60)
+        res = self.client().get("/bikes", headers={"Authorization": "Bearer " + token})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data["message"]["code"], "token_expired")
+
+    def test_profile_requested_route(self):
+        """Test a manager can profile a request and merge its route's profiles"""
+        with tempfile.TemporaryDirectory() as profile_dir:
+            self.app.config["PROFILE_DIR"] = profile_dir
+            headers = dict(self.manager_auth_header, **{PROFILE_HEADER: "1"})
+
+            profiled = self.client().get("/stations/1/bikes", headers=headers)
+            unprofiled = self.client().get(
+                "/stations",
+                headers=dict(self.rider_auth_header, **{PROFILE_HEADER: "1"}),
+            )
+            merged = merge_profiles(profile_dir)
+
+        self.assertEqual(profiled.status_code, 200)
+        self.assertIn(PROFILE_HEADER, profiled.headers)
+        self.assertNotIn(PROFILE_HEADER, unprofiled.headers)  # riders can't profile
+        self.assertEqual(list(merged), ["GET_stations_station_id_bikes"])
+        self.assertEqual(merged["GET_stations_station_id_bikes"][1], 1)
+
+    def test_get_slow_queries(self):
+        """Test slow statements are listed with their route and plan"""
+        slow_queries.reset()
+        slow_queries.threshold_ms, slow_queries.explain_rate = 0, 1
+        try:
+            with self.assertLogs("slow_query", "WARNING") as logged:
+                self.client().get("/riders/1/trips", headers=self.manager_auth_header)
+        finally:
+            slow_queries.threshold_ms = SLOW_QUERY_MS
+            slow_queries.explain_rate = EXPLAIN_SAMPLE_RATE
+
+        res = self.client().get("/queries/slow", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+        routed = [
+            q for q in data["queries"] if "GET /riders/<rider_id>/trips" in q["routes"]
+        ]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(routed)
+        self.assertTrue(any(q["plan"] for q in routed))
+        self.assertEqual(len(logged.records), sum(q["count"] for q in data["queries"]))
+
+    def test_trace_create_rider(self):
+        """Test a request's spans are exported under the caller's trace"""
+        collector = tracing.LocalCollector()
+        tracing.setup_tracing(self.app, collector)
+        trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+        headers = dict(
+            self.manager_auth_header, traceparent=f"00-{trace_id}-{parent_id}-01"
+        )
+
+        res = self.client().post("/riders", json=self.test_rider, headers=headers)
+        spans = {s["name"]: s for s in collector.traces[-1]}
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers["traceparent"].startswith(f"00-{trace_id}-"))
+        self.assertEqual(spans["POST /riders"]["parent_id"], parent_id)
+        self.assertEqual(spans["POST /riders"]["attributes"]["http.status_code"], 200)
+        for name in (
+            "auth.get_token_auth_header",
+            "auth.verify_decode_jwt",
+            "sql",
+            "models.Rider.format",
+            "response.encode",
+        ):
+            self.assertIn(name, spans)
+            self.assertEqual(spans[name]["trace_id"], trace_id)
+
+    def test_fleet_state_follows_writes(self):
+        """Test the fleet state tracks writes and reloads after drifting"""
+        with self.app.app_context():
+            fleet.load()
+            self.client().post(
+                "/trips",
+                json={"bike_id": 2, "rider_id": 1},
+                headers=self.manager_auth_header,
+            )
+            res = self.client().get(
+                "/stations/availability", headers=self.rider_auth_header
+            )
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(
+                {s["station_id"]: s for s in data["stations"]}, station_availability()
+            )
+            self.assertFalse(fleet.check())
+
+            # a write the models never see
+            db.session.execute(
+                "UPDATE stations SET capacity = capacity + 1 WHERE id = 1"
+            )
+            db.session.commit()
+            try:
+                self.assertTrue(fleet.check())
+                self.assertEqual(fleet.availability(), station_availability())
+            finally:
+                db.session.execute(
+                    "UPDATE stations SET capacity = capacity - 1 WHERE id = 1"
+                )
+                db.session.commit()
+                fleet.load()
+
+    def test_fleet_state_follows_other_workers(self):
+        """Test the fleet state re-reads stations changed by other workers"""
+        with self.app.app_context():
+            state = FleetState()
+            state.load()
+            relay = PostgresBroker()
+            relay.watch(state.reload)
+            relay.start()
+            self.assertTrue(relay.listening.wait(5))
+
+            # another worker moves a bike from station 1 to station 2
+            bike_id = int(state.bikes_at(1)[0])
+            db.session.execute(
+                f"UPDATE bikes SET current_station_id = 2 WHERE id = {bike_id}"
+            )
+            db.session.commit()
+            try:
+                self.assertNotEqual(
+                    state.availability([1, 2]), station_availability([1, 2])
+                )
+                relay.publish([{"station_id": 1}, {"station_id": 2}])
+
+                deadline = time.monotonic() + 5
+                while state.availability([1, 2]) != station_availability([1, 2]):
+                    self.assertLess(time.monotonic(), deadline)
+                    time.sleep(0.05)
+            finally:
+                db.session.execute(
+                    f"UPDATE bikes SET current_station_id = 1 WHERE id = {bike_id}"
+                )
+                db.session.commit()
+
+    def test_rider_summary_follows_trips(self):
+        """Test rider summaries count a trip when it starts and its time when it ends"""
+
+        def rider_info():
+            res = self.client().get(
+                "/riders/4/trips?limit=1", headers=self.manager_auth_header
+            )
+            return json.loads(res.data)["rider_info"]
+
+        before = rider_info()
+        res = self.client().post(
+            "/trips",
+            json={"bike_id": 9, "rider_id": 4},
+            headers=self.manager_auth_header,
+        )
+        trip_id = json.loads(res.data)["started_trip"]["trip_id"]
+        self.client().patch(
+            f"/trips/{trip_id}",
+            json={"destination_station_id": 3},
+            headers=self.manager_auth_header,
+        )
+        after = rider_info()
+
+        self.assertEqual(after["num_trips"], before["num_trips"] + 1)
+        self.assertGreaterEqual(after["minutes_ridden"], before["minutes_ridden"])
+        self.assertNotEqual(after["last_ride_at"], before["last_ride_at"])
+
+        # the running totals match totals recomputed from the trips
+        with self.app.app_context():
+            backfill_rider_summaries()
+        self.assertEqual(rider_info(), after)
+
+        # deleting the trip takes it back out, last ride included
+        with self.app.app_context():
+            Trip.query.get(trip_id).delete()
+        self.assertEqual(rider_info(), before)
+
+    def test_backfill_rider_summaries_with_archive(self):
+        """Test the backfill counts archived partitions and zeroes riders without trips"""
+        with self.app.app_context():
+            db.session.execute("CREATE SCHEMA IF NOT EXISTS archive")
+            db.session.execute(
+                "CREATE TABLE archive.trips_y2000m01 " "(LIKE trips INCLUDING DEFAULTS)"
+            )
+            db.session.execute(
+                "INSERT INTO archive.trips_y2000m01 "
+                "(id, origination_station_id, destination_station_id, bike_id, "
+                "rider_id, start_time, end_time) "
+                "VALUES (100000, 1, 1, 1, 6, '2000-01-01 10:00', '2000-01-01 10:30')"
+            )
+            # a stale summary of a rider whose trips are gone
+            db.session.execute(
+                "INSERT INTO rider_summaries (rider_id, num_trips) VALUES (3, 7) "
+                "ON CONFLICT (rider_id) DO UPDATE SET num_trips = 7"
+            )
+            db.session.commit()
+
+            try:
+                backfill_rider_summaries()
+                live = Trip.query.filter(Trip.rider_id == 6).count()
+                summary = Rider.query.get(6).format()
+                self.assertEqual(summary["num_trips"], live + 1)
+                self.assertGreaterEqual(summary["minutes_ridden"], 30)
+
+                trips = Trip.query.filter(Trip.rider_id == 3).count()
+                self.assertEqual(Rider.query.get(3).format()["num_trips"], trips)
+            finally:
+                db.session.rollback()
+                db.session.execute("DROP TABLE archive.trips_y2000m01")
+                db.session.commit()
+                backfill_rider_summaries()
+
+    def test_get_trip_stats(self):
+        """Test trip stats match durations and distances computed per trip"""
+        res = self.client().get("/stats/trips", headers=self.manager_auth_header)
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            trips = Trip.query.filter(Trip.end_time != None).all()
+            durations = [
+                (t.end_time - t.start_time).total_seconds() / 60 for t in trips
+            ]
+            stations = {station.id: station for station in Station.query.all()}
+            distances = [
+                haversine_km(
+                    stations[t.origination_station_id].latitude,
+                    stations[t.origination_station_id].longitude,
+                    stations[t.destination_station_id].latitude,
+                    stations[t.destination_station_id].longitude,
+                )
+                for t in trips
+            ]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["overall"]["num_trips"], len(trips))
+        self.assertAlmostEqual(
+            data["overall"]["avg_duration_min"], sum(durations) / len(trips), places=1
+        )
+        self.assertAlmostEqual(
+            data["overall"]["avg_distance_km"], sum(distances) / len(trips), places=2
+        )
+        for group in ("by_station", "by_bike_model", "by_membership"):
+            self.assertEqual(
+                sum(row["num_trips"] for row in data[group]), len(trips), group
+            )
+
+    def test_get_trip_stats_not_blocked_by_other_range(self):
+        """Test a slow stats computation only holds up requests for its own range"""
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_columns(source, start=None, end=None):
+            started.set()
+            release.wait(5)
+            raise RuntimeError("archive unavailable")
+
+        res = self.client().get(
+            "/stats/trips?from=2001-01-01", headers=self.manager_auth_header
+        )
+        with mock.patch("stats.read_stats_columns", side_effect=slow_columns):
+            slow = threading.Thread(
+                target=self.client().get,
+                args=("/stats/trips?from=2002-01-01",),
+                kwargs={"headers": self.manager_auth_header},
+            )
+            slow.start()
+            self.assertTrue(started.wait(5))
+
+            asked_at = time.monotonic()
+            cached = self.client().get(
+                "/stats/trips?from=2001-01-01", headers=self.manager_auth_header
+            )
+            waited = time.monotonic() - asked_at
+            release.set()
+            slow.join(5)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(cached.data), json.loads(res.data))
+        self.assertLess(waited, 1)
+
+    def test_get_trip_stats_empty_range(self):
+        """Test trip stats of a range without trips are zero counts"""
+        res = self.client().get(
+            "/stats/trips?from=2030-01-01&to=2030-02-01",
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["overall"]["num_trips"], 0)
+        self.assertEqual(data["by_station"], [])
+
+    def test_400_get_trip_stats_bad_source(self):
+        """Tests for 400 error on an unknown trip stats source"""
+        res = self.client().get(
+            "/stats/trips?source=spreadsheet", headers=self.manager_auth_header
+        )
+
+        self.assertEqual(res.status_code, 400)
+
     def test_404_invalid_page_get_bikes(self):
         """Tests for 404 error in GET bikes"""
         res = self.client().get("/bikes?page=10000", headers=self.manager_auth_header)
@@ -215,6 +1177,44 @@ class BikeSystemTest(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "Unprocessable")
 
+    def test_bulk_update_bikes(self):
+        """Test for moving bikes matched by a filter in one PATCH"""
+        res = self.client().patch(
+            "/bikes",
+            json={"filter": {"ids": [14, 15]}, "changes": {"current_station_id": 3}},
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["num_bikes_updated"], 2)
+        self.assertEqual(sorted(data["updated_bike_ids"]), [14, 15])
+
+        res = self.client().get("/stations/3/bikes", headers=self.rider_auth_header)
+        ids = [bike["id"] for bike in json.loads(res.data)["bikes"]]
+        self.assertIn(14, ids)
+        self.assertIn(15, ids)
+
+        # put bike 15 back where it was
+        self.client().patch(
+            "/bikes",
+            json={"filter": {"ids": [15]}, "changes": {"current_station_id": 6}},
+            headers=self.manager_auth_header,
+        )
+
+    def test_422_bulk_update_without_filter(self):
+        """Tests for 422 error on bulk update with an empty filter"""
+        res = self.client().patch(
+            "/stations",
+            json={"filter": {}, "changes": {"active": False}},
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["errors"][0]["field"], "filter")
+
     def test_404_update_bike_fail(self):
         """Tests for bad PATCH requests to bikes"""
         res = self.client().patch(
@@ -302,6 +1302,90 @@ class BikeSystemTest(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "Unprocessable")
 
+    def test_422_invalid_station_fields(self):
+        """Tests invalid fields are rejected and named before the station is saved"""
+        res = self.client().post(
+            "/stations",
+            json=dict(self.test_station, capacity="ten", latitude=100, capcity=10),
+            headers=self.manager_auth_header,
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["message"], "Unprocessable")
+        self.assertEqual(
+            sorted(error["field"] for error in data["errors"]),
+            ["capacity", "capcity", "latitude"],
+        )
+
+    def test_decommission_station(self):
+        """Test for moving a closed station's bikes to the nearest station with docks"""
+        res = self.client().post(
+            "/stations/6/decommission", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        try:
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["decommissioned_station_id"], 6)
+            # City Hall shares 7th Ave's coordinates and has room for every bike
+            self.assertEqual([move["station_id"] for move in data["moves"]], [12])
+            self.assertEqual(len(data["moves"][0]["bike_ids"]), data["num_bikes_moved"])
+
+            res = self.client().get("/stations/6/bikes", headers=self.rider_auth_header)
+            bikes = json.loads(res.data)["bikes"]
+            self.assertEqual(len(bikes), data["num_bikes_on_trip"])
+        finally:
+            self.client().patch(
+                "/bikes",
+                json={
+                    "filter": {"current_station_id": 12},
+                    "changes": {"current_station_id": 6},
+                },
+                headers=self.manager_auth_header,
+            )
+            self.client().patch(
+                "/stations/6", json={"active": True}, headers=self.manager_auth_header
+            )
+
+    def test_decommission_targets_lock(self):
+        """Test decommission locks let bike writes through and re-count spare docks"""
+        with self.app.app_context():
+            state = load_decommission_state(6)
+            nearest = state["id"].tolist().index(12)
+            spare = int(state["spare"][nearest])
+
+            # docks taken after the candidates were read
+            state["spare"][nearest] += 100
+            targets, distance = assign_targets(state, spare + 1)
+
+            other = db.engine.connect()
+            writing = other.begin()
+            try:
+                other.execute("SET LOCAL lock_timeout = '2s'")
+                # the foreign key check only needs a key share lock
+                other.execute(
+                    "INSERT INTO bikes (model, manufactured_at, electric, current_station_id)"
+                    " VALUES ('probe', '2021-01-03', false, 12)"
+                )
+            finally:
+                writing.rollback()
+                other.close()
+                db.session.rollback()
+
+        self.assertEqual(len(targets), spare + 1)
+        self.assertEqual(state["id"][targets].tolist().count(12), spare)
+
+    def test_404_decommission_station_fail(self):
+        """Tests for decommissioning a station that does not exist"""
+        res = self.client().post(
+            "/stations/100/decommission", headers=self.manager_auth_header
+        )
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
     def test_404_update_station_fail(self):
         """Tests for bad PATCH requests to stations"""
         res = self.client().patch(
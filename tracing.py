@@ -0,0 +1,331 @@
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from urllib.request import Request, urlopen
+
+from flask import request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+####### Settings ########
+
+# "none" (default), "memory" for the in-process collector stand-in,
+# "file:<path>" for JSON lines, or "http://..." for a collector endpoint
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+
+# fraction of requests traced, requests arriving with a sampled W3C
+# traceparent are always traced
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 1))
+
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+MAX_STATEMENT_LENGTH = 1000
+COLLECTOR_MAX_TRACES = 256
+EXPORT_QUEUE_SIZE = 1024
+
+
+####### SPANS #######
+
+
+class Span:
+    def __init__(self, trace_id, parent_id, name, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+
+    def finish(self, error=None):
+        self.duration_ms = (time.perf_counter() - self.start) * 1000
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def format(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    """Spans of one request, the open ones stacked by nesting"""
+
+    def __init__(self, trace_id=None, parent_id=None):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.parent_id = parent_id
+        self.open = []
+        self.finished = []
+
+
+# the trace of the request this thread is serving, None when untraced
+_local = threading.local()
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def start_span(name, attributes=None):
+    """Opens a child of the innermost open span, None outside a traced request"""
+    trace = current_trace()
+    if trace is None:
+        return None
+
+    parent_id = trace.open[-1].span_id if trace.open else trace.parent_id
+    span = Span(trace.trace_id, parent_id, name, attributes)
+    trace.open.append(span)
+    return span
+
+
+def end_span(span, error=None):
+    trace = current_trace()
+    if span is None or trace is None or span not in trace.open:
+        return
+
+    span.finish(error)
+    trace.open.remove(span)
+    trace.finished.append(span)
+
+
+@contextmanager
+def span(name, **attributes):
+    opened = start_span(name, attributes)
+    try:
+        yield opened
+    except Exception as e:
+        end_span(opened, e)
+        raise
+    else:
+        end_span(opened)
+
+
+def traced(f):
+    """Records calls to f as spans named after its module and qualified name"""
+    name = f"{f.__module__}.{f.__qualname__}"
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        # untraced calls skip the context manager entirely
+        if current_trace() is None:
+            return f(*args, **kwargs)
+        with span(name):
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+def traceparent(span, sampled=True):
+    """W3C trace-context header value naming span as the parent"""
+    return f"00-{span.trace_id}-{span.span_id}-{'01' if sampled else '00'}"
+
+
+def inject(headers):
+    """Adds the current span's traceparent to the headers of an outgoing request"""
+    trace = current_trace()
+    if trace is not None and trace.open:
+        headers[TRACEPARENT_HEADER] = traceparent(trace.open[-1])
+    return headers
+
+
+####### EXPORTERS #######
+
+
+class LocalCollector:
+    """In-process stand-in for a trace collector, keeps the latest traces"""
+
+    def __init__(self, max_traces=COLLECTOR_MAX_TRACES):
+        self.traces = deque(maxlen=max_traces)
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+class FileExporter:
+    """Appends each trace as a JSON line"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps({"trace_id": spans[0]["trace_id"], "spans": spans})
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class HttpExporter:
+    """Posts traces to a collector from a background thread.
+
+    Requests never wait on the collector, traces are dropped while the
+    queue is full.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.pending = queue.Queue(EXPORT_QUEUE_SIZE)
+        self.sender = None
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        with self.lock:
+            # started lazily so the thread belongs to the worker, not a
+            # preloading master
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.send, daemon=True)
+                self.sender.start()
+
+        try:
+            self.pending.put_nowait(spans)
+        except queue.Full:
+            pass
+
+    def send(self):
+        while True:
+            spans = self.pending.get()
+            try:
+                body = json.dumps({"spans": spans}).encode()
+                urlopen(
+                    Request(
+                        self.url,
+                        data=body,
+                        headers={"Content-Type": "application/json"},
+                    ),
+                    timeout=5,
+                ).close()
+            except Exception:
+                # a collector outage only loses traces
+                pass
+
+
+def exporter_from_url(url=TRACE_EXPORTER):
+    """Builds the exporter named by TRACE_EXPORTER, None turns tracing off"""
+    if url == "none":
+        return None
+    if url == "memory":
+        return LocalCollector()
+    if url.startswith("file:"):
+        return FileExporter(url[len("file:") :])
+    if url.startswith("http://") or url.startswith("https://"):
+        return HttpExporter(url)
+
+    raise ValueError(f"unknown trace exporter: {url}")
+
+
+exporter = exporter_from_url()
+
+
+####### APP HOOKS #######
+
+
+class TracedJSONEncoder(JSONEncoder):
+    """Records response encoding as a span"""
+
+    def encode(self, o):
+        with span("response.encode"):
+            return super().encode(o)
+
+
+def setup_tracing(app, exporter=None, sample_rate=TRACE_SAMPLE_RATE):
+    """Traces requests to app, exporting each finished trace to exporter"""
+    app.extensions["tracing"] = exporter
+    if exporter is None:
+        return
+
+    app.json_encoder = TracedJSONEncoder
+
+    @app.before_request
+    def start_request_span():
+        # batched operations become children of the batch's span
+        if current_trace() is None:
+            incoming = TRACEPARENT.match(request.headers.get(TRACEPARENT_HEADER, ""))
+            sampled = incoming is not None and incoming.group(3) == "01"
+            if not (sampled or random.random() < sample_rate):
+                return
+
+            _local.trace = Trace(*incoming.group(1, 2)) if incoming else Trace()
+            request.environ["tracing.root"] = True
+
+        route = request.url_rule.rule if request.url_rule else request.path
+        request.environ["tracing.span"] = start_span(
+            f"{request.method} {route}",
+            {"http.method": request.method, "http.route": route},
+        )
+
+    @app.after_request
+    def tag_request_span(response):
+        request_span = request.environ.get("tracing.span", None)
+        if request_span is not None:
+            request_span.attributes["http.status_code"] = response.status_code
+            response.headers[TRACEPARENT_HEADER] = traceparent(request_span)
+        return response
+
+    @app.teardown_request
+    def end_request_span(exception):
+        request_span = request.environ.pop("tracing.span", None)
+        trace = current_trace()
+        if request_span is None or trace is None:
+            return
+
+        end_span(request_span, exception)
+
+        # the outermost request exports its whole trace
+        if request.environ.pop("tracing.root", False):
+            _local.trace = None
+            spans = [s.format() for s in trace.finished]
+            app.extensions["tracing"].export(spans)
+
+
+####### SQL SPANS #######
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_span(conn, cursor, statement, parameters, context, executemany):
+    if current_trace() is None:
+        return
+
+    conn.info.setdefault("trace_spans", []).append(
+        start_span(
+            "sql",
+            {
+                "db.system": "postgresql",
+                "db.statement": " ".join(statement.split())[:MAX_STATEMENT_LENGTH],
+                "db.executemany": executemany,
+            },
+        )
+    )
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement_span(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get("trace_spans"):
+        statement_span = conn.info["trace_spans"].pop()
+        if statement_span is not None:
+            statement_span.attributes["db.rowcount"] = cursor.rowcount
+        end_span(statement_span)
+
+
+@event.listens_for(Engine, "handle_error")
+def fail_statement_span(context):
+    connection = context.connection
+    if connection is not None and connection.info.get("trace_spans"):
+        end_span(connection.info["trace_spans"].pop(), context.original_exception)